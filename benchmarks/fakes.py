@@ -0,0 +1,113 @@
+import random
+import threading
+import time
+
+
+class FakeBridge(object):
+    """
+    Hue bridge without hardware for benchmarks. Every call takes given latency in
+    seconds and fails with OSError with given loss probability, like a bridge on a busy
+    wifi. Commands update state of lights, so cached state behaves as with a real bridge.
+    """
+
+    def __init__(self, lights=8, latency=0, loss=0, seed=None):
+        self.name = "Fake bridge"
+        self.pool = None
+        self.latency = latency
+        self.loss = loss
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._lights = {str(i): {"name": f"Light {i}", "state": {"on": False}}
+                        for i in range(1, lights + 1)}
+        self._groups = {}
+        self._scenes = {"scene": {"name": "After sunset scene", "group": "0",
+                                  "lights": list(self._lights)[:2]}}
+
+    def connect(self):
+        self._call()
+
+    def get_api(self):
+        self._call()
+        with self._lock:
+            return {
+                "lights": {light_id: {"name": light["name"],
+                                      "state": dict(light["state"])}
+                           for light_id, light in self._lights.items()},
+                "groups": {group_id: dict(group)
+                           for group_id, group in self._groups.items()},
+                "scenes": dict(self._scenes),
+            }
+
+    def set_light(self, light_id, state):
+        self._call()
+        with self._lock:
+            self._lights[str(light_id)]["state"].update(state)
+
+    def set_group(self, group_id, parameter, value=None):
+        self._call()
+        with self._lock:
+            if parameter == "lights":
+                self._groups[str(group_id)]["lights"] = [str(light) for light in value]
+                return [{"success": {}}]
+            if str(group_id) == "0":
+                lights = list(self._lights)
+            else:
+                lights = self._groups[str(group_id)]["lights"]
+            for light_id in lights:
+                self._lights[light_id]["state"].update(parameter)
+        return [{"success": {}}]
+
+    def create_group(self, name, lights):
+        self._call()
+        with self._lock:
+            group_id = str(len(self._groups) + 1)
+            self._groups[group_id] = {"name": name,
+                                      "lights": [str(light) for light in lights]}
+        return [{"success": {"id": group_id}}]
+
+    def activate_scene(self, group_id, scene_id):
+        self._call()
+        with self._lock:
+            for light_id in self._scenes[scene_id]["lights"]:
+                self._lights[light_id]["state"]["on"] = True
+
+    def reset(self):
+        """ Turn off all lights """
+        with self._lock:
+            for light in self._lights.values():
+                light["state"]["on"] = False
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+            lost = self._random.random() < self.loss
+        if self.latency:
+            time.sleep(self.latency)
+        if lost:
+            raise OSError(101, "Network is unreachable")
+
+
+class FakeProbe(object):
+    """
+    Network probe without network for benchmarks. Probe responds after given latency
+    or, with given loss probability, waits the timeout and does not respond. Waiting is
+    interrupted when probe is cancelled.
+    """
+
+    def __init__(self, latency=0, loss=0, timeout=0.05, seed=None):
+        self.latency = latency
+        self.loss = loss
+        self.timeout = timeout
+        self.probes = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, address, cancel):
+        with self._lock:
+            self.probes += 1
+            lost = self._random.random() < self.loss
+        if lost:
+            cancel.wait(self.timeout)
+            return False
+        return not cancel.wait(self.latency)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks of Network and Hue against fake capture, probe and bridge
+backends. Prints p50, p95 and p99 timings and peak allocations of each scenario and
+saves them as JSON, which can be compared with results of another run:
+
+    python -m benchmarks.run --output before.json
+    python -m benchmarks.run --output after.json --compare before.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from unittest.mock import patch
+
+from scapy.all import IP, Ether
+
+from benchmarks.fakes import FakeBridge, FakeProbe
+from src.bluetooth import FakeBluetoothBackend
+from src.commands import TokenBucket
+from src.dispatcher import ActionDispatcher
+from src.hue import Hue
+from src.network import Network
+from src.presence import PRESENT, Resident
+from src.rawcapture import FRAME_BUFFER, FakeFrameSource
+from src.settings import DEVICES, reload_config
+
+BENCHMARK_ENV = {
+    "DEVICES": ",".join(f"02:00:00:00:00:{i:02x}" for i in range(1, 5)),
+    "ARRIVE_LIGHTS": "Light 1,Light 2",
+    "LOCATION_LAT": "60",
+    "LOCATION_LON": "25",
+}
+RESULTS_VERSION = 1
+CAPTURE_BATCH = 100  # Frames received and handled in one capture scenario
+UNLIMITED_RATE = 1e9  # Commands per second of fake bridge, which has no rate limit
+REGRESSION_THRESHOLD = 0.2  # Relative growth of p95 reported as regression
+
+
+def percentile(values, percent):
+    """ Return given percentile of values with nearest rank method """
+    ordered = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+class Benchmark(object):
+    """
+    Network and Hue wired together as in main.py, but with fake backends. Bridge and
+    probes have given latency in seconds and loss probability. Tracked devices and
+    lights are replaced with the ones of fake bridge.
+    """
+
+    def __init__(self, latency=0.001, loss=0, seed=1):
+        os.environ.update(BENCHMARK_ENV)
+        reload_config()
+        self.bridge = FakeBridge(latency=latency, loss=loss, seed=seed)
+        with patch("src.hue.PooledBridge", return_value=self.bridge):
+            self.hue = Hue()
+        self.hue.retry.sleep = latency  # Retry at pace of fake bridge
+        for kind in self.hue.commands.buckets:
+            self.hue.commands.buckets[kind] = TokenBucket(UNLIMITED_RATE, UNLIMITED_RATE)
+        self.dispatcher = ActionDispatcher(arrive=self.hue.set_arrive,
+                                           leave=self.hue.set_leave_home)
+        self.network = Network(callback_leave=self.dispatcher.leave,
+                               callback_join=self.dispatcher.arrive, track=False,
+                               bluetooth=FakeBluetoothBackend())
+        probe = FakeProbe(latency=latency, loss=loss, seed=seed)
+        self.network._probe_arp = probe
+        self.network._probe_icmp = probe
+        self.network._probe_tcp = probe
+        self.devices = DEVICES()
+        self.packets = [Ether(src=mac)/IP(src=f"192.168.1.{i + 10}")
+                        for i, mac in enumerate(self.devices)]
+        self.frames = FakeFrameSource(self.devices)
+
+    def arrive(self):
+        """ Time from captured packet of arriving resident to arrive lights turned on """
+        self.network.presence.mark_absent(self.devices[0])
+        self.bridge.reset()
+        self.hue.state.invalidate()
+        start = time.perf_counter()
+        self.network.handle_packet(self.packets[0])
+        self.dispatcher.wait()
+        return time.perf_counter() - start
+
+    def leave(self):
+        """ Time to turn off all lights when last resident has left """
+        self.hue.state.invalidate()
+        start = time.perf_counter()
+        self.hue.set_leave_home()
+        return time.perf_counter() - start
+
+    def ping_pass(self):
+        """ Duration of one pass of probing all residents """
+        for i, mac in enumerate(self.devices):
+            self.network.presence.restore(
+                Resident(mac, f"192.168.1.{i + 10}", None, {"ip": 0}, PRESENT))
+        self.network._cadence.clear()
+        start = time.perf_counter()
+        self.network.ping_devices_online(now=time.time() + 86400)
+        return time.perf_counter() - start
+
+    def handle_packet(self):
+        """ Time to handle one packet of a resident already present """
+        packet = self.packets[1]
+        start = time.perf_counter()
+        self.network.handle_packet(packet)
+        return time.perf_counter() - start
+
+    def capture_scapy(self):
+        """
+        Time to receive and handle a batch of heartbeat frames dissected with scapy,
+        like L2listen socket does
+        """
+        sock = self.frames.socket.ins
+        return self._capture(lambda: Ether(sock.recv(FRAME_BUFFER)))
+
+    def capture_raw(self):
+        """ Time to receive and handle a batch of heartbeat frames with RawSocket """
+        return self._capture(self.frames.socket.recv)
+
+    def _capture(self, recv):
+        self.network.handle_packet(self.packets[1])  # Resident is present
+        frame = bytes(self.packets[1])
+        for _ in range(CAPTURE_BATCH):
+            self.frames.send(frame)
+        start = time.perf_counter()
+        for _ in range(CAPTURE_BATCH):
+            self.network.handle_captured(recv())
+        return time.perf_counter() - start
+
+    def scenarios(self):
+        return {
+            "arrive": self.arrive,
+            "leave": self.leave,
+            "ping_pass": self.ping_pass,
+            "handle_packet": self.handle_packet,
+            "capture_scapy": self.capture_scapy,
+            "capture_raw": self.capture_raw,
+        }
+
+
+def run_scenario(scenario, iterations):
+    """ Return timings and peak allocated bytes of given scenario function """
+    scenario()  # Warm up caches and connections
+    timings = [scenario() for _ in range(iterations)]
+
+    tracemalloc.start()
+    scenario()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "iterations": iterations,
+        "p50": percentile(timings, 50),
+        "p95": percentile(timings, 95),
+        "p99": percentile(timings, 99),
+        "mean": sum(timings) / len(timings),
+        "peak_bytes": peak,
+    }
+
+
+def run(iterations=100, latency=0.001, loss=0, names=None):
+    """ Run scenarios and return results dictionary """
+    benchmark = Benchmark(latency=latency, loss=loss)
+    scenarios = benchmark.scenarios()
+    results = {}
+    for name in names or scenarios:
+        results[name] = run_scenario(scenarios[name], iterations)
+    return {
+        "version": RESULTS_VERSION,
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "params": {"iterations": iterations, "latency": latency, "loss": loss},
+        "scenarios": results,
+    }
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Return list of (scenario, baseline p95, current p95) tuples of scenarios whose p95
+    has grown more than given threshold compared to baseline.
+    """
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous and current["p95"] > previous["p95"] * (1 + threshold):
+            regressions.append((name, previous["p95"], current["p95"]))
+    return regressions
+
+
+def print_results(results):
+    print(f"{'scenario':<16}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KiB':>10}")
+    for name, result in results["scenarios"].items():
+        print(f"{name:<16}{result['p50'] * 1000:>10.3f}{result['p95'] * 1000:>10.3f}"
+              f"{result['p99'] * 1000:>10.3f}{result['peak_bytes'] / 1024:>10.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.001,
+                        help="Seconds each fake bridge call and probe takes")
+    parser.add_argument("--loss", type=float, default=0,
+                        help="Probability of a fake bridge call or probe failing")
+    parser.add_argument("--scenario", action="append", dest="names",
+                        help="Scenario to run, by default all")
+    parser.add_argument("--output", help="File to save results as JSON")
+    parser.add_argument("--compare", help="Results JSON of earlier run to compare to")
+    args = parser.parse_args(argv)
+
+    results = run(args.iterations, args.latency, args.loss, args.names)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        for name, previous, current in regressions:
+            print(f"Regression in {name}: p95 {previous * 1000:.3f} ms -> "
+                  f"{current * 1000:.3f} ms")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
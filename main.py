@@ -1,9 +1,21 @@
 #!/usr/bin/env python3
 
+import signal
+
+from src.dispatcher import ActionDispatcher
 from src.hue import Hue
+from src.metrics import REGISTRY, serve_metrics
 from src.network import Network
+from src.scheduler import Scheduler
+from src.settings import (METRICS_HOST, METRICS_PORT, SITES, SNAPSHOT_PATH,
+                          TRACE_PROFILE, TRACE_SLOW, ConfigWatcher, load_sites)
+from src.sites import MultiSite
+from src.snapshot import SnapshotStore
+from src.tracing import TRACER, SamplingProfiler
 from src.utils import setup_logger
 
+CONFIG_WATCH_INTERVAL = 10  # Seconds between checking changes in env file
+
 
 def version():
     import logging
@@ -14,5 +26,26 @@ def version():
 if __name__ == "__main__":
     setup_logger()
     version()
-    hue = Hue()
-    network = Network(callback_leave=hue.set_leave_home, callback_join=hue.set_arrive)
+    if METRICS_PORT:
+        serve_metrics(REGISTRY, METRICS_HOST, METRICS_PORT)
+    TRACER.slow_threshold = TRACE_SLOW
+    if TRACE_PROFILE:
+        TRACER.profiler = SamplingProfiler()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: TRACER.dump())
+    if SITES:
+        runtime = MultiSite(load_sites(SITES))
+        runtime.scheduler.every(CONFIG_WATCH_INTERVAL, runtime.check, name="config")
+        signal.signal(signal.SIGHUP, lambda signum, frame: runtime.reload())
+    else:
+        scheduler = Scheduler()
+        store = SnapshotStore(SNAPSHOT_PATH)
+        hue = Hue(store=store, scheduler=scheduler)
+        dispatcher = ActionDispatcher(arrive=hue.set_arrive, leave=hue.set_leave_home)
+        REGISTRY.gauge("action_queue_depth", "Arrive and leave actions waiting",
+                       function=lambda: dispatcher.queue_depth)
+        network = Network(callback_leave=dispatcher.leave,
+                          callback_join=dispatcher.arrive, store=store,
+                          scheduler=scheduler)
+        watcher = ConfigWatcher()
+        scheduler.every(CONFIG_WATCH_INTERVAL, watcher.check, name="config")
+        signal.signal(signal.SIGHUP, lambda signum, frame: watcher.reload())
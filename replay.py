@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import time
+
+from src.replay import Replay
+from src.utils import setup_logger
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay recorded captures through home arrive and leave detection")
+    parser.add_argument("paths", nargs="+", help="Capture files or directories of them")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="Replay speed compared to recorded timing, 1 is recorded "
+                             "timing, default 0 is as fast as possible")
+    args = parser.parse_args()
+
+    setup_logger()
+    logger = logging.getLogger("main")
+    replay = Replay(speed=args.speed)
+    start = time.monotonic()
+    decisions = replay.run(args.paths)
+    elapsed = time.monotonic() - start
+    logger.info(f"Replayed {replay.packets} packets, {replay.handled} from tracked "
+                f"devices, in {elapsed:.2f}s. {len(decisions)} decisions")
@@ -0,0 +1,120 @@
+import logging
+import socket
+import struct
+import threading
+import time
+from itertools import count
+from subprocess import PIPE, Popen
+
+L2CAP_ECHO_REQUEST = 0x08
+L2CAP_ECHO_RESPONSE = 0x09
+L2CAP_CMD_HEADER = struct.Struct("<BBH")  # code, ident, length
+ECHO_PAYLOAD = b"hue-geofencing"
+ECHO_TIMEOUT = 2  # Seconds to wait for echo response
+MAX_CONNECTIONS = 3  # How many devices are paged concurrently with one adapter
+log = logging.getLogger("main")
+
+
+class BluetoothBackend(object):
+    """
+    Interface for Bluetooth ping backends. Backend pings one device at time, but the same
+    backend instance is shared between all probes and must be thread safe.
+    """
+
+    def ping(self, address, timeout=ECHO_TIMEOUT):
+        """ Send one echo to given Bluetooth mac address, return True if it responded """
+        raise NotImplementedError
+
+
+class L2capEchoBackend(BluetoothBackend):
+    """
+    Ping devices in process with L2CAP echo requests, same as l2ping does. Requires
+    raw L2CAP sockets, so process must have CAP_NET_RAW capability.
+    """
+
+    def __init__(self, adapter="00:00:00:00:00:00", max_connections=MAX_CONNECTIONS):
+        """
+        Keyword arguments:
+        adapter -- Mac address of local adapter to use, by default any adapter
+        max_connections -- How many devices can be pinged at the same time
+        """
+        self.adapter = adapter
+        self._connections = threading.Semaphore(max_connections)
+        self._ident = count()
+        self._ident_lock = threading.Lock()
+
+    def ping(self, address, timeout=ECHO_TIMEOUT):
+        with self._ident_lock:
+            ident = next(self._ident) % 255 + 1  # Ident 0 is reserved
+        with self._connections:
+            try:
+                return self._echo(address, ident, timeout)
+            except OSError as e:
+                log.debug(f"L2CAP echo to {address} failed, {e}")
+                return False
+
+    def _echo(self, address, ident, timeout):
+        with socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW,
+                           socket.BTPROTO_L2CAP) as sock:
+            sock.settimeout(timeout)
+            sock.bind((self.adapter, 0))
+            sock.connect((address, 0))
+            sock.send(build_echo_request(ident))
+
+            end = time.monotonic() + timeout
+            while time.monotonic() < end:
+                sock.settimeout(max(end - time.monotonic(), 0.01))
+                if is_echo_response(sock.recv(1024), ident):
+                    return True
+        return False
+
+
+class L2pingBackend(BluetoothBackend):
+    """ Ping devices by running l2ping from bluez, used when raw sockets are missing """
+
+    def ping(self, address, timeout=ECHO_TIMEOUT):
+        p = Popen(["l2ping", "-c", "1", "-t", str(timeout), str(address)], stdout=PIPE,
+                  stderr=PIPE, close_fds=True)
+        p.communicate()
+        return p.returncode == 0
+
+
+class FakeBluetoothBackend(BluetoothBackend):
+    """
+    Backend without radio hardware for tests and benchmarks. Addresses in present
+    respond after given latency, others time out after given timeout.
+    """
+
+    def __init__(self, present=(), latency=0, timeout=0):
+        self.present = set(present)
+        self.latency = latency
+        self.timeout = timeout
+        self.pings = []
+
+    def ping(self, address, timeout=ECHO_TIMEOUT):
+        self.pings.append(address)
+        if address in self.present:
+            time.sleep(self.latency)
+            return True
+        time.sleep(self.timeout)
+        return False
+
+
+def build_echo_request(ident, payload=ECHO_PAYLOAD):
+    """ Return L2CAP signaling echo request with given ident as bytes """
+    return L2CAP_CMD_HEADER.pack(L2CAP_ECHO_REQUEST, ident, len(payload)) + payload
+
+
+def is_echo_response(data, ident):
+    """ Return True if given bytes are L2CAP echo response to request with given ident """
+    if len(data) < L2CAP_CMD_HEADER.size:
+        return False
+    code, response_ident, _ = L2CAP_CMD_HEADER.unpack_from(data)
+    return code == L2CAP_ECHO_RESPONSE and response_ident == ident
+
+
+def default_backend():
+    """ Return in process L2CAP backend if supported by platform, otherwise l2ping """
+    if hasattr(socket, "AF_BLUETOOTH") and hasattr(socket, "BTPROTO_L2CAP"):
+        return L2capEchoBackend()
+    return L2pingBackend()
@@ -0,0 +1,108 @@
+import logging
+import os
+import threading
+import time
+from select import select
+
+from scapy.all import Ether, conf
+
+from src.rawcapture import RAW_BACKEND, RawSocket, frame_source
+from src.settings import CAPTURE_BACKEND
+
+log = logging.getLogger("main")
+
+
+class SharedCapture(object):
+    """
+    Capture socket of one interface shared by networks of many sites. BPF filter matches
+    tracked devices of all attached networks and each packet is demultiplexed by its
+    source mac to networks tracking it, so one socket and thread serve all sites on the
+    interface. Packets of a network with capture paused are discarded. With raw backend
+    frames are demultiplexed by source mac read from frame header.
+    """
+
+    def __init__(self, iface=None, backend=CAPTURE_BACKEND):
+        self.iface = iface
+        self.backend = backend
+        self.packets = 0
+        self._networks = []
+        self._by_mac = {}  # Tuple of networks by tracked mac address
+        self._wakeup = os.pipe()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def attach(self, network):
+        """ Start handling packets of devices tracked by given network """
+        with self._lock:
+            self._networks.append(network)
+        self.reload()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name=f"capture-{self.iface or 'default'}")
+                self._thread.start()
+
+    def reload(self):
+        """ Rebuild mac index and wake up capture to rebuild BPF filter """
+        by_mac = {}
+        with self._lock:
+            for network in self._networks:
+                for mac in network.config.devices:
+                    by_mac[mac] = by_mac.get(mac, ()) + (network,)
+        self._by_mac = by_mac
+        os.write(self._wakeup[1], b"\0")
+
+    def handle_packet(self, packet):
+        """ Handle packet or raw frame with networks tracking its source """
+        if isinstance(packet, memoryview):
+            source = frame_source(packet)
+        elif Ether in packet:
+            source = packet[Ether].src
+        else:
+            return
+        self.packets += 1
+        for network in self._by_mac.get(source, ()):
+            if network.capture_active:
+                network.handle_captured(packet)
+
+    def _get_BPF_filter(self):
+        return " or ".join(f"ether src host {mac}" for mac in sorted(self._by_mac))
+
+    def _run(self):
+        """ Run persistent capture, socket is reopened only when filter changes """
+        sock, sock_filter = None, None
+        while True:
+            bpf_filter = self._get_BPF_filter()
+            if sock is None or sock_filter != bpf_filter:
+                if sock is not None:
+                    sock.close()
+                sock = self._open_capture(bpf_filter)
+                sock_filter = bpf_filter
+                log.debug(f"Shared capture socket opened on {self.iface or 'default'}")
+            try:
+                self._capture_packets(sock, bpf_filter)
+            except OSError as e:
+                log.error(f"Capture failed: {e}")
+                sock.close()
+                sock = None
+                time.sleep(1)
+
+    def _open_capture(self, bpf_filter):
+        if self.backend == RAW_BACKEND:
+            return RawSocket(sorted(self._by_mac), iface=self.iface)
+        return conf.L2listen(iface=self.iface, filter=bpf_filter)
+
+    def _capture_packets(self, sock, bpf_filter):
+        """ Handle packets from socket until BPF filter changes """
+        wakeup = self._wakeup[0]
+        while True:
+            ready, _, _ = select([sock, wakeup], [], [])
+            if wakeup in ready:
+                os.read(wakeup, 1024)
+                if self._get_BPF_filter() != bpf_filter:
+                    return
+                continue
+
+            packet = sock.recv()
+            if packet is not None:
+                self.handle_packet(packet)
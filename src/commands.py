@@ -0,0 +1,172 @@
+import functools
+import heapq
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import nullcontext
+from itertools import count
+
+from src.metrics import REGISTRY
+from src.tracing import TRACER
+from src.transport import BridgeBusy
+
+LIGHT = "light"
+GROUP = "group"
+LIGHT_RATE = 10  # Light commands per second bridge can handle
+GROUP_RATE = 1  # Group and scene commands per second bridge can handle
+GROUP_BURST = 2  # Group commands sent without waiting, like a group and a scene
+COMMAND_WORKERS = 3  # How many commands are in flight at the same time
+BUSY_PAUSE = 1  # Seconds no commands of same kind are sent after bridge was busy
+ARRIVE_PRIORITY = 0  # Commands with lower priority value are sent first
+LEAVE_PRIORITY = 1
+log = logging.getLogger("main")
+
+Command = namedtuple("Command", ["kind", "func", "args", "future", "deadline", "trace"])
+
+
+class RateLimited(Exception):
+    """ Command could not be sent within deadline due to rate limit """
+
+
+COMMAND_WAIT_SECONDS = REGISTRY.histogram("bridge_command_wait_seconds",
+                                          "Time commands waited for rate limit by kind",
+                                          ["kind"])
+BRIDGE_BUSY = REGISTRY.counter("bridge_busy_total",
+                               "Commands rejected by busy bridge by kind", ["kind"])
+
+
+class TokenBucket(object):
+    """
+    Limit operations to given rate per second, with bursts up to capacity. Callers
+    reserve tokens in turn and wait until their token is available, so concurrent
+    callers are spread evenly over time. Bucket can be paused, for example when bridge
+    tells it is overloaded.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()  # Time tokens were counted, in future while paused
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """ Take one token and return seconds to wait until it is available """
+        with self._lock:
+            now = self._clock()
+            if now > self._updated:
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+            self._tokens -= 1
+            return max(self._updated - now + max(-self._tokens, 0) / self.rate, 0)
+
+    def acquire(self, timeout=None):
+        """ Wait for one token, return False without waiting if it takes over timeout """
+        wait = self.reserve()
+        if timeout is not None and wait > timeout:
+            with self._lock:
+                self._tokens += 1
+            return False
+        if wait:
+            self._sleep(wait)
+        return True
+
+    def pause(self, seconds):
+        """ Give no tokens for given seconds, tokens are refilled after the pause """
+        with self._lock:
+            self._updated = max(self._updated, self._clock() + seconds)
+            self._tokens = min(self._tokens, 0)
+
+
+class CommandDispatcher(object):
+    """
+    Send commands to bridge concurrently on a small pool of workers, limited to rate
+    bridge can handle by token buckets of light and group commands. Queued commands are
+    sent in order of priority, so commands of arriving are sent before commands of
+    leaving. Every try of a command takes a token, and when bridge tells it is busy,
+    commands of that kind are paused for a while before retrying.
+
+    Commands are run with given RetryPolicy, which takes the token before asking circuit
+    breaker. Deadline and trace of the thread submitting a command are applied to the
+    worker sending it.
+    """
+
+    def __init__(self, retry, workers=COMMAND_WORKERS, light_rate=LIGHT_RATE,
+                 group_rate=GROUP_RATE, busy_pause=BUSY_PAUSE):
+        self.retry = retry
+        self.busy_pause = busy_pause
+        self.buckets = {LIGHT: TokenBucket(light_rate),
+                        GROUP: TokenBucket(group_rate, capacity=GROUP_BURST)}
+        self._queue = []
+        self._sequence = count()
+        self._condition = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"command-{i}", daemon=True).start()
+
+    def submit(self, kind, func, args=(), priority=ARRIVE_PRIORITY):
+        """ Queue command of given kind, return Future of its result """
+        future = Future()
+        remaining = self.retry.remaining()
+        deadline = None if remaining is None else time.monotonic() + remaining
+        command = Command(kind, func, args, future, deadline, TRACER.current())
+        with self._condition:
+            heapq.heappush(self._queue, (priority, next(self._sequence), command))
+            self._condition.notify()
+        return future
+
+    def run(self, kind, func, args_list, priority=ARRIVE_PRIORITY):
+        """ Send command with each of given argument lists, return list of results """
+        futures = [self.submit(kind, func, args, priority) for args in args_list]
+        return [future.result() for future in futures]
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue)
+                _, _, command = heapq.heappop(self._queue)
+            if not command.future.set_running_or_notify_cancel():
+                continue
+            try:
+                command.future.set_result(self._send(command))
+            except Exception as e:
+                command.future.set_exception(e)
+
+    def _send(self, command):
+        """ Send command with retries, return None if all tries failed """
+        bucket = self.buckets[command.kind]
+        wait_seconds = COMMAND_WAIT_SECONDS.labels(command.kind)
+
+        def throttle():
+            with wait_seconds.time():
+                if not bucket.acquire(self.retry.remaining()):
+                    raise RateLimited(f"Rate limit of {command.kind} commands exceeds "
+                                      f"deadline")
+
+        @functools.wraps(command.func)
+        def attempt(*args):
+            try:
+                return command.func(*args)
+            except BridgeBusy:
+                log.debug(f"Bridge busy, pausing {command.kind} commands")
+                BRIDGE_BUSY.labels(command.kind).inc()
+                bucket.pause(self.busy_pause)
+                raise
+
+        deadline = nullcontext()
+        if command.deadline is not None:
+            deadline = self.retry.deadline(command.deadline - time.monotonic())
+        with TRACER.activate(command.trace), deadline:
+            try:
+                return self.retry.run(attempt, *command.args, throttle=throttle)
+            except RateLimited as e:
+                log.info(str(e))
+                return None
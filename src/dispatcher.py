@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+from src.tracing import TRACER
+
+ARRIVE = "arrive"
+LEAVE = "leave"
+log = logging.getLogger("main")
+
+Event = namedtuple("Event", ["action", "timestamp", "trace", "queued"],
+                   defaults=(None, None))
+
+
+class ActionDispatcher(object):
+    """
+    Queue arrive and leave events and run their actions in own worker thread, so
+    detection threads are not blocked by slow bridge calls. Redundant events waiting in
+    queue are coalesced:
+        - Repeated events of same type are run only once
+        - Leave followed by arrive is cancelled, as resident came back before lights
+          were turned off
+        - Arrive followed by leave runs only leave
+
+    Trace active in thread putting an event is carried with it and activated for its
+    action, traces of coalesced events are finished right away.
+    """
+
+    def __init__(self, arrive, leave):
+        """
+        Keyword arguments:
+        arrive -- Function to run for arrive events
+        leave -- Function to run for leave events
+        """
+        self._actions = {ARRIVE: arrive, LEAVE: leave}
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._running = False
+        self.latency = None  # Seconds from last event to its action finished
+        self.events = 0
+        self.coalesced = 0
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def arrive(self):
+        self._put(ARRIVE)
+
+    def leave(self):
+        self._put(LEAVE)
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def wait(self, timeout=None):
+        """ Wait until all queued actions are run, return True if queue was emptied """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._queue and not self._running, timeout=timeout)
+
+    def _put(self, action):
+        trace = TRACER.current()
+        now = time.monotonic()
+        with self._condition:
+            self.events += 1
+            pending = self._queue[-1] if self._queue else None
+            if pending and pending.action == action:
+                self.coalesced += 1
+                self._drop(trace, "coalesced")
+            elif pending and pending.action == LEAVE:
+                log.debug("Pending leave cancelled by arrive")
+                self._queue.pop()
+                self.coalesced += 2
+                self._drop(pending.trace, "cancelled")
+                self._drop(trace, "cancelled")
+            elif pending:
+                self._queue[-1] = Event(action, pending.timestamp, trace, now)
+                self.coalesced += 1
+                self._drop(pending.trace, "coalesced")
+            else:
+                self._queue.append(Event(action, now, trace, now))
+            self._condition.notify_all()
+
+    def _drop(self, trace, reason):
+        """ Finish trace of event which is not run """
+        if trace:
+            trace.attributes["dropped"] = reason
+            TRACER.finish(trace)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._queue)
+                event = self._queue.popleft()
+                self._running = True
+
+            if event.trace:
+                event.trace.add_span("queue", event.queued, time.monotonic())
+            with TRACER.activate(event.trace), TRACER.profile(event.trace):
+                try:
+                    self._actions[event.action]()
+                except Exception as e:
+                    log.error(f"Action {event.action} failed: {e}")
+                    if event.trace:
+                        event.trace.attributes["error"] = repr(e)
+            TRACER.finish(event.trace)
+
+            with self._condition:
+                self.latency = time.monotonic() - event.timestamp
+                self._running = False
+                self._condition.notify_all()
+            log.debug(f"Action {event.action} done in {self.latency:.2f}s")
@@ -0,0 +1,149 @@
+import json
+import logging
+import ssl
+import threading
+import urllib.request
+from http.client import HTTPException
+
+from phue import PhueException
+
+from src.metrics import REGISTRY
+
+EVENTSTREAM_PATH = "/eventstream/clip/v2"
+STREAM_TIMEOUT = 300  # Seconds without data from bridge before reconnecting
+RECONNECT_SLEEP = 1  # Seconds to sleep after first failed connection, doubled after each
+RECONNECT_MAX_SLEEP = 60  # Maximum seconds to sleep between connections
+TOPOLOGY_TYPES = ("light", "scene", "room", "zone", "grouped_light")
+log = logging.getLogger("main")
+
+BRIDGE_EVENTS = REGISTRY.counter("bridge_events_total",
+                                 "Events received from bridge event stream", ["type"])
+BRIDGE_RESYNCS = REGISTRY.counter("bridge_resyncs_total",
+                                  "Full fetches of bridge state by event stream")
+
+
+def parse_events(lines):
+    """
+    Generate (id, data) tuples of server-sent events from given lines as bytes. Data of
+    multiple data lines is joined with newlines, comments and unknown fields are skipped.
+    """
+    event_id, data = None, []
+    for line in lines:
+        line = line.decode("utf-8").rstrip("\r\n")
+        if not line:
+            if data:
+                yield event_id, "\n".join(data)
+            event_id, data = None, []
+            continue
+        field, _, value = line.partition(":")
+        value = value[1:] if value.startswith(" ") else value
+        if field == "data":
+            data.append(value)
+        elif field == "id":
+            event_id = value
+
+
+class BridgeMirror(object):
+    """
+    Keep state of lights in BridgeState up to date from push event stream of bridge, so
+    reads are answered from memory without polling. After each connection state is
+    fetched again in full, as changes while disconnected are missed. Connection is
+    reconnected with exponential backoff, and state is polled with TTL as usual while
+    event stream is not connected.
+
+    Bridge has a certificate of its own authority, it is not verified as commands are
+    sent in plain HTTP anyway.
+    """
+
+    def __init__(self, state, url, username, timeout=STREAM_TIMEOUT,
+                 sleep=RECONNECT_SLEEP, max_sleep=RECONNECT_MAX_SLEEP):
+        """
+        Keyword arguments:
+        state -- BridgeState to update
+        url -- URL of event stream, for example https://<bridge ip>/eventstream/clip/v2
+        username -- Username of bridge API, sent as application key
+        timeout -- Seconds without data before reconnecting
+        """
+        self.state = state
+        self.url = url
+        self.username = username
+        self.timeout = timeout
+        self.sleep = sleep
+        self.max_sleep = max_sleep
+        self.events = 0
+        self.connections = 0
+        self._stopped = threading.Event()
+        self._context = ssl.create_default_context()
+        self._context.check_hostname = False
+        self._context.verify_mode = ssl.CERT_NONE
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="eventstream", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self.state.live = False
+
+    def _run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                self._stream()
+                failures = 0
+            except (OSError, HTTPException, ValueError, PhueException) as e:
+                log.debug(f"Bridge event stream failed, {e}")
+                failures += 1
+            except Exception:
+                log.exception("Bridge event stream failed unexpectedly")
+                failures += 1
+            self.state.live = False
+            self._stopped.wait(min(self.sleep * 2 ** failures, self.max_sleep))
+
+    def _stream(self):
+        """ Connect to event stream and apply events until connection is closed """
+        request = urllib.request.Request(self.url, headers={
+            "hue-application-key": self.username or "",
+            "Accept": "text/event-stream",
+        })
+        with urllib.request.urlopen(request, timeout=self.timeout,
+                                    context=self._context) as response:
+            self.connections += 1
+            self.resync()
+            self.state.live = True
+            log.debug("Bridge event stream connected")
+            for event_id, data in parse_events(response):
+                if self._stopped.is_set():
+                    return
+                self.apply(json.loads(data))
+        log.debug("Bridge event stream closed")
+
+    def resync(self):
+        """ Fetch full state of bridge """
+        BRIDGE_RESYNCS.inc()
+        self.state.refresh()
+
+    def apply(self, messages):
+        """
+        Apply list of event messages to state. Light on states are updated in place,
+        added or deleted lights, scenes and groups fetch state again.
+        """
+        lights = {}
+        for message in messages:
+            for resource in message.get("data", []):
+                self.events += 1
+                BRIDGE_EVENTS.labels(message.get("type", "unknown")).inc()
+                if message.get("type") in ("add", "delete"):
+                    if resource.get("type") in TOPOLOGY_TYPES:
+                        self.resync()
+                        return
+                    continue
+                if resource.get("type") != "light" or "on" not in resource:
+                    continue
+                prefix, _, light_id = resource.get("id_v1", "").rpartition("/")
+                if prefix == "/lights" and light_id.isdigit():
+                    lights[int(light_id)] = resource["on"]["on"]
+        if lights and not self.state.update_lights(lights):
+            self.resync()
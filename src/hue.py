@@ -1,121 +1,545 @@
+import copy
 import logging
 import os
+import random
+import threading
 import time
+from collections import namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-from phue import Bridge, PhueException
+from phue import PhueException
 from pytz import timezone
 
-from src.settings import (AFTER_SUNSET_SCENE, ARRIVE_LIGHTS, BRIDGE_IP,
-                          DISABLE_END, DISABLE_START, EXCLUDE_LIGHTS)
+from src.commands import (ARRIVE_PRIORITY, GROUP, LEAVE_PRIORITY, LIGHT,
+                          CommandDispatcher)
+from src.eventstream import EVENTSTREAM_PATH, BridgeMirror
+from src.metrics import REGISTRY
+from src.settings import (AFTER_SUNSET_SCENE, BRIDGE_IP, BRIDGE_STATE_TTL,
+                          DISABLE_END, DISABLE_START, EVENT_STREAM, get_config)
 from src.sun import Sun
+from src.tracing import TRACER
+from src.transport import BridgeBusy, PooledBridge
 
 log = logging.getLogger("main")
 
+ALL_LIGHTS_GROUP = 0  # Special group id of bridge containing all lights
+LEAVE_GROUP = "Hue geofencing"  # Group managed for turning off lights when leaving
+ARRIVE_STATE = {'on': True, 'bri': 255}
+LEAVE_STATE = {'on': False}
+ACTION_DEADLINE = 60  # Seconds one arrive or leave action may spend retrying
+RETRY_ATTEMPTS = 10  # How many times a bridge call is tried
+RETRY_SLEEP = 0.5  # Seconds to sleep after first failure, doubled after each failure
+RETRY_MAX_SLEEP = 8  # Maximum seconds to sleep between tries
+BREAKER_THRESHOLD = 5  # Consecutive failures after bridge is considered unreachable
+BREAKER_RESET = 30  # Seconds to fail fast before probing bridge again
+
+LightState = namedtuple("LightState", ["light_id", "name", "on"])
+SceneState = namedtuple("SceneState", ["scene_id", "name", "group", "lights"])
+GroupState = namedtuple("GroupState", ["group_id", "name", "lights"])
+
+BRIDGE_CALL_SECONDS = REGISTRY.histogram("bridge_call_seconds",
+                                         "Duration of bridge calls by function",
+                                         ["call"])
+BRIDGE_RETRIES = REGISTRY.counter("bridge_retries_total",
+                                  "Bridge calls retried after failure", ["call"])
+BRIDGE_FAILURES = REGISTRY.counter("bridge_failures_total",
+                                   "Bridge calls failed after all tries", ["call"])
+BRIDGE_REJECTED = REGISTRY.counter("bridge_rejected_total",
+                                   "Bridge calls not made as circuit was open")
+ACTION_SECONDS = REGISTRY.histogram("action_seconds",
+                                    "Duration of arrive and leave actions", ["action"])
+
+
+class CircuitBreaker(object):
+    """
+    Fail fast while bridge is unreachable. Circuit opens after given amount of
+    consecutive failures and calls are rejected until reset timeout has passed. After
+    that one call at a time is let through to probe for recovery, success of the call
+    closes the circuit and failure opens it again. Probe ending without either, for
+    example with an unexpected exception, is released so another call can probe.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_timeout=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened is not None
+
+    def allow(self):
+        """ Return True if call can be made """
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._probing or time.monotonic() - self._opened < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self._opened is not None:
+                log.info("Connection to Hue bridge recovered")
+            self.failures = 0
+            self._opened = None
+            self._probing = False
+
+    def release(self):
+        """ Let next call probe, when probe call ended without success or failure """
+        with self._lock:
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                if self._opened is None:
+                    log.info("Hue bridge unreachable, failing fast")
+                self._opened = time.monotonic()
+                self._probing = False
+
+
+class RetryPolicy(object):
+    """
+    Run bridge calls with retries. Sleep between tries grows exponentially with random
+    jitter. Tries are limited by amount, by deadline of current action and by circuit
+    breaker shared between all calls. Busy exceptions are retried like others, but
+    bridge telling it is busy is reachable, so they do not open the circuit.
+    """
+
+    def __init__(self, exceptions=(OSError, PhueException), attempts=RETRY_ATTEMPTS,
+                 sleep=RETRY_SLEEP, max_sleep=RETRY_MAX_SLEEP, breaker=None,
+                 busy=(BridgeBusy,)):
+        self.exceptions = exceptions
+        self.busy = busy
+        self.attempts = attempts
+        self.sleep = sleep
+        self.max_sleep = max_sleep
+        self.breaker = breaker or CircuitBreaker()
+        self._local = threading.local()
+
+    @contextmanager
+    def deadline(self, seconds):
+        """
+        Limit time spent in retries of all calls inside context to given seconds. Nested
+        deadlines can not extend the outer one.
+        """
+        previous = getattr(self._local, "deadline", None)
+        deadline = time.monotonic() + seconds
+        self._local.deadline = min(deadline, previous) if previous else deadline
+        try:
+            yield
+        finally:
+            self._local.deadline = previous
+
+    def remaining(self):
+        """ Return seconds left until deadline of current thread, None without one """
+        deadline = getattr(self._local, "deadline", None)
+        return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+    def run(self, func, *args, throttle=None):
+        """
+        Run given function, return its result or None if all tries failed. Throttle is
+        called before each try and before asking circuit breaker, so a try waiting for
+        rate limit does not hold the recovery probe of an open circuit.
+        """
+        deadline = getattr(self._local, "deadline", None)
+        name = getattr(func, "__name__", repr(func))
+        call = getattr(func, "__name__", "unknown")
+        call_seconds = BRIDGE_CALL_SECONDS.labels(call)
+        for attempt in range(self.attempts):
+            if throttle:
+                throttle()
+            if not self.breaker.allow():
+                log.debug(f'Circuit open, not running {name}')
+                BRIDGE_REJECTED.inc()
+                return None
+            try:
+                with TRACER.span(call, attempt=attempt), call_seconds.time():
+                    result = func(*args)
+            except self.exceptions as e:
+                if isinstance(e, self.busy):
+                    self.breaker.success()
+                else:
+                    self.breaker.failure()
+                sleep = min(self.sleep * 2 ** attempt, self.max_sleep)
+                sleep *= random.uniform(0.5, 1)
+                if deadline and time.monotonic() + sleep > deadline:
+                    log.info(f'Deadline exceeded when running {name}')
+                    BRIDGE_FAILURES.labels(call).inc()
+                    return None
+                log.debug(f'Try to run failed, sleeping {sleep:.2f}s, {e}')
+                BRIDGE_RETRIES.labels(call).inc()
+                with TRACER.span("retry_sleep"):
+                    time.sleep(sleep)
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.success()
+                return result
+        log.info(f'Failed to run {name} with args {args}')
+        BRIDGE_FAILURES.labels(call).inc()
+        return None
+
+
+class BridgeSnapshot(object):
+    """
+    Lights, groups and scenes of Hue bridge at one point of time, indexed by id and
+    name. Built from full api dictionary, so whole snapshot is fetched with one request.
+
+    Snapshot restored from disk has only topology of the bridge, state of lights is
+    unknown.
+    """
+
+    def __init__(self, api, restored=False):
+        self.timestamp = time.monotonic()
+        self.restored = restored
+        self.lights = [
+            LightState(int(light_id), light["name"], light["state"]["on"])
+            for light_id, light in api.get("lights", {}).items()
+        ]
+        self.scenes = [
+            SceneState(scene_id, scene["name"], scene.get("group", 0),
+                       sorted(int(light_id) for light_id in scene.get("lights", [])))
+            for scene_id, scene in api.get("scenes", {}).items()
+        ]
+        self.groups = [
+            GroupState(int(group_id), group["name"],
+                       frozenset(int(light_id) for light_id in group.get("lights", [])))
+            for group_id, group in api.get("groups", {}).items()
+        ]
+        self._index_lights()
+        self.scenes_by_id = {scene.scene_id: scene for scene in self.scenes}
+        self.scenes_by_name = {scene.name: scene for scene in self.scenes}
+        self.groups_by_name = {group.name: group for group in self.groups}
+        self.groups_by_lights = {group.lights: group for group in self.groups}
+
+    def with_lights(self, states):
+        """
+        Return copy of snapshot with given on states by light id. Topology is shared
+        with the copy, so updating state of lights does not rebuild indexes of it.
+        """
+        snapshot = copy.copy(self)
+        snapshot.lights = [light._replace(on=states[light.light_id])
+                           if light.light_id in states else light
+                           for light in self.lights]
+        snapshot._index_lights()
+        return snapshot
+
+    def _index_lights(self):
+        self.lights_by_id = {light.light_id: light for light in self.lights}
+        self.lights_by_name = {light.name: light for light in self.lights}
+
+    def topology(self):
+        """ Return ids and names of lights, groups and scenes as api dictionary """
+        return {
+            "lights": {
+                str(light.light_id): {"name": light.name, "state": {"on": None}}
+                for light in self.lights
+            },
+            "scenes": {
+                scene.scene_id: {"name": scene.name, "group": scene.group,
+                                 "lights": [str(light_id) for light_id in scene.lights]}
+                for scene in self.scenes
+            },
+            "groups": {
+                str(group.group_id): {
+                    "name": group.name,
+                    "lights": [str(light_id) for light_id in sorted(group.lights)],
+                }
+                for group in self.groups
+            },
+        }
+
+
+class BridgeState(object):
+    """
+    Cache for bridge state. Snapshot is fetched again when it is older than given TTL in
+    seconds or it has been invalidated, for example after a command was sent to bridge.
+    While live, state of lights is kept up to date by BridgeMirror from event stream of
+    bridge, so snapshot does not expire and commands to lights do not invalidate it.
+
+    If SnapshotStore is given, topology of the bridge is restored from it and saved to
+    it when changed. Restored topology is used until invalidated by callers that do not
+    need state of lights.
+    """
+
+    def __init__(self, bridge, ttl=BRIDGE_STATE_TTL, store=None):
+        self.bridge = bridge
+        self.ttl = ttl
+        self._store = store
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.live = False
+        if store and store.get("bridge"):
+            self._snapshot = BridgeSnapshot(store.get("bridge"), restored=True)
+
+    def get(self, light_state=True):
+        """
+        Return current snapshot, fetch new one from bridge if needed. If light_state is
+        False, snapshot restored from disk is accepted.
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot and snapshot.restored:
+                expired = light_state
+            elif self.live:
+                expired = not snapshot
+            else:
+                expired = not snapshot or time.monotonic() - snapshot.timestamp > self.ttl
+            if expired:
+                snapshot = self._fetch()
+            return snapshot
+
+    def refresh(self):
+        """ Fetch new snapshot from bridge """
+        with self._lock:
+            return self._fetch()
+
+    def update_lights(self, states):
+        """
+        Update on states by light id to current snapshot. Returns False if there is no
+        snapshot with state of lights or a light is unknown, so snapshot must be fetched.
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            if not snapshot or snapshot.restored:
+                return False
+            self._snapshot = snapshot.with_lights(states)
+            return all(light_id in snapshot.lights_by_id for light_id in states)
+
+    def invalidate(self, topology=True):
+        """
+        Invalidate snapshot. If topology is False, only state of lights has changed,
+        which does not invalidate a live snapshot.
+        """
+        if topology or not self.live:
+            self._snapshot = None
+
+    def _fetch(self):
+        snapshot = BridgeSnapshot(self.bridge.get_api())
+        self._snapshot = snapshot
+        if self._store:
+            self._store.update("bridge", snapshot.topology())
+        return snapshot
+
 
 class Hue(object):
     """
     Class to control Hue lights. Provides methods to trigger lights with full brightness
     when user arrives home and turn off all lights when all users have left home
     """
-    def __init__(self):
-        config_path = f"{os.getcwd()}/.phue_config"
+    def __init__(self, store=None, scheduler=None, bridge_ip=BRIDGE_IP, config=get_config,
+                 sun=None, scene=AFTER_SUNSET_SCENE, config_path=None,
+                 event_stream=EVENT_STREAM):
+        """
+        Keyword arguments:
+        store -- SnapshotStore to warm start bridge topology from, default None
+        scheduler -- Scheduler for periodic updates of sunset times, default None
+        bridge_ip -- Address of Hue bridge, default from settings
+        config -- Function returning Config of lights, default global config
+        sun -- Sun to share between many bridges, by default own Sun is created
+        scene -- Name of scene activated when arriving after sunset
+        config_path -- File to save bridge username to, default in working directory
+        event_stream -- Mirror state of lights from event stream of bridge
+        """
+        config_path = config_path or f"{os.getcwd()}/.phue_config"
+        self.retry = RetryPolicy()
+        self.commands = CommandDispatcher(self.retry)
+        self._config = config
+        self.after_sunset_scene = scene
         try:
-            self.bridge = Bridge(BRIDGE_IP, config_file_path=config_path)
+            self.bridge = PooledBridge(bridge_ip, config_file_path=config_path)
         except OSError:
-            log.error(f'Failed to connect to Hue bridge using address {BRIDGE_IP}')
+            log.error(f'Failed to connect to Hue bridge using address {bridge_ip}')
             exit()
         self.__try_to_run(self.bridge.connect, [])
-        bridge_name = self.__try_to_get(self.bridge.name, sleep=0.1)  # Test connection
+        bridge_name = self.__try_to_get(lambda: self.bridge.name)  # Test connection
         if not bridge_name:
-            log.error(f'Failed to connect to Hue bridge using address {BRIDGE_IP}')
+            log.error(f'Failed to connect to Hue bridge using address {bridge_ip}')
             exit()
 
         log.info(f'Connected to Hue bridge, {bridge_name}!')
-        self.sunset = Sun()
+        self.state = BridgeState(self.bridge, store=store)
+        self.sunset = sun or Sun(scheduler=scheduler)
+        self.mirror = None
+        if event_stream:
+            url = f"https://{bridge_ip}{EVENTSTREAM_PATH}"
+            self.mirror = BridgeMirror(self.state, url, self.bridge.username).start()
+        REGISTRY.gauge("bridge_circuit_open", "1 if bridge is considered unreachable",
+                       function=lambda: int(self.retry.breaker.is_open))
+        REGISTRY.gauge("bridge_state_live", "1 if state of lights is mirrored live",
+                       function=lambda: int(self.state.live))
 
     def set_arrive(self):
         """
         Set all given lights to full brightness. If sun has set, trigger additional light
         settings.
         """
-        if self._is_disabled_time():
+        with ACTION_SECONDS.labels("arrive").time(), self.retry.deadline(ACTION_DEADLINE):
+            self._set_arrive()
+        self._log_connection_stats()
+
+    def _set_arrive(self):
+        with TRACER.span("disabled_time"):
+            disabled = self._is_disabled_time()
+        if disabled:
             log.info("Home arrive not triggered due disabled time")
             return
 
-        for light in ARRIVE_LIGHTS():
-            self.__try_to_run(self._turn_on_light, [light])
-        if self.sunset.is_past_sunset():
+        snapshot = self.__try_to_run(self.state.get, [False])
+        if not snapshot:
+            return
+
+        lights = []
+        for name in self._config().arrive_lights:
+            light = snapshot.lights_by_name.get(name)
+            if not light:
+                log.info(f"Light {name} not found")
+                continue
+            lights.append(light.light_id)
+        self._set_lights(snapshot, lights, ARRIVE_STATE)
+        with TRACER.span("sunset"):
+            past_sunset = self.sunset.is_past_sunset()
+        if past_sunset:
             self.set_arrive_after_sunset()
 
     def set_arrive_after_sunset(self):
-        self.activate_scene(AFTER_SUNSET_SCENE)
+        self.activate_scene(self.after_sunset_scene)
 
     def set_leave_home(self):
         """ Turn off all lights """
-        all_lights = self.__try_to_get(self.bridge.lights)
-        if not all_lights:
+        with ACTION_SECONDS.labels("leave").time(), self.retry.deadline(ACTION_DEADLINE):
+            result = self._set_leave_home()
+        self._log_connection_stats()
+        return result
+
+    def _set_leave_home(self):
+        snapshot = self.__try_to_run(self.state.get, [False])
+        if not snapshot or not snapshot.lights:
             return False
 
-        for light in all_lights:
-            if self.__try_to_get(light.name) in EXCLUDE_LIGHTS():
-                continue
-            self.__try_to_run(self._turn_off_light, [light.light_id])
-        return True
+        excluded = self._config().excluded_lights
+        lights = [light.light_id for light in snapshot.lights
+                  if light.name not in excluded]
+        return self._set_lights(snapshot, lights, LEAVE_STATE, managed_group=LEAVE_GROUP,
+                                priority=LEAVE_PRIORITY)
 
     def activate_scene(self, name):
         """ Activate scene by name """
-        scene = self.__try_to_run(self._resolve_scene, [name])
-        if not scene or not self._is_scene_lights_off(scene):
+        with TRACER.span("scene", scene=name):
+            return self._activate_scene(name)
+
+    def _activate_scene(self, name):
+        snapshot = self.__try_to_run(self.state.get, [])
+        if not snapshot:
+            return
+        scene = snapshot.scenes_by_name.get(name)
+        if not scene or not self._is_scene_lights_off(snapshot, scene):
             return
-        return self.__try_to_run(self.bridge.activate_scene,
-                                 [scene.group, scene.scene_id])
+        result, = self.commands.run(GROUP, self.bridge.activate_scene,
+                                    [(scene.group, scene.scene_id)])
+        self.state.invalidate(topology=False)
+        return result
 
-    def _is_scene_lights_off(self, scene):
+    def _is_scene_lights_off(self, snapshot, scene):
         """
-        Return True if any of lights in given scene is turned on
+        Return True if all lights in given scene are turned off
         """
         if not scene or not scene.lights:
             return False
 
-        scene_lights = self.__try_to_run(self._get_lights, [scene.lights])
+        scene_lights = [snapshot.lights_by_id[light_id] for light_id in scene.lights
+                        if light_id in snapshot.lights_by_id]
         if not scene_lights:
             return False
         return all(light.on is False for light in scene_lights)
 
-    def _get_lights(self, lights):
-        return [light for light in self.bridge.lights if light.light_id in lights]
+    def _set_lights(self, snapshot, lights, state, managed_group=None,
+                    priority=ARRIVE_PRIORITY):
+        """
+        Set given state to given light ids with as few requests as possible. If lights
+        match all lights or lights of an existing group, one group action is sent. If
+        managed group name is given, lights of that group are updated to match given
+        lights and it is used instead of commanding each light. Otherwise state is set to
+        each light with one request per light, sent concurrently within rate limits of
+        bridge.
 
-    def _resolve_scene(self, name):
+        Returns True if all commands were sent successfully, otherwise False
         """
-        Resolve scene and group ids from scene name.
-        Returns scene or None if scene not found
+        if not lights:
+            return True
+
+        with TRACER.span("set_lights", lights=len(lights)):
+            with TRACER.span("resolve_group"):
+                group_id = self._resolve_group(snapshot, frozenset(lights),
+                                               managed_group, priority)
+            if group_id is not None:
+                result, = self.commands.run(GROUP, self._set_group, [(group_id, state)],
+                                            priority)
+                return result is not None
+            return all(self.commands.run(LIGHT, self._set_light,
+                                         [(light, state) for light in lights], priority))
+
+    def _resolve_group(self, snapshot, lights, managed_group=None,
+                       priority=ARRIVE_PRIORITY):
         """
-        all_scenes = self.__try_to_get(self.bridge.scenes)
-        if not all_scenes:
+        Return id of group containing exactly given set of light ids or None if there is
+        no such group and managed group can not be used. Managed group is updated with
+        group commands of given priority.
+        """
+        if lights == frozenset(snapshot.lights_by_id):
+            return ALL_LIGHTS_GROUP
+        if lights in snapshot.groups_by_lights:
+            return snapshot.groups_by_lights[lights].group_id
+        if not managed_group or len(lights) < 2:
             return None
-        for scene in self.bridge.scenes:
-            if scene.name == name:
-                return scene
-        return None
 
-    def _turn_off_light(self, light):
-        """
-        Utility function to turn off given light and catch possible OSError.
+        group = snapshot.groups_by_name.get(managed_group)
+        if group:
+            result, = self.commands.run(
+                GROUP, self.bridge.set_group,
+                [(group.group_id, 'lights', sorted(lights))], priority)
+            self.state.invalidate()
+            return group.group_id if result else None
 
-        OSError gets raised sometimes witch coded 101 Network is unreachable. Try to turn
-        off light given times again if exception is raised.
+        result, = self.commands.run(GROUP, self.bridge.create_group,
+                                    [(managed_group, sorted(lights))], priority)
+        self.state.invalidate()
+        try:
+            return int(result[0]['success']['id'])
+        except (TypeError, KeyError, IndexError, ValueError):
+            log.info(f'Failed to create group {managed_group}, {result}')
+            return None
+
+    def _set_light(self, light, state):
+        """
+        Utility function to set given state to light with one request.
 
-        Returns True if light is turned off successfully, otherwise False
+        OSError gets raised sometimes witch coded 101 Network is unreachable, run with
+        __try_to_run to try again if exception is raised.
         """
-        self.bridge.set_light(light, 'on', False)
+        self.state.invalidate(topology=False)
+        self.bridge.set_light(light, state)
         return True
 
-    def _turn_on_light(self, light):
-        self.bridge.set_light(light, 'on', True)
-        self.bridge.set_light(light, 'bri', 255)
+    def _set_group(self, group, state):
+        """ Utility function to set given state to lights of group with one request """
+        self.state.invalidate(topology=False)
+        self.bridge.set_group(group, state)
         return True
 
+    def _log_connection_stats(self):
+        if self.bridge.pool:
+            log.debug(f'Bridge connections: {self.bridge.pool.stats()}')
+
     def _is_disabled_time(self):
         if not DISABLE_START or not DISABLE_END:
             return False
@@ -131,25 +555,10 @@ class Hue(object):
 
         return now >= start and now <= end
 
-    def __try_to_run(self, func, args, exceptions=(OSError, PhueException), amount=10,
-                     sleep=2):
-        """ Try to run given function and catch given exceptions """
-        for _ in range(amount):
-            try:
-                return func(*args)
-            except exceptions as e:
-                log.debug(f'Try to run failed, sleeping {sleep}s, {e}')
-                time.sleep(sleep)
-        log.info(f'Failed to run {func.__name__} with args {args}')
-        return None
+    def __try_to_run(self, func, args):
+        """ Run given function with retry policy, return None if all tries failed """
+        return self.retry.run(func, *args)
 
-    def __try_to_get(self, property, exceptions=(OSError, PhueException), amount=10,
-                     sleep=2):
-        for _ in range(amount):
-            try:
-                return property
-            except exceptions as e:
-                log.debug(f'Try to get failed, sleeping {sleep}s, {e}')
-                time.sleep(sleep)
-        log.info('Failed to get property')
-        return None
+    def __try_to_get(self, getter):
+        """ Get property with retry policy, getter is called again on each try """
+        return self.retry.run(getter)
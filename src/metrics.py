@@ -0,0 +1,281 @@
+import logging
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+log = logging.getLogger("main")
+
+
+class CounterValue(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeValue(object):
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class HistogramValue(object):
+    """ Counts of observations in buckets, last bucket is for values over all bounds """
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        """ Observe seconds spent inside context """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Metric(object):
+    """
+    Metric with optional labels. Values of each combination of label values are
+    created on first use with labels(), callers on hot paths should keep the returned
+    value instead of looking it up for every update. Metric without labels is updated
+    directly. If function is given, value is read from it when metrics are collected,
+    which costs nothing on the hot path for values already counted elsewhere. Function
+    of a metric with labels returns dictionary of label value tuples and values.
+
+    Updates are not locked, increments are cheap enough for packet handling and a lost
+    increment in a rare thread race is acceptable for monitoring.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """ Return value of given label values, created if it does not exist """
+        value = self._values.get(values)
+        if value is None:
+            with self._lock:
+                value = self._values.setdefault(values, self._create())
+        return value
+
+    def samples(self):
+        """ Return list of (name suffix, labels dictionary, value) tuples """
+        if self.function and self.label_names:
+            return [("", dict(zip(self.label_names, values)), value)
+                    for values, value in self.function().items()]
+        if self.function:
+            return [("", {}, self.function())]
+        samples = []
+        for values, value in list(self._values.items()):
+            samples.extend(self._samples(dict(zip(self.label_names, values)), value))
+        return samples
+
+    def _create(self):
+        raise NotImplementedError
+
+    def _samples(self, labels, value):
+        return [("", labels, value.value)]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def _create(self):
+        return CounterValue()
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def _create(self):
+        return GaugeValue()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _create(self):
+        return HistogramValue(self.buckets)
+
+    def _samples(self, labels, value):
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), list(value.counts)):
+            total += count
+            samples.append(("_bucket", dict(labels, le=_format_value(bound)), total))
+        samples.append(("_sum", labels, value.sum))
+        samples.append(("_count", labels, total))
+        return samples
+
+
+class Registry(object):
+    """ Collection of metrics rendered together in Prometheus text format """
+
+    def __init__(self, prefix="hue_geofencing_"):
+        self.prefix = prefix
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add metric to registry and return it. Metric with same name is replaced, so
+        objects created again, for example in tests, report their own values.
+        """
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=(), function=None):
+        return self.register(Counter(name, documentation, labels, function))
+
+    def gauge(self, name, documentation, labels=(), function=None):
+        return self.register(Gauge(name, documentation, labels, function))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """ Return all metrics in Prometheus text exposition format """
+        lines = []
+        for metric in sorted(list(self._metrics.values()), key=lambda m: m.name):
+            name = self.prefix + metric.name
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                log.debug(f"Failed to collect metric {name}, {e}")
+                continue
+            for suffix, labels, value in samples:
+                lines.append(f"{name}{suffix}{_format_labels(labels)} "
+                             f"{_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer(object):
+    """ Serve metrics of registry on /metrics over HTTP in own thread """
+
+    def __init__(self, registry, host, port):
+        handler = type("MetricsHandler", (MetricsHandler,), {"registry": registry})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info(f"Serving metrics on http://{host}:{self.port}/metrics")
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def serve_metrics(registry, host, port):
+    """
+    Return MetricsServer of registry or None if it can not be started, for example when
+    port is used by another instance. Missing metrics do not stop the server.
+    """
+    try:
+        return MetricsServer(registry, host, port)
+    except OSError as e:
+        log.error(f"Failed to serve metrics on {host}:{port}, {e}")
+        return None
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    values = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return "{" + values + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value is None or value != value:
+        return "NaN"
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
@@ -1,19 +1,60 @@
 import ipaddress
 import logging
-import subprocess
+import os
+import struct
 import threading
 import time
-from subprocess import PIPE, Popen
-
-import schedule
-from scapy.all import ARP, ICMP, IP, TCP, Ether, sniff, sr1, srp
-
-from src.settings import (BLUETOOTH_DEVICES, DEVICES, NETWORK_MASK,
-                          PING_SCHEDULE, SCAN_INTERVAL)
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain, islice
+from select import select
+
+from scapy.all import (ARP, DHCP, ICMP, IP, TCP, Ether, ICMPv6ND_NS, conf, sr1,
+                       srp)
+
+from src.bluetooth import default_backend
+from src.metrics import REGISTRY
+from src.presence import ABSENT, PRESENT, SUSPECT, PresenceStore, Resident
+from src.rawcapture import (RAW_BACKEND, RawSocket, frame_ipv4_source,
+                            frame_source, packed_address)
+from src.scheduler import Scheduler
+from src.settings import (CAPTURE_BACKEND, HEARTBEAT_WINDOW, LEAVE_GRACE,
+                          LEAVE_MISSES, NETWORK_MASK, PING_SCHEDULE,
+                          SCAN_INTERVAL, get_config, on_reload)
+from src.tracing import TRACER
 
 MAX_PING_TRIES = 5  # How many times a device is pinged
+SWEEP_BATCH_SIZE = 256  # How many ARP requests are sent in one send/receive pass
+SWEEP_INTERVAL = 0.005  # Seconds between sent ARP requests, limits the send rate
+SWEEP_TIMEOUT = 2  # Seconds to wait for replies after last request of a batch
+PROBE_WORKERS = 8  # How many probes are run concurrently
+PROBE_DEADLINE = 30  # Seconds one pass of pinging devices online may take
+PROBE_TICK = 10  # Seconds between checking which residents are due to be probed
+PROBE_BACKOFF = 2  # Multiplier of probe interval after a response
+PROBE_MAX_INTERVAL = 4  # Longest probe interval as multiple of scan interval
+SUSPECT_INTERVAL = 30  # Seconds between probes of a resident not responding
+SNAPSHOT_MAX_AGE = 3600  # Seconds after devices seen are not restored from snapshot
+CAPTURE_STATS_INTERVAL = 600  # Seconds between logging capture counters
+DRAIN_LIMIT = 10000  # Maximum amount of stale packets discarded when capture resumes
+HEARTBEAT_RESOLUTION = 1  # Seconds, packets of a present resident seen within are skipped
+CAPTURE_MAX_DELAY = 60  # Seconds, older packet timestamps are not traced as capture
+ARRIVE_TRACE = "arrive"
+LEAVE_TRACE = "leave"
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+DHCP_DISCOVER = 1
+DHCP_REQUEST = 3
 log = logging.getLogger("main")
 
+ProbeCadence = namedtuple("ProbeCadence", ["interval", "next_probe", "misses"])
+
+PROBE_SECONDS = REGISTRY.histogram("probe_seconds", "Duration of probes by method",
+                                   ["method"])
+PROBES = REGISTRY.counter("probes_total", "Probes by method and result",
+                          ["method", "result"])
+PROBE_PASS_SECONDS = REGISTRY.histogram("probe_pass_seconds",
+                                        "Duration of concurrent probe passes")
+
 
 class Network(object):
     """
@@ -22,228 +63,691 @@ class Network(object):
     periodically.
     """
 
-    def __init__(self, callback_leave, callback_join, track=True):
+    def __init__(self, callback_leave, callback_join, track=True, bluetooth=None,
+                 store=None, scheduler=None, clock=time.time, config=get_config,
+                 network_mask=NETWORK_MASK, iface=None, capture=None, probe_pool=None,
+                 capture_backend=CAPTURE_BACKEND, stagger=0):
         """
-        Set up network class and create intervals.
+        Set up network class and create intervals. Scheduler, probe pool and capture can
+        be shared between networks of many sites.
 
         Keyword arguments:
         callback_join -- Function to trigger when new tracked device joins to network
         callback_leave -- Function to trigger when none of tracked devices are in network
         track -- Start ARP packet sniffing and interval to scan network, default True
+        bluetooth -- Bluetooth ping backend, by default resolved from platform
+        store -- SnapshotStore to warm start from and save presence to, default None
+        scheduler -- Scheduler to run intervals on, by default own scheduler is created
+        clock -- Function returning current time, replaced when replaying captures
+        config -- Function returning Config of tracked devices, default global config
+        network_mask -- Network to scan for devices, default from settings
+        iface -- Interface to capture and send ARP requests on, default from scapy
+        capture -- SharedCapture to attach to instead of opening own capture socket
+        probe_pool -- Executor to run probes on, by default own pool is created
+        capture_backend -- "raw" to capture with RawSocket, default from settings
+        stagger -- Fraction of interval first runs of jobs are delayed by, spreads jobs
+                   of many sites sharing scheduler and probe pool, default 0
         """
 
         self.handle_leave = callback_leave
         self.handle_join = callback_join
-        self._devices_online = set()
+        self._clock = clock
+        self._config = config
+        self._network_mask = network_mask
+        self._iface = iface
+        self._capture = capture
+        self._capture_backend = capture_backend
+        self._bluetooth = bluetooth or default_backend()
+        self.presence = PresenceStore()
         self._discovered_hosts = set()
-        self._stop_sniff = threading.Event()
+        self._cadence = {}  # Probe cadence by WiFi mac address
+        self._store = store
+        self._capture_active = threading.Event()
+        self._capture_active.set()
+        self._capture_wakeup = os.pipe()
+        self._capture_stats = {"packets": 0, "drops": 0, "heartbeats": 0,
+                               "probes_skipped": 0}
+        self._capture_rate = (time.monotonic(), 0)
+        self._bpf_filter = (None, None)
+        self._probe_pool = probe_pool or ThreadPoolExecutor(max_workers=PROBE_WORKERS,
+                                                            thread_name_prefix="probe")
+        self._register_metrics()
+
+        # A lock to prevent multiple ping calls at the same time
+        self._ping_lock = threading.Lock()
+        self._restore()
+
         if track:
             log.info("Tracking active")
 
-            # A lock to prevent multiple ping calls at the same time
-            self._ping_running = False
-
-            schedule.every(SCAN_INTERVAL).minutes.do(self.ping_devices_online)
-            schedule.every(SCAN_INTERVAL*2).minutes.do(self.scan_devices_bluetooth)
+            self._scheduler = scheduler or Scheduler()
+            for interval, func in [(PROBE_TICK, self.ping_devices_online),
+                                   (SCAN_INTERVAL * 120, self.scan_devices_bluetooth),
+                                   (CAPTURE_STATS_INTERVAL, self._log_capture_stats)]:
+                self._scheduler.every(interval, func, delay=interval * (1 + stagger))
             if PING_SCHEDULE:
-                schedule.every(1).hours.do(self.scan_devices)
+                self._scheduler.every(3600, self.scan_devices, delay=3600 * (1 + stagger))
+            if config is get_config:
+                on_reload(self.reload_filter)
 
-            self._scheduler = threading.Thread(target=self._run_schedule).start()
-            self._sniff = threading.Thread(target=self._run_sniff).start()
-            self.scan_devices()
+            if capture:
+                capture.attach(self)
+            else:
+                threading.Thread(target=self._run_sniff).start()
+            threading.Thread(target=self._warm_start).start()
 
-    def scan_devices(self, ip=NETWORK_MASK):
+    def scan_devices(self, ip=None):
         """
-        Scan all devices in network. By default network mask from settings is used, but
-        can be overridden from arguments. Found devices are handled as normal packets in
+        Scan all devices in network. By default network mask given to constructor is
+        used, but can be overridden from arguments.
+
+        Hosts are swept with ARP requests in rate limited batches, previously discovered
+        hosts first. ARP replies from tracked devices are handled as normal packets in
         handle packet method.
         """
-        def ping(host):
-            log.debug(f"Ping host {host}")
-            subprocess.call(["ping", "-c", "1", str(host)], shell=False,
-                            stdout=subprocess.DEVNULL)
-
         if self._all_devices_online():
             return
 
-        log.debug("Staring ping")
-        for host in self._discovered_hosts:
-            ping(host)
+        log.debug("Starting ARP sweep")
+        tracked = self._config().device_set
+        hosts = self._get_sweep_hosts(ip or self._network_mask)
+        while True:
+            batch = list(islice(hosts, SWEEP_BATCH_SIZE))
+            if not batch:
+                break
+
+            requests = [Ether(dst="ff:ff:ff:ff:ff:ff")/ARP(pdst=host) for host in batch]
+            ans, unans = srp(requests, timeout=SWEEP_TIMEOUT, inter=SWEEP_INTERVAL,
+                             iface=self._iface, verbose=False)
+            for sent, received in ans:
+                if received[Ether].src.lower() in tracked:
+                    self.handle_packet(received)
+            if self._all_devices_online():
+                break
+        log.debug("ARP sweep done")
 
-        subnetmask_hosts = [host for host in ipaddress.ip_network(ip).hosts()]
-        for host in subnetmask_hosts:
-            ping(host)
+    def _get_sweep_hosts(self, ip):
+        """
+        Return generator of host addresses to sweep. Discovered hosts are yielded first
+        and rest of the hosts are generated lazily from given network.
+        """
+        known = set(self._discovered_hosts)
+        subnetmask_hosts = (str(host) for host in ipaddress.ip_network(ip).hosts())
+        return chain(known, (host for host in subnetmask_hosts if host not in known))
 
     def scan_devices_bluetooth(self):
-        """ Ping all bluetooth devices, even those which are offline """
-        if self._ping_running:
+        """
+        Ping all bluetooth devices, even those which are offline. Resident found by the
+        scan has arrived and triggers join callback function like a captured packet.
+        """
+        if not self._ping_lock.acquire(blocking=False):
             return False
-
-        self._ping_running = True
-        for device in DEVICES():
-            address = self._resolve_bt_mac(device)
-            if self._ping_device_bluetooth(address):
-                self._devices_online.add((address))
-        self._ping_running = False
-
-    def ping_devices_online(self):
+        try:
+            self._scan_bluetooth()
+        finally:
+            self._ping_lock.release()
+
+    def _scan_bluetooth(self):
+        residents = []
+        for mac in self._config().devices:
+            bluetooth_mac = self._resolve_bt_mac(mac)
+            if bluetooth_mac and not self.presence.is_present(mac):
+                residents.append(Resident(mac, None, bluetooth_mac, {}, ABSENT))
+        for mac in self._probe_devices(residents):
+            _, previous = self.presence.mark_present(
+                mac, "bluetooth", bluetooth_mac=self._resolve_bt_mac(mac),
+                now=self._clock())
+            if previous and previous.present:
+                continue
+            log.info(f"new tracked device joined {mac}, detected from bluetooth")
+            trace = TRACER.start(ARRIVE_TRACE)
+            trace.attributes.update(mac=mac, signal="bluetooth")
+            with TRACER.activate(trace):
+                self.handle_join()
+        self._save()
+
+    def ping_devices_online(self, now=None):
         """
-        Ping all devices in devices_online. Return True if device is responding, otherwise
-        False and remove device from devices_online set. If all devices are removed from
-        set, trigger handle_leave callback function
+        Ping residents at home which are due to be probed. Each resident has its own
+        probe cadence: probe interval is backed off while resident responds and a
+        resident not responding becomes suspect and is probed more often. Suspect is
+        marked absent after leave misses failed passes and leave grace period. If all
+        residents are absent, trigger handle_leave callback function.
+
+        When heartbeat is enabled, residents seen within heartbeat window are not pinged,
+        their own traffic captured from network tells they are still present. Residents
+        without address or Bluetooth mac to probe are unknown, not missing, and they are
+        checked again after suspect interval while capture waits for their address.
+        Unknown resident silent longer than heartbeat window, or leave misses suspect
+        intervals without heartbeat, is counted as a miss so it can leave.
         """
-        if not self._devices_online or self._ping_running:
+        start = time.monotonic()
+        now = self._clock() if now is None else now
+        residents = [resident for resident in self.presence.present()
+                     if self._get_cadence(resident).next_probe <= now]
+        if not residents or not self._ping_lock.acquire(blocking=False):
             return False
+        try:
+            self._ping_pass(residents, now, start)
+        finally:
+            self._ping_lock.release()
+
+    def _ping_pass(self, residents, now, start):
+        """ Probe given residents due to be probed and update their presence """
+        if HEARTBEAT_WINDOW:
+            silent = [resident for resident in residents
+                      if resident.last_traffic < now - HEARTBEAT_WINDOW]
+            for resident in residents:
+                if resident not in silent:
+                    cadence = self._get_cadence(resident)
+                    self._cadence[resident.wifi_mac] = cadence._replace(
+                        next_probe=now + cadence.interval)
+            self._capture_stats["probes_skipped"] += len(residents) - len(silent)
+            residents = silent
+        unknown = [resident for resident in residents if not self._get_probes(resident)]
+        silent_limit = HEARTBEAT_WINDOW or SUSPECT_INTERVAL * LEAVE_MISSES
+        for resident in unknown:
+            if resident.last_traffic < now - silent_limit:
+                log.debug(f"No address to probe {resident.wifi_mac}, silent too long")
+                self._update_cadence(resident, False, now)
+                continue
+            log.debug(f"No address to probe {resident.wifi_mac}, waiting for traffic")
+            self._cadence[resident.wifi_mac] = self._get_cadence(resident)._replace(
+                next_probe=now + SUSPECT_INTERVAL)
+            self._capture_active.set()
+        residents = [resident for resident in residents if resident not in unknown]
+        not_started = set()
+        responding = self._probe_devices(residents, not_started=not_started)
+        for resident in residents:
+            if resident.wifi_mac in not_started:
+                log.debug(f"Probes of {resident.wifi_mac} did not start, rescheduling")
+                self._cadence[resident.wifi_mac] = self._get_cadence(resident)._replace(
+                    next_probe=now + PROBE_TICK)
+                continue
+            self._update_cadence(resident, resident.wifi_mac in responding, now)
+
+        if not self.presence.present():
+            log.info("All devices offline")
+            trace = TRACER.start(LEAVE_TRACE, start)
+            trace.attributes["probed"] = len(residents)
+            trace.add_span("probe_pass", start, time.monotonic())
+            with TRACER.activate(trace):
+                self.handle_leave()
+        self._save()
+
+    def _get_cadence(self, resident):
+        """ Return probe cadence of resident, first probe is scan interval after seen """
+        cadence = self._cadence.get(resident.wifi_mac)
+        if cadence is None:
+            interval = SCAN_INTERVAL * 60
+            cadence = ProbeCadence(interval, resident.last_seen + interval, 0)
+        return cadence
+
+    def _update_cadence(self, resident, responded, now):
+        """ Move resident between present, suspect and absent after a probe pass """
+        mac = resident.wifi_mac
+        cadence = self._get_cadence(resident)
+        if responded:
+            interval = SCAN_INTERVAL * 60
+            if resident.state == PRESENT and not cadence.misses:
+                interval = min(cadence.interval * PROBE_BACKOFF,
+                               interval * PROBE_MAX_INTERVAL)
+            self.presence.mark_present(mac, "probe", now=now)
+            self._cadence[mac] = ProbeCadence(interval, now + interval, 0)
+            return
 
-        self._ping_running = True
-        for device in self._devices_online.copy():
-            if len(device) == 1:  # Device has only bt mac address
-                if self._ping_device_bluetooth(device):
-                    continue
-            else:
-                if self._ping_device(device[0]) or self._ping_device_bluetooth(device[1]):
-                    continue
+        misses = cadence.misses + 1 if resident.state == SUSPECT else 1
+        if misses >= LEAVE_MISSES and now - resident.last_seen >= LEAVE_GRACE:
+            if self.presence.mark_absent(mac, unseen_since=resident.last_seen):
+                log.info(f"Lost device {mac}")
+                self._cadence.pop(mac, None)
+                self._capture_active.set()
+            return
 
-            log.info(f"Lost device {device}")
-            self._devices_online.remove(device)
-            self._stop_sniff.clear()
+        if self.presence.mark_suspect(mac, unseen_since=resident.last_seen):
+            log.info(f"Device {mac} not responding, {misses}/{LEAVE_MISSES} misses")
+            self._cadence[mac] = ProbeCadence(SUSPECT_INTERVAL, now + SUSPECT_INTERVAL,
+                                              misses)
 
-        if not self._devices_online:
-            log.info("All devices offline")
-            self.handle_leave()
-        self._ping_running = False
+    def _probe_devices(self, residents, deadline=PROBE_DEADLINE, not_started=None):
+        """
+        Probe given residents concurrently with all available methods and return set of
+        WiFi mac addresses of residents responding to any of them. When a resident
+        responds, rest of its probes are cancelled. Probes still running after the
+        deadline are cancelled and their residents are considered not responding.
+
+        Probes waiting for a worker of busy shared pool at the deadline are never run.
+        WiFi mac addresses of residents none of whose probes started are added to given
+        not started set, those residents were not probed at all.
+        """
+        start = time.perf_counter()
+        cancel = {resident.wifi_mac: threading.Event() for resident in residents}
+        probes = {}
+        for resident in residents:
+            device = resident.wifi_mac
+            for probe, address in self._get_probes(resident):
+                future = self._probe_pool.submit(self._run_probe, probe, address,
+                                                 cancel[device])
+                probes[future] = device
+
+        responding = set()
+        pending = set(probes)
+        end = time.monotonic() + deadline
+        while pending:
+            done, pending = wait(pending, timeout=max(end - time.monotonic(), 0),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                log.debug(f"Probe deadline of {deadline}s exceeded")
+                break
+
+            for future in done:
+                device = probes[future]
+                if future.cancelled() or device in responding:
+                    continue
+                if future.exception():
+                    log.debug(f"Probe failed for {device}, {future.exception()}")
+                elif future.result():
+                    responding.add(device)
+                    cancel[device].set()
+            cancelled = {future for future in pending if cancel[probes[future]].is_set()}
+            for future in cancelled:
+                future.cancel()
+            pending -= cancelled
+
+        for event in cancel.values():
+            event.set()
+        unstarted = {probes[future] for future in pending if future.cancel()}
+        started = {probes[future] for future in probes if not future.cancelled()}
+        if not_started is not None:
+            not_started.update(unstarted - started - responding)
+        PROBE_PASS_SECONDS.observe(time.perf_counter() - start)
+        return responding
+
+    def _run_probe(self, probe, address, cancel):
+        """ Run given probe and record its duration and result by probe method """
+        method = getattr(probe, "__name__", "probe").replace("_probe_", "")
+        start = time.perf_counter()
+        try:
+            result = probe(address, cancel)
+        except Exception:
+            PROBES.labels(method, "error").inc()
+            raise
+        finally:
+            PROBE_SECONDS.labels(method).observe(time.perf_counter() - start)
+        if result:
+            PROBES.labels(method, "up").inc()
+        else:
+            PROBES.labels(method, "cancelled" if cancel.is_set() else "down").inc()
+        return result
+
+    def _get_probes(self, resident):
+        """
+        Return list of (probe, address) tuples to check is given resident present. IP
+        probes are used when address of resident is known and Bluetooth probe when
+        Bluetooth mac address is known or given in settings.
+        """
+        probes = []
+        if resident.ip:
+            probes = [(self._probe_arp, resident.ip), (self._probe_icmp, resident.ip),
+                      (self._probe_tcp, resident.ip)]
+        bluetooth_mac = resident.bluetooth_mac or self._resolve_bt_mac(resident.wifi_mac)
+        if bluetooth_mac:
+            probes.append((self._probe_bluetooth, bluetooth_mac))
+        return probes
 
     def handle_packet(self, packet):
         """
-        Handle detected packet. If source of packet is not present in devices online,
-        trigger join callback function.
+        Handle detected packet. If source of packet is not present, mark it present and
+        trigger join callback function. If packet tells address of a resident already
+        present, address of resident is updated. IP packets from known address of a
+        resident present are heartbeats, which are recorded at most once per heartbeat
+        resolution.
 
         Note: packets must be filtered with _get_BPF_filter() before handling
         """
 
-        if IP not in packet or Ether not in packet:
+        if Ether not in packet:
             return
 
+        start = time.monotonic()
+        now = self._clock()
         client_mac = str(packet[Ether].src)
-        client_ip = str(packet[IP].src)
-        log.debug(f'Packet: {client_ip}, {client_mac}')
-        if not self._is_device_online(client_mac) and client_ip != "0.0.0.0":
-            device = (client_ip, client_mac)
-            log.info(f"new tracked device joined {device}")
-            self._devices_online.add(device)
+        resident = self.presence.get(client_mac)
+        if (resident and resident.present and IP in packet
+                and packet[IP].src == resident.ip
+                and now - resident.last_traffic < HEARTBEAT_RESOLUTION):
+            self._capture_stats["heartbeats"] += 1
+            return
+
+        signal, client_ip = self._classify_packet(packet)
+        if not signal:
+            return
+
+        log.debug(f'Packet: {signal}, {client_ip}, {client_mac}')
+        resident, previous = self.presence.mark_present(client_mac, signal, ip=client_ip,
+                                                        now=now)
+        if client_ip:
             self._discovered_hosts.add(client_ip)
+        if previous and previous.present:
+            if resident.ip != previous.ip:
+                log.debug(f"Learned address {client_ip} for {client_mac}")
+                self._save()
+                self._pause_capture()
+            return
+
+        log.info(f"new tracked device joined {client_ip}, {client_mac}, "
+                 f"detected from {signal}")
+        trace = TRACER.start(ARRIVE_TRACE, start)
+        trace.attributes.update(mac=client_mac, signal=signal)
+        delay = now - float(packet.time)
+        if 0 <= delay < CAPTURE_MAX_DELAY:
+            trace.add_span("capture", start - delay, start)
+        trace.add_span("handle_packet", start, time.monotonic())
+        with TRACER.activate(trace):
             self.handle_join()
-            if self._all_devices_online():
-                self._stop_sniff.set()
+        self._save()
+        self._pause_capture()
+
+    def _classify_packet(self, packet):
+        """
+        Return tuple of arrival signal type and IPv4 address of packet source. Address
+        is None if it is not known yet and signal is None if packet is not used for
+        detecting devices.
+
+        Earliest frames sent by a device joining to network are handled as fast path:
+            - DHCP discover and request, address is requested address if any
+            - ARP probe, announcement or reply, address of probe is the probed address
+            - IPv6 neighbor solicitation, address is not known
+        """
+        if DHCP in packet:
+            options = dict(option for option in packet[DHCP].options
+                           if isinstance(option, tuple) and len(option) == 2)
+            if options.get("message-type") not in (DHCP_DISCOVER, DHCP_REQUEST):
+                return None, None
+            requested = options.get("requested_addr")
+            if not requested and packet[IP].src != "0.0.0.0":
+                requested = packet[IP].src
+            return "dhcp", requested and str(requested)
+
+        if ARP in packet:
+            arp = packet[ARP]
+            if arp.psrc == "0.0.0.0":
+                return "arp", str(arp.pdst)
+            return "arp", str(arp.psrc)
+
+        if ICMPv6ND_NS in packet:
+            return "ndp", None
+
+        if IP in packet and packet[IP].src != "0.0.0.0":
+            return "ip", str(packet[IP].src)
+        return None, None
+
+    def _probe_bluetooth(self, bluetooth_mac, cancel):
+        """ Ping given Bluetooth mac address with Bluetooth backend until it responds """
+        if self._probe(lambda: self._bluetooth.ping(bluetooth_mac), cancel):
+            log.debug(f"Host {bluetooth_mac} is up, responding to bluetooth")
+            return True
+        return False
 
-    def _ping_device_bluetooth(self, device, tries=MAX_PING_TRIES):
+    def _warm_start(self):
+        """
+        Verify devices restored from snapshot with a ping pass and scan network for the
+        rest of devices. Run in own thread, so restored state is usable immediately.
         """
-        Ping Bluetooth device
+        if self.presence.present():
+            self.ping_devices_online()
+        self.scan_devices()
+
+    def _restore(self):
+        """ Restore residents present and discovered hosts from snapshot """
+        data = self._store.get("network") if self._store else None
+        if not data:
+            return
+
+        oldest = self._clock() - SNAPSHOT_MAX_AGE
+        wifi_by_bluetooth = self._config().wifi_by_bluetooth
+        for entry in data.get("devices", []):
+            mac = entry.get("mac") or wifi_by_bluetooth.get(entry.get("bluetooth"))
+            if entry["last_seen"] < oldest or not mac:
+                continue
+            seen = entry.get("seen") or {"snapshot": entry["last_seen"]}
+            self.presence.restore(Resident(mac, entry.get("ip"), entry.get("bluetooth"),
+                                           seen, PRESENT))
+        self._discovered_hosts.update(data.get("hosts", []))
+        log.info(f"Restored {len(self.presence.present())} devices online from snapshot")
+        if self.presence.present():
+            self._pause_capture()
+
+    def _save(self):
+        """ Save residents present and discovered hosts to snapshot """
+        if not self._store:
+            return
 
-        Core arguments:
-        device -- Device as wifi mac, bluetooth mac is resolved from settings
+        devices = [{
+            "mac": resident.wifi_mac,
+            "ip": resident.ip,
+            "bluetooth": resident.bluetooth_mac,
+            "seen": resident.seen,
+            "last_seen": resident.last_seen,
+        } for resident in self.presence.present()]
+        self._store.update("network", {
+            "devices": devices,
+            "hosts": sorted(self._discovered_hosts),
+        })
+
+    def reload_filter(self):
+        """ Wake up capture to rebuild BPF filter and socket after config change """
+        if self._capture:
+            self._capture.reload()
+        else:
+            os.write(self._capture_wakeup[1], b"\0")
+
+    def _register_metrics(self):
+        """ Expose capture counters and residents, read when metrics are collected """
+        stats = self._capture_stats
+        REGISTRY.counter("capture_packets_total", "Packets dissected from capture",
+                         function=lambda: stats["packets"])
+        REGISTRY.counter("capture_drops_total", "Packets dropped by kernel",
+                         function=lambda: stats["drops"])
+        REGISTRY.counter("capture_heartbeats_total",
+                         "Packets of residents present recorded as heartbeat",
+                         function=lambda: stats["heartbeats"])
+        REGISTRY.counter("probes_skipped_total",
+                         "Residents not probed as they were seen within heartbeat window",
+                         function=lambda: stats["probes_skipped"])
+        REGISTRY.gauge("capture_active", "1 if captured packets are handled",
+                       function=lambda: int(self._capture_active.is_set()))
+        REGISTRY.gauge("residents_present", "Residents at home, present or suspect",
+                       function=lambda: len(self.presence.present()))
+
+    @property
+    def config(self):
+        """ Current Config of tracked devices """
+        return self._config()
+
+    @property
+    def capture_active(self):
+        """ True if captured packets are handled """
+        return self._capture_active.is_set()
+
+    def handle_captured(self, packet):
+        """ Count and handle packet or raw frame from capture socket """
+        self._capture_stats["packets"] += 1
+        if isinstance(packet, memoryview):
+            self.handle_frame(packet)
+        else:
+            self.handle_packet(packet)
+
+    def handle_frame(self, frame):
         """
-        bluetooth_mac = self._resolve_bt_mac(device)
-        if not bluetooth_mac:
-            return False
+        Handle raw Ethernet frame from RawSocket. Heartbeats of residents present are
+        recognized from header bytes without dissecting the frame, other frames of
+        tracked devices are dissected with scapy and handled like captured packets.
+        """
+        client_mac = frame_source(frame)
+        resident = self.presence.get(client_mac)
+        if resident and resident.present and resident.ip:
+            source = frame_ipv4_source(frame)
+            if (source is not None and source == packed_address(resident.ip)
+                    and self._clock() - resident.last_traffic < HEARTBEAT_RESOLUTION):
+                self._capture_stats["heartbeats"] += 1
+                return
+        if client_mac in self._config().device_set:
+            self.handle_packet(Ether(frame.tobytes()))
+
+    def _pause_capture(self):
+        """
+        Pause capture when all residents are home, unless heartbeat is enabled. Capture
+        continues until IPv4 address of every resident is known, as address is needed
+        for probing and it is learned only from captured packets.
+        """
+        if (not HEARTBEAT_WINDOW and self._all_devices_online()
+                and all(resident.ip for resident in self.presence.present())):
+            self._capture_active.clear()
 
-        for _ in range(tries):
-            p = Popen(["l2ping", "-c", "5", "-t", "2", str(bluetooth_mac)], stdout=PIPE,
-                      stderr=PIPE, close_fds=True)
-            p.communicate()
+    def capture_stats(self):
+        """
+        Return dictionary of capture counters: packets handled, packets dropped by kernel,
+        heartbeat packets, residents not probed due to heartbeat and packets per second
+        since previous call.
+        """
+        now, packets = time.monotonic(), self._capture_stats["packets"]
+        previous, previous_packets = self._capture_rate
+        self._capture_rate = (now, packets)
+        rate = (packets - previous_packets) / (now - previous) if now > previous else 0
+        return dict(self._capture_stats, rate=rate)
 
-            if p.returncode == 0:
-                log.debug(f"Host {bluetooth_mac} is up, responding to bluetooth")
-                return True
+    def counters(self):
+        """ Return copy of capture counters, without updating rate like capture_stats """
+        return dict(self._capture_stats)
 
-        return False
+    def _log_capture_stats(self):
+        log.debug(f"Capture: {self.capture_stats()}")
 
     def _run_sniff(self):
-        """ Run scapy network sniff with BPF filter """
+        """
+        Run persistent packet capture with BPF filter. Capture socket is kept open and it
+        is reopened only when filter changes. Without heartbeat, handling packets is
+        paused while all devices are online and resumed immediately when capture event
+        is set again.
+        """
+        sock, sock_filter = None, None
         while True:
-            if not self._stop_sniff.isSet():
-                log.debug("Sniffing started")
-                sniff(filter=self._get_BPF_filter(), prn=self.handle_packet, store=False,
-                      stop_filter=self._should_stop_sniff)
-                log.debug("Sniffing stopped")
-            time.sleep(60)
+            self._capture_active.wait()
+            bpf_filter = self._get_BPF_filter()
+            if sock is None or sock_filter != bpf_filter:
+                if sock is not None:
+                    sock.close()
+                sock = self._open_capture(bpf_filter)
+                sock_filter = bpf_filter
+                log.debug("Capture socket opened")
+            else:
+                self._drain_capture(sock)
 
-    def _should_stop_sniff(self, packet):
-        return self._stop_sniff.isSet()
+            log.debug("Capture resumed")
+            try:
+                self._capture_packets(sock, bpf_filter)
+            except OSError as e:
+                log.error(f"Capture failed: {e}")
+                sock.close()
+                sock = None
+                time.sleep(1)
+            log.debug("Capture paused")
+
+    def _open_capture(self, bpf_filter):
+        """ Return capture socket of configured backend for tracked devices """
+        if self._capture_backend == RAW_BACKEND:
+            return RawSocket(self._config().devices, iface=self._iface)
+        return conf.L2listen(iface=self._iface, filter=bpf_filter)
+
+    def _capture_packets(self, sock, bpf_filter):
+        """ Handle packets from socket until capture is paused or BPF filter changes """
+        wakeup = self._capture_wakeup[0]
+        while self._capture_active.is_set():
+            ready, _, _ = select([sock, wakeup], [], [])
+            if wakeup in ready:
+                os.read(wakeup, 1024)
+                if self._get_BPF_filter() != bpf_filter:
+                    return
+                continue
+
+            packet = sock.recv()
+            if packet is None:
+                continue
+            self.handle_captured(packet)
+        self._update_drops(sock)
+
+    def _drain_capture(self, sock):
+        """ Discard packets buffered in socket while capture was paused """
+        for _ in range(DRAIN_LIMIT):
+            if not select([sock], [], [], 0)[0]:
+                break
+            sock.recv()
+        self._update_drops(sock)
+
+    def _update_drops(self, sock):
+        """ Add packets dropped by kernel to capture counters, Linux only """
+        try:
+            stats = sock.ins.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8)
+        except (AttributeError, OSError):
+            return
+        self._capture_stats["drops"] += struct.unpack("II", stats)[1]
 
-    def _ping_device(self, device):
+    def _probe(self, ping, cancel, tries=MAX_PING_TRIES):
         """
-        Ping given device with multiple different methods on network layer. If device is
-        responding return True, otherwise False.
-
-        Ping is done with following steps:
-            1. Ping with ARP packet
-            2. Ping ICMP echo packet
-            3. Ping with TCP packets to ports 5353 and 62078.
-               (Used in iPhone for Bonjour service and wifi-sync)
-
-        Core arguments:
-            device -- Device ip address as string, for example '192.168.1.101'
-        Returns:
-            boolean --- If device is responding
+        Run given ping function until it returns True, tries run out or the probe is
+        cancelled. Cancel event is checked before each try.
         """
+        for _ in range(tries):
+            if cancel.is_set():
+                return False
+            if ping():
+                return True
+        return False
 
-        if not device:
-            return False
-
-        ans, unans = srp(Ether(dst="ff:ff:ff:ff:ff:ff")/ARP(pdst=device), retry=5,
-                         timeout=2, verbose=False)
-        if ans:
+    def _probe_arp(self, device, cancel):
+        """ Ping device with ARP packet. Device is ip address as string """
+        packet = Ether(dst="ff:ff:ff:ff:ff:ff")/ARP(pdst=device)
+        if self._probe(lambda: srp(packet, timeout=2, iface=self._iface,
+                                   verbose=False)[0], cancel):
             log.debug(f"Host {device} is up, responding to ARP")
             return True
+        return False
 
-        ans = sr1(IP(dst=device)/ICMP(), retry=5, timeout=2, verbose=False)
-        if ans:
+    def _probe_icmp(self, device, cancel):
+        """ Ping device with ICMP echo packet. Device is ip address as string """
+        packet = IP(dst=device)/ICMP()
+        if self._probe(lambda: sr1(packet, timeout=2, verbose=False), cancel):
             log.debug(f"Host {device} is up, responding to ICMP Echo")
             return True
+        return False
 
-        ans = sr1(IP(dst=device)/TCP(dport=[5353, 62078]), retry=5, timeout=1,
-                  verbose=False)
-        if ans:
-            log.debug(f"Host {device} is up, responding to ICP port 62078")
-        return bool(ans)
+    def _probe_tcp(self, device, cancel):
+        """
+        Ping device with TCP packets to ports 5353 and 62078. (Used in iPhone for Bonjour
+        service and wifi-sync). Device is ip address as string
+        """
+        packet = IP(dst=device)/TCP(dport=[5353, 62078])
+        if self._probe(lambda: sr1(packet, timeout=1, verbose=False), cancel):
+            log.debug(f"Host {device} is up, responding to TCP port 62078")
+            return True
+        return False
 
     def _get_BPF_filter(self):
         """
-        Return BPF filter to be used with scapy sniff(). Filter matches all packets with
-        source mac in tracked devices given in settings.
+        Return BPF filter to be used with capture socket. Filter matches all packets with
+        source mac in tracked devices given in settings. Filter is built again only when
+        tracked devices change.
         """
-
-        output = ""
-        for i in range(len(DEVICES())):
-            mac_address = DEVICES()[i]
-            output += f"ether src host {mac_address}"
-            if i < len(DEVICES()) - 1:
-                output += " or "
-        return output
+        devices = self._config().devices
+        if self._bpf_filter[0] != devices:
+            output = " or ".join(f"ether src host {mac}" for mac in devices)
+            self._bpf_filter = (devices, output)
+        return self._bpf_filter[1]
 
     def _resolve_bt_mac(self, wifi_mac):
-        try:
-            return BLUETOOTH_DEVICES()[wifi_mac]
-        except KeyError:
-            return None
-
-    def _run_schedule(self):
-        """
-        Start loop for scheduler. This should be run at own thread to prevent blocking
-        """
-        while True:
-            try:
-                while True:
-                    schedule.run_pending()
-                    time.sleep(5)
-            except Exception as e:
-                log.error(f"Scheduler failed: {e}")
+        return self._config().bluetooth_devices.get(wifi_mac)
 
     def _all_devices_online(self):
         """ Return True if all residents are currently at home """
-        return len(DEVICES()) == len(self._devices_online)
-
-    def _is_device_online(self, mac_address):
-        """ Check is device online based on WiFi mac address """
-        return any(mac == mac_address for ip, mac in self._devices_online)
+        return all(self.presence.is_present(mac) for mac in self._config().devices)
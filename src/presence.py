@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import namedtuple
+
+PRESENT = "present"
+SUSPECT = "suspect"  # Still counted as present, but not responding to probes
+ABSENT = "absent"
+PASSIVE_SIGNALS = ("ip", "arp", "dhcp", "ndp")  # Seen in own traffic of resident
+
+
+class Resident(namedtuple("Resident", ["wifi_mac", "ip", "bluetooth_mac", "seen",
+                                       "state"])):
+    """
+    Presence record of one resident. Seen is dictionary of signal name and timestamp
+    when resident was last seen with it. Records are never modified, they are replaced
+    with updated copies.
+    """
+    __slots__ = ()
+
+    @property
+    def last_seen(self):
+        return max(self.seen.values(), default=0)
+
+    @property
+    def last_traffic(self):
+        """ Last time resident was seen in its own traffic, probes are not counted """
+        return max((self.seen[signal] for signal in PASSIVE_SIGNALS
+                    if signal in self.seen), default=0)
+
+    @property
+    def present(self):
+        return self.state != ABSENT
+
+
+class PresenceStore(object):
+    """
+    Presence of residents keyed by WiFi mac address, with indexes to find a resident by
+    IP or Bluetooth mac address.
+
+    Reads are lock-free: records and indexes are published together as one tuple, which
+    is replaced atomically on each update, so reader always sees a consistent view.
+    Updates are serialized with a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._view = ({}, {}, {})  # Residents by WiFi mac, by IP and by Bluetooth mac
+
+    def get(self, identifier):
+        """ Return resident by WiFi mac, IP or Bluetooth mac address, None if unknown """
+        residents, by_ip, by_bluetooth = self._view
+        return (residents.get(identifier) or residents.get(by_ip.get(identifier))
+                or residents.get(by_bluetooth.get(identifier)))
+
+    def is_present(self, wifi_mac):
+        resident = self._view[0].get(wifi_mac)
+        return resident is not None and resident.present
+
+    def residents(self):
+        """ Return list of all known residents """
+        return list(self._view[0].values())
+
+    def present(self):
+        """ Return list of residents at home, either present or suspect """
+        return [resident for resident in self._view[0].values() if resident.present]
+
+    def mark_present(self, wifi_mac, signal, ip=None, bluetooth_mac=None, now=None):
+        """
+        Mark resident present, seen now with given signal. Address of resident is updated
+        if given. Returns tuple of updated and previous record, previous is None for a
+        new resident.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            previous = self._view[0].get(wifi_mac)
+            if previous:
+                resident = previous._replace(
+                    ip=ip or previous.ip,
+                    bluetooth_mac=bluetooth_mac or previous.bluetooth_mac,
+                    seen=dict(previous.seen, **{signal: now}),
+                    state=PRESENT)
+            else:
+                resident = Resident(wifi_mac, ip, bluetooth_mac, {signal: now}, PRESENT)
+            self._publish(resident)
+        return resident, previous
+
+    def mark_suspect(self, wifi_mac, unseen_since=None):
+        """
+        Mark resident suspect. If unseen since is given, resident is not changed if it
+        has been seen after it. Returns updated record or None if not changed.
+        """
+        return self._set_state(wifi_mac, SUSPECT, unseen_since)
+
+    def mark_absent(self, wifi_mac, unseen_since=None):
+        """
+        Mark resident absent. If unseen since is given, resident is not changed if it
+        has been seen after it. Returns updated record or None if not changed.
+        """
+        return self._set_state(wifi_mac, ABSENT, unseen_since)
+
+    def _set_state(self, wifi_mac, state, unseen_since):
+        with self._lock:
+            previous = self._view[0].get(wifi_mac)
+            if not previous:
+                return None
+            if unseen_since is not None and previous.last_seen > unseen_since:
+                return None
+            resident = previous._replace(state=state)
+            self._publish(resident)
+        return resident
+
+    def restore(self, resident):
+        """ Add resident record as is, used when restoring from snapshot """
+        with self._lock:
+            self._publish(resident)
+
+    def _publish(self, resident):
+        """ Publish new view with given record, must be called with lock held """
+        residents, by_ip, by_bluetooth = (dict(index) for index in self._view)
+        for index, key in ((by_ip, "ip"), (by_bluetooth, "bluetooth_mac")):
+            for address, wifi_mac in list(index.items()):
+                if wifi_mac == resident.wifi_mac and address != getattr(resident, key):
+                    del index[address]
+        residents[resident.wifi_mac] = resident
+        if resident.ip:
+            by_ip[resident.ip] = resident.wifi_mac
+        if resident.bluetooth_mac:
+            by_bluetooth[resident.bluetooth_mac] = resident.wifi_mac
+        self._view = (residents, by_ip, by_bluetooth)
@@ -0,0 +1,140 @@
+import ctypes
+import socket
+import struct
+from functools import lru_cache
+
+RAW_BACKEND = "raw"  # Value of CAPTURE_BACKEND setting enabling RawSocket
+ETH_P_ALL = 0x0003  # All protocols
+SO_ATTACH_FILTER = 26
+FRAME_BUFFER = 65536  # Bytes of buffer frames are received to, larger frames are cut
+MAX_FILTER_DEVICES = 64  # Jump offsets of classic BPF limit devices in one filter
+MAC_CACHE_SIZE = 1024  # Formatted mac addresses kept in cache
+ETHER_HEADER = 14
+IPV4_HEADER_END = 34  # Ethernet and minimal IPv4 header
+ETHERTYPE = slice(12, 14)
+SOURCE_MAC = slice(6, 12)
+IPV4_SOURCE = slice(26, 30)
+IPV4 = b"\x08\x00"
+
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_JEQ_K = 0x15
+BPF_RET_K = 0x06
+BPF_INSTRUCTION = struct.Struct("HBBI")  # Native struct sock_filter
+
+_mac_names = {}
+
+
+class RawSocket(object):
+    """
+    Linux AF_PACKET capture socket, which returns frames as memoryview without
+    dissecting them. Kernel BPF filter passes only frames from given mac addresses.
+    Frames are received to one reused buffer, returned frame is valid only until next
+    call of recv.
+    """
+
+    def __init__(self, devices, iface=None, sock=None):
+        """
+        Keyword arguments:
+        devices -- Mac addresses to capture frames from
+        iface -- Interface to capture on, by default all interfaces
+        sock -- Socket to read frames from instead of opening AF_PACKET socket
+        """
+        if sock is None:
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                 socket.htons(ETH_P_ALL))
+            if iface:
+                sock.bind((iface, 0))
+        attach_filter(sock, build_filter(devices))
+        self.ins = sock  # Same attribute as scapy sockets, used for kernel statistics
+        self._buffer = bytearray(FRAME_BUFFER)
+        self._view = memoryview(self._buffer)
+
+    def fileno(self):
+        return self.ins.fileno()
+
+    def recv(self):
+        """ Return next frame as memoryview """
+        return self._view[:self.ins.recv_into(self._buffer)]
+
+    def close(self):
+        self.ins.close()
+
+
+class FakeFrameSource(object):
+    """
+    Raw frames without network for tests and benchmarks. Frames sent to source are read
+    by RawSocket from a datagram socket pair, which has the same kernel BPF filter as
+    capture socket.
+    """
+
+    def __init__(self, devices):
+        self._writer, reader = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket = RawSocket(devices, sock=reader)
+
+    def send(self, frame):
+        self._writer.send(bytes(frame))
+
+    def close(self):
+        self._writer.close()
+        self.socket.close()
+
+
+def build_filter(devices, snaplen=FRAME_BUFFER):
+    """
+    Return classic BPF program as bytes, passing frames with source mac in given
+    devices. Source mac is compared as 32 bit low part and 16 bit high part, four
+    instructions for each device. If there are more devices than jump offsets can
+    reach, all frames are passed and devices must be filtered after receiving.
+    """
+    devices = list(devices)
+    if len(devices) > MAX_FILTER_DEVICES:
+        return BPF_INSTRUCTION.pack(BPF_RET_K, 0, 0, snaplen)
+
+    instructions = []
+    for i, mac in enumerate(devices):
+        high, low = struct.unpack("!HI", bytes.fromhex(mac.replace(":", "")))
+        accept = 4 * (len(devices) - i) - 3  # Offset to last instruction
+        instructions += [
+            (BPF_LD_W_ABS, 0, 0, 8),
+            (BPF_JEQ_K, 0, 2, low),
+            (BPF_LD_H_ABS, 0, 0, 6),
+            (BPF_JEQ_K, accept, 0, high),
+        ]
+    instructions += [(BPF_RET_K, 0, 0, 0), (BPF_RET_K, 0, 0, snaplen)]
+    return b"".join(BPF_INSTRUCTION.pack(*instruction) for instruction in instructions)
+
+
+def attach_filter(sock, program):
+    """ Attach BPF program to socket, kernel copies the program """
+    buffer = ctypes.create_string_buffer(program)
+    fprog = struct.pack("HL", len(program) // BPF_INSTRUCTION.size,
+                        ctypes.addressof(buffer))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def frame_source(frame):
+    """
+    Return source mac address of frame formatted like in scapy. Formatted addresses are
+    cached, so frames of tracked devices do not build new strings.
+    """
+    key = frame[SOURCE_MAC].tobytes()
+    name = _mac_names.get(key)
+    if name is None:
+        if len(_mac_names) >= MAC_CACHE_SIZE:
+            _mac_names.clear()
+        name = _mac_names[key] = ":".join(f"{byte:02x}" for byte in key)
+    return name
+
+
+def frame_ipv4_source(frame):
+    """ Return source address of IPv4 frame as memoryview, None for other frames """
+    if len(frame) >= IPV4_HEADER_END and frame[ETHERTYPE] == IPV4:
+        return frame[IPV4_SOURCE]
+    return None
+
+
+@lru_cache(maxsize=MAC_CACHE_SIZE)
+def packed_address(ip):
+    """ Return IPv4 address as 4 bytes, for comparing to address in frame """
+    return socket.inet_aton(ip)
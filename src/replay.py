@@ -0,0 +1,109 @@
+import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from scapy.all import Ether, PcapReader
+
+from src.bluetooth import FakeBluetoothBackend
+from src.network import PROBE_TICK, Network
+from src.settings import get_config
+
+ARRIVE = "arrive"
+LEAVE = "leave"
+CAPTURE_EXTENSIONS = (".pcap", ".pcapng", ".cap")
+log = logging.getLogger("main")
+
+Decision = namedtuple("Decision", ["timestamp", "action"])
+
+
+class ReplayClock(object):
+    """ Clock of replay, time is moved forward by timestamps of replayed packets """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class Replay(object):
+    """
+    Stream recorded captures through the same detection logic as live capture. Packets
+    are filtered by tracked devices like with BPF filter and handled with Network at
+    their recorded time. Probe passes are run on replay clock between packets, probes
+    never respond as captures contain no replies to them, so a resident leaves after it
+    has been silent long enough in the capture.
+
+    Arrive and leave decisions are collected with their timestamps.
+    """
+
+    def __init__(self, speed=0, tick=PROBE_TICK):
+        """
+        Keyword arguments:
+        speed -- Replay speed compared to recorded timing, 0 is as fast as possible
+        tick -- Seconds of replay time between probe passes
+        """
+        self.speed = speed
+        self.tick = tick
+        self.clock = ReplayClock()
+        self.decisions = []
+        self.packets = 0
+        self.handled = 0
+        self.network = Network(callback_leave=lambda: self._decide(LEAVE),
+                               callback_join=lambda: self._decide(ARRIVE), track=False,
+                               bluetooth=FakeBluetoothBackend(), clock=self.clock)
+        for probe in ["_probe_arp", "_probe_icmp", "_probe_tcp", "_probe_bluetooth"]:
+            setattr(self.network, probe, lambda address, cancel: False)
+        self._next_tick = None
+        self._started = None  # Tuple of wall clock and capture time of first packet
+
+    def run(self, paths):
+        """ Replay given capture files and directories, return list of decisions """
+        tracked = get_config().device_set
+        for packet in read_packets(paths):
+            self.packets += 1
+            self._advance(float(packet.time))
+            if Ether in packet and packet[Ether].src in tracked:
+                self.handled += 1
+                self.network.handle_packet(packet)
+        return self.decisions
+
+    def _advance(self, timestamp):
+        """ Move replay clock to given time, running probe passes due before it """
+        if self._started is None:
+            self._started = (time.monotonic(), timestamp)
+            self._next_tick = timestamp + self.tick
+        if self.speed:
+            wall, start = self._started
+            delay = (timestamp - start) / self.speed - (time.monotonic() - wall)
+            if delay > 0:
+                time.sleep(delay)
+
+        while self._next_tick <= timestamp:
+            self.clock.now = self._next_tick
+            self.network.ping_devices_online(now=self._next_tick)
+            self._next_tick += self.tick
+        self.clock.now = max(self.clock.now, timestamp)
+
+    def _decide(self, action):
+        decision = Decision(self.clock.now, action)
+        log.info(f"{datetime.fromtimestamp(decision.timestamp).isoformat()} {action}")
+        self.decisions.append(decision)
+
+
+def read_packets(paths):
+    """
+    Generate packets of given capture files one by one, without reading whole capture
+    to memory. Directories are replaced with capture files in them in name order.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                           if name.endswith(CAPTURE_EXTENSIONS))
+            yield from read_packets(files)
+            continue
+
+        with PcapReader(path) as reader:
+            yield from reader
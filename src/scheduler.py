@@ -0,0 +1,125 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+
+SCHEDULER_WORKERS = 4  # How many jobs can run at the same time
+log = logging.getLogger("main")
+
+
+class Job(object):
+    """ Function run periodically by Scheduler, with counters of its runs """
+
+    def __init__(self, func, interval, name=None):
+        self.func = func
+        self.interval = interval
+        self.name = name or getattr(func, "__name__", repr(func))
+        self.next_run = None
+        self.running = False
+        self.cancelled = False
+        self.runs = 0
+        self.skipped = 0
+        self.lag = None  # Seconds job started after its deadline on last run
+        self.duration = None  # Seconds last run took
+
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "lag": self.lag,
+            "duration": self.duration,
+        }
+
+
+class Scheduler(object):
+    """
+    Run jobs periodically on a bounded thread pool. Jobs are kept in a heap ordered by
+    their next deadline and scheduler thread sleeps until the earliest deadline, so there
+    is no polling. A job is never run concurrently with itself, if previous run has not
+    finished when job is due again, that run is skipped.
+    """
+
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self._heap = []
+        self._jobs = []
+        self._sequence = count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def every(self, interval, func, name=None, delay=None):
+        """
+        Run given function every interval seconds. First run is after delay seconds,
+        by default after one interval. Returns created job.
+        """
+        job = Job(func, interval, name)
+        with self._condition:
+            self._jobs.append(job)
+            self._push(job, time.monotonic() + (interval if delay is None else delay))
+        return job
+
+    def cancel(self, job):
+        with self._condition:
+            job.cancelled = True
+            self._jobs.remove(job)
+            self._condition.notify()
+
+    def shutdown(self):
+        """ Stop scheduler, jobs already running are finished """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._pool.shutdown(wait=False)
+
+    def stats(self):
+        """ Return dictionary of job names and their run statistics """
+        with self._condition:
+            return {job.name: job.stats() for job in self._jobs}
+
+    def _push(self, job, deadline):
+        job.next_run = deadline
+        heapq.heappush(self._heap, (deadline, next(self._sequence), job))
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                while not self._stopped and (not self._heap or self._heap[0][0] > now):
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._condition.wait(timeout=timeout)
+                    now = time.monotonic()
+                if self._stopped:
+                    return
+
+                deadline, _, job = heapq.heappop(self._heap)
+                if job.cancelled:
+                    continue
+                if job.running:
+                    job.skipped += 1
+                    log.debug(f"Job {job.name} still running, skipping run")
+                else:
+                    job.running = True
+                    self._pool.submit(self._execute, job, now - deadline)
+
+                # Missed deadlines are not caught up, next run is one interval from now
+                next_run = deadline + job.interval
+                self._push(job, next_run if next_run > now else now + job.interval)
+
+    def _execute(self, job, lag):
+        start = time.monotonic()
+        try:
+            job.func()
+        except Exception as e:
+            log.error(f"Job {job.name} failed: {e}")
+        finally:
+            with self._condition:
+                job.running = False
+                job.runs += 1
+                job.lag = lag
+                job.duration = time.monotonic() - start
+            log.debug(f"Job {job.name} done, lag {lag:.3f}s, took {job.duration:.3f}s")
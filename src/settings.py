@@ -1,38 +1,190 @@
+import ast
+import logging
 import os
 
 from dotenv import load
 
+ENV_FILE = ".env"
+
 if not os.getenv("TEST_RUN", False):
-    load()
+    load(ENV_FILE)
+
+log = logging.getLogger("main")
+_config = None
+_reload_callbacks = []
+
+
+class Config(object):
+    """
+    Tracked devices and lights parsed and validated once from environment. MAC
+    addresses are normalized to lower case and indexed for lookups in both directions.
+    Config is never modified after it is created, reloading replaces the whole object.
+    """
+
+    def __init__(self, environ):
+        self.devices = tuple(_normalize_mac(mac)
+                             for mac in environ.get("DEVICES", "").split(","))
+        self.device_set = frozenset(self.devices)
+
+        self.bluetooth_devices = {}
+        for device in environ.get("BLUETOOTH_DEVICES", "").split(","):
+            if not device:
+                continue
+            try:
+                wifi, bluetooth = device.split(";")
+            except ValueError:
+                raise ValueError(f"Invalid Bluetooth device {device}")
+            self.bluetooth_devices[_normalize_mac(wifi)] = _normalize_mac(bluetooth)
+        self.wifi_by_bluetooth = {bluetooth: wifi for wifi, bluetooth
+                                  in self.bluetooth_devices.items()}
+
+        self.arrive_lights = tuple(environ.get("ARRIVE_LIGHTS", "").split(","))
+        self.excluded_lights = frozenset(environ.get("EXCLUDE_LIGHTS", "").split(","))
+
+
+class SiteConfig(Config):
+    """
+    Config of one site in multi-site mode, read from own env file named by the site.
+    In addition to tracked devices and lights, site has own Hue bridge and network.
+    Values not given in site file, except tracked devices and lights, default to
+    values of main env file.
+    """
+
+    def __init__(self, path):
+        values = _read_env_file(path)
+        super().__init__(values)
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.bridge_ip = values.get("BRIDGE_IP")
+        if not self.bridge_ip:
+            raise ValueError(f"BRIDGE_IP not set for site {self.name}")
+        self.network_mask = values.get("NETWORK_MASK", NETWORK_MASK)
+        self.interface = values.get("INTERFACE")  # None is default interface of scapy
+        self.after_sunset_scene = values.get("AFTER_SUNSET", AFTER_SUNSET_SCENE)
+        self.snapshot_path = values.get("SNAPSHOT_PATH", f"{SNAPSHOT_PATH}-{self.name}")
+        self.phue_config = values.get("PHUE_CONFIG",
+                                      f"{os.getcwd()}/.phue_config-{self.name}")
+
+
+class ConfigWatcher(object):
+    """
+    Reload config when modification time of env file changes. By default global config
+    is reloaded, load function is called with path of env file and raises ValueError
+    if config is invalid.
+    """
+
+    def __init__(self, path=ENV_FILE, load=None):
+        self.path = path
+        self.load = load or reload_config
+        self._mtime = self._get_mtime()
+
+    def check(self):
+        """ Reload config if env file has changed, return True if reloaded """
+        mtime = self._get_mtime()
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        return self.reload()
+
+    def reload(self):
+        """ Reload config from env file, invalid config is logged and not used """
+        try:
+            self.load(self.path)
+        except ValueError as e:
+            log.error(f"Config {self.path} not reloaded: {e}")
+            return False
+        log.info(f"Config {self.path} reloaded")
+        return True
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+
+def get_config():
+    """ Return current config, parse it from environment on first call """
+    global _config
+    if _config is None:
+        _config = Config(os.environ)
+    return _config
+
+
+def reload_config(env_file=None):
+    """
+    Parse config again and replace current config with it. Values of given env file
+    override current environment. If config is invalid, ValueError is raised and
+    current config is kept. Callbacks registered with on_reload are called after
+    config is replaced.
+    """
+    global _config
+    values = _read_env_file(env_file) if env_file else {}
+    config = Config({**os.environ, **values})
+    os.environ.update(values)
+    _config = config
+    for callback in list(_reload_callbacks):
+        callback()
+    return config
+
+
+def load_sites(directory):
+    """ Return list of SiteConfig of env files in given directory in name order """
+    names = sorted(name for name in os.listdir(directory) if name.endswith(".env"))
+    if not names:
+        raise ValueError(f"No site env files in {directory}")
+    return [SiteConfig(os.path.join(directory, name)) for name in names]
+
+
+def on_reload(callback):
+    """ Register function to call when config is reloaded """
+    _reload_callbacks.append(callback)
+
+
+def _read_env_file(path):
+    """ Return dictionary of values in env file, same format as read by dotenv """
+    values = {}
+    try:
+        lines = open(path).read().splitlines()
+    except OSError:
+        return values
+
+    for line in lines:
+        line = line.strip()
+        if line.startswith("#") or "=" not in line:
+            continue
+        key, value = (part.strip() for part in line.split("=", 1))
+        if not key or not value:
+            continue
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        values[key.upper()] = str(value)
+    return values
+
+
+def _normalize_mac(mac):
+    mac = mac.strip().lower()
+    if len(mac) != 17:
+        raise ValueError(f"Invalid MAC address {mac}")
+    return mac
 
 
 def _get_devices():
-    device_list = os.getenv("DEVICES", "")
-    device_list = device_list.split(",")
-    if not all(len(device) == 17 for device in device_list):
-        raise ValueError("Invalid MAC address")
-    return device_list
+    return get_config().devices
 
 
 def _get_bluetooth_devices():
-    device_list = os.getenv("BLUETOOTH_DEVICES", "")
-    device_list = device_list.split(",")
-    wifi_addresses = []
-    bt_addresses = []
-    for device in device_list:
-        splitted = device.split(";")
-        wifi_addresses.append(splitted[0])
-        bt_addresses.append(splitted[1])
-
-    return {wifi: bt for wifi, bt in zip(wifi_addresses, bt_addresses)}
+    return get_config().bluetooth_devices
 
 
 def _get_arrive_lights():
-    return os.getenv("ARRIVE_LIGHTS", "").split(",")
+    return get_config().arrive_lights
 
 
 def _get_excluded_lights():
-    return os.getenv("EXCLUDE_LIGHTS", "").split(",")
+    return get_config().excluded_lights
 
 
 def _get_location():
@@ -43,7 +195,7 @@ def _get_location():
         return False
 
     try:
-        location = (int(float(lat)), int(float(lon)))
+        location = (float(lat), float(lon))
     except (ValueError):
         raise ValueError(f"Invalid location {lat}, {lon}")
     return location
@@ -55,7 +207,7 @@ def _get_log_level():
 
 
 LOG_LEVEL = _get_log_level
-SCAN_INTERVAL = os.getenv("SCAN_INTERVAL", 5)
+SCAN_INTERVAL = int(os.getenv("SCAN_INTERVAL", 5))  # Minutes
 DISABLE_START = os.getenv("DISABLE_START")  # Disable start hours
 if DISABLE_START:
     DISABLE_START = int(DISABLE_START)
@@ -64,6 +216,8 @@ if DISABLE_END:
     DISABLE_END = int(DISABLE_END)
 NETWORK_MASK = os.getenv("NETWORK_MASK", "192.168.1.0/24")
 BRIDGE_IP = os.getenv("BRIDGE_IP")
+BRIDGE_STATE_TTL = int(os.getenv("BRIDGE_STATE_TTL", 10))  # Seconds to cache bridge state
+EVENT_STREAM = os.getenv("EVENT_STREAM", False)  # Mirror state from bridge event stream
 DEVICES = _get_devices
 BLUETOOTH_DEVICES = _get_bluetooth_devices
 ARRIVE_LIGHTS = _get_arrive_lights
@@ -71,3 +225,13 @@ EXCLUDE_LIGHTS = _get_excluded_lights
 AFTER_SUNSET_SCENE = os.getenv("AFTER_SUNSET", None)
 LOCATION = _get_location
 PING_SCHEDULE = os.getenv('PING_SCHEDULE', False)
+HEARTBEAT_WINDOW = int(os.getenv("HEARTBEAT_WINDOW", 600))  # Seconds, 0 disables
+CAPTURE_BACKEND = os.getenv("CAPTURE_BACKEND", "scapy")  # "raw" skips scapy, Linux only
+LEAVE_MISSES = int(os.getenv("LEAVE_MISSES", 3))  # Failed probe passes before leaving
+LEAVE_GRACE = int(os.getenv("LEAVE_GRACE", 0))  # Seconds unseen before leaving
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9877))  # 0 disables metrics endpoint
+TRACE_SLOW = float(os.getenv("TRACE_SLOW", 2))  # Seconds after event is logged as slow
+TRACE_PROFILE = os.getenv("TRACE_PROFILE", False)  # Sample stacks of slow events
+SITES = os.getenv("SITES")  # Directory of site env files, enables multi-site mode
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", f"{os.getcwd()}/.snapshot")
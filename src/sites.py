@@ -0,0 +1,136 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from src.bluetooth import default_backend
+from src.capture import SharedCapture
+from src.dispatcher import ActionDispatcher
+from src.hue import Hue
+from src.metrics import REGISTRY
+from src.network import PROBE_WORKERS, Network
+from src.scheduler import SCHEDULER_WORKERS, Scheduler
+from src.settings import ConfigWatcher, SiteConfig
+from src.snapshot import SnapshotStore
+from src.sun import Sun
+
+SITE_PROBE_WORKERS = 2  # Probe workers added to shared pool for each site
+SITE_SCHEDULER_WORKERS = 2  # Scheduler workers for each site, probe passes take long
+log = logging.getLogger("main")
+
+
+class Site(object):
+    """
+    One home in multi-site mode with own Hue bridge, action dispatcher, snapshot and
+    presence of residents. Capture, probe pool, scheduler, Bluetooth backend and sun
+    times are shared with other sites of the runtime.
+    """
+
+    def __init__(self, config, runtime, track=True, stagger=0):
+        self.config = config
+        self.name = config.name
+        self.store = SnapshotStore(config.snapshot_path)
+        self.hue = Hue(store=self.store, scheduler=runtime.scheduler,
+                       bridge_ip=config.bridge_ip, config=self.get_config,
+                       sun=runtime.sun, scene=config.after_sunset_scene,
+                       config_path=config.phue_config)
+        self.dispatcher = ActionDispatcher(arrive=self.hue.set_arrive,
+                                           leave=self.hue.set_leave_home)
+        capture = runtime.get_capture(config.interface) if track else None
+        self.network = Network(callback_leave=self.dispatcher.leave,
+                               callback_join=self.dispatcher.arrive, track=track,
+                               bluetooth=runtime.bluetooth, store=self.store,
+                               scheduler=runtime.scheduler, config=self.get_config,
+                               network_mask=config.network_mask, iface=config.interface,
+                               capture=capture, probe_pool=runtime.probe_pool,
+                               stagger=stagger)
+        self.watcher = ConfigWatcher(config.path, load=self.reload)
+        log.info(f"Site {self.name} started")
+
+    def get_config(self):
+        return self.config
+
+    def reload(self, path):
+        """
+        Reload tracked devices and lights of site from given env file. Bridge and network
+        of a site are not changed without restart.
+        """
+        config = SiteConfig(path)
+        if (config.bridge_ip, config.network_mask, config.interface) != \
+                (self.config.bridge_ip, self.config.network_mask, self.config.interface):
+            log.warning(f"Bridge or network of site {self.name} changes after restart")
+        self.config = config
+        self.network.reload_filter()
+
+
+class MultiSite(object):
+    """
+    Runtime of many sites in one process. One capture socket is opened per interface
+    and shared by sites on it, probes of all sites run on one pool and periodic jobs on
+    one scheduler, so cost of a site is its devices and bridge instead of own threads
+    and sockets. First runs of jobs are staggered between sites, so probe passes of
+    all sites do not compete for the shared pool at the same time.
+    """
+
+    def __init__(self, configs, scheduler=None, bluetooth=None, track=True):
+        """
+        Keyword arguments:
+        configs -- List of SiteConfig, one per site
+        scheduler -- Scheduler shared by sites, by default own scheduler is created with
+                     workers for each site, so slow jobs of one site do not delay
+                     probe passes of others
+        bluetooth -- Bluetooth ping backend, by default resolved from platform
+        track -- Start capture and intervals of sites, default True
+        """
+        self.scheduler = scheduler or Scheduler(
+            workers=max(SCHEDULER_WORKERS, SITE_SCHEDULER_WORKERS * len(configs)))
+        self.bluetooth = bluetooth or default_backend()
+        self.sun = Sun(scheduler=self.scheduler)
+        workers = max(PROBE_WORKERS, SITE_PROBE_WORKERS * len(configs))
+        self.probe_pool = ThreadPoolExecutor(max_workers=workers,
+                                             thread_name_prefix="probe")
+        self.captures = {}  # SharedCapture by interface
+        self.sites = [Site(config, self, track=track, stagger=i / len(configs))
+                      for i, config in enumerate(configs)]
+        self._register_metrics()
+
+    def get_capture(self, iface):
+        """ Return capture of given interface, created on first use """
+        if iface not in self.captures:
+            self.captures[iface] = SharedCapture(iface)
+        return self.captures[iface]
+
+    def check(self):
+        """ Reload configs of sites whose env file has changed """
+        for site in self.sites:
+            site.watcher.check()
+
+    def reload(self):
+        """ Reload configs of all sites """
+        for site in self.sites:
+            site.watcher.reload()
+
+    def _register_metrics(self):
+        """ Replace metrics of last created site with metrics of all sites by site """
+        def by_site(value):
+            return lambda: {(site.name,): value(site) for site in self.sites}
+
+        for name, key in [("capture_packets_total", "packets"),
+                          ("capture_drops_total", "drops"),
+                          ("capture_heartbeats_total", "heartbeats"),
+                          ("probes_skipped_total", "probes_skipped")]:
+            metric = REGISTRY.get(name)
+            REGISTRY.counter(name, metric.documentation, ["site"],
+                             function=by_site(lambda site, key=key:
+                                              site.network.counters()[key]))
+        REGISTRY.gauge("capture_active", "1 if captured packets are handled", ["site"],
+                       function=by_site(lambda site: int(site.network.capture_active)))
+        REGISTRY.gauge("residents_present", "Residents at home, present or suspect",
+                       ["site"], function=by_site(
+                           lambda site: len(site.network.presence.present())))
+        REGISTRY.gauge("bridge_circuit_open", "1 if bridge is considered unreachable",
+                       ["site"], function=by_site(
+                           lambda site: int(site.hue.retry.breaker.is_open)))
+        REGISTRY.gauge("bridge_state_live", "1 if state of lights is mirrored live",
+                       ["site"], function=by_site(lambda site: int(site.hue.state.live)))
+        REGISTRY.gauge("action_queue_depth", "Arrive and leave actions waiting",
+                       ["site"], function=by_site(
+                           lambda site: site.dispatcher.queue_depth))
@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+SNAPSHOT_VERSION = 1
+log = logging.getLogger("main")
+
+
+class SnapshotStore(object):
+    """
+    Compact on-disk snapshot of state, used to warm start after restart. Snapshot is
+    divided into sections, which are updated separately by their owners. Whole file is
+    written atomically on each change, so a crash never leaves a partial snapshot.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = self._read()
+
+    def get(self, section, default=None):
+        """ Return data of given section or default if section is not in snapshot """
+        return self._data.get(section, default)
+
+    def update(self, section, data):
+        """
+        Replace data of given section and write snapshot to disk. Returns True if
+        snapshot was written, False if data was unchanged or write failed.
+        """
+        with self._lock:
+            if self._data.get(section) == data:
+                return False
+            self._data[section] = data
+            return self._write()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.info(f"Failed to read snapshot {self.path}, {e}")
+            return {}
+
+        if not isinstance(data, dict) or data.get("version") != SNAPSHOT_VERSION:
+            log.info(f"Ignoring snapshot {self.path} of unknown version")
+            return {}
+        return data
+
+    def _write(self):
+        """ Write snapshot to temporary file and replace old snapshot with it """
+        self._data["version"] = SNAPSHOT_VERSION
+        directory = os.path.dirname(os.path.abspath(self.path))
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".snapshot-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._data, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log.info(f"Failed to write snapshot {self.path}, {e}")
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        return True
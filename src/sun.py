@@ -1,99 +1,134 @@
-import threading
-import time
+import math
+from collections import namedtuple
 from datetime import date, datetime, timedelta
 
-import requests
-import schedule
-
+from src.metrics import REGISTRY
 from src.settings import LOCATION
 
+J2000_DATETIME = datetime(2000, 1, 1, 12)
+OBLIQUITY = math.radians(23.4397)  # Axial tilt of earth
+SUNSET_ELEVATION = math.radians(-0.833)  # Sun elevation at sunset, with refraction
+POLAR_DAY = "day"
+POLAR_NIGHT = "night"
+UPDATE_INTERVAL = 24 * 3600  # Seconds between checks for new year table
+EPOCH = datetime(1970, 1, 1)
+
+SunTimes = namedtuple("SunTimes", ["sunrise", "sunset", "polar"])
+
+YEAR_SECONDS = REGISTRY.histogram("sun_year_seconds",
+                                  "Duration of calculating sun times of a year")
+
 
 class Sun(object):
     """
     Class representing sunset time for given location. Provides sunset time and
     timestamp as datetime objects.
-    When class is created, set up scheduler to update sunset and sunrise times at 12:00
-    every day.
+    Sunrise and sunset times are calculated locally for a whole year when class is
+    created, so no network access is needed. Days are indexed by local mean solar date
+    of the location, so a night is not split at UTC midnight. If scheduler is given,
+    table of a new year is calculated in a scheduled job instead of on first lookup.
 
     Note: All times are in UTC
     """
 
-    def __init__(self):
+    def __init__(self, scheduler=None):
+        location = LOCATION()
+        if not location:
+            raise ValueError("Can not get sun data, location not set")
+        self.latitude, self.longitude = location
+        self._days = {}
         self.update()
-        schedule.every().day.at("12:00").do(self.update)
-        self._scheduler = threading.Thread(target=self._run_schedule)
-        self._scheduler.start()
+        REGISTRY.gauge("sunset_timestamp", "Sunset of current day as UNIX time",
+                       function=lambda: _timestamp(self.sunset))
+        REGISTRY.gauge("sunrise_timestamp", "Sunrise of current day as UNIX time",
+                       function=lambda: _timestamp(self.sunrise))
+        if scheduler:
+            scheduler.every(UPDATE_INTERVAL, self.update, name="sun_update")
 
     def update(self):
         """
-        Update sunset and timestamp class variables. Returns True if sunset updated
-        successfully othervise False
+        Calculate sunrise and sunset times for current year, if not calculated already.
+        Returns True if table was updated, otherwise False
         """
-        data = self._get_sunset_sunrise()
-        if not data:
+        year = self._solar_date(datetime.utcnow()).year
+        if date(year, 12, 31) in self._days:
             return False
 
-        self.sunset = data[0]
-        self.sunrise = data[1]
+        with YEAR_SECONDS.time():
+            self._days.update(self._get_year(year))
         self.timestamp = datetime.utcnow()
         return True
 
-    def is_past_sunset(self):
-        """
-        Return True if sun is set, after sunset return True until sunrise
-        """
-        if not self.sunset or not self.sunrise:
-            return False
-        return self.sunset < datetime.utcnow() < self.sunrise
+    @property
+    def sunset(self):
+        return self.get_day(datetime.utcnow()).sunset
 
-    def _run_schedule(self):
-        """
-        Start loop for scheduler. This should be run at own thread to prevent blocking
-        """
+    @property
+    def sunrise(self):
+        return self.get_day(datetime.utcnow()).sunrise
 
-        while True:
-            schedule.run_pending()
-            time.sleep(60)
+    def get_day(self, now):
+        """ Return SunTimes of solar day containing given UTC datetime """
+        day = self._solar_date(now)
+        if day not in self._days:
+            with YEAR_SECONDS.time():
+                self._days.update(self._get_year(day.year))
+        return self._days[day]
 
-    def _get_sunset_sunrise(self):
+    def is_past_sunset(self, now=None):
         """
-        Return sunset and sunrise as datetime object in tuple or False if sunset
-        time fetch failed. Sun time is fetched from external api and requires to
-        location to be defined and valid in settings.
-
-        Output: (sunset, sunrise)
+        Return True if sun is set, after sunset return True until sunrise
         """
-
-        location = LOCATION()
-        if not location:
-            raise ValueError("Can not get sun data, location not set")
-
-        resp = requests.get(
-            f"https://api.sunrise-sunset.org/json?lat={location[0]}&lng={location[1]}"
-        )
-
-        if resp.status_code == 200:
-            data = resp.json()
-            sunset = self._parse_date(data["results"]["sunset"])
-            sunrise = self._parse_date(data["results"]["sunrise"], next_day=True)
-            return (sunset, sunrise)
-
-        return False
-
-    def _parse_date(self, input_time, next_day=False):
+        now = now or datetime.utcnow()
+        day = self.get_day(now)
+        if day.polar:
+            return day.polar == POLAR_NIGHT
+        return not day.sunrise < now < day.sunset
+
+    def _solar_date(self, now):
+        """ Return local mean solar date of location at given UTC datetime """
+        return (now + timedelta(hours=self.longitude / 15)).date()
+
+    def _get_year(self, year):
+        """ Return dictionary of SunTimes for each day of given year """
+        days = {}
+        day = date(year, 1, 1)
+        while day.year == year:
+            days[day] = self._get_sunrise_sunset(day)
+            day += timedelta(days=1)
+        return days
+
+    def _get_sunrise_sunset(self, day):
         """
-        Return parsed datetime object from string or False if parse failed. If next_day is
-        True add one day (tomorrow) to output.
-        Input must in format "1:23:45 PM"
+        Return SunTimes for given date, calculated with sunrise equation. For polar day
+        and night sunrise and sunset are None and polar tells which one it is.
         """
-
-        today = date.today()
-        if next_day:
-            today += timedelta(days=1)
-
-        try:
-            parsed = datetime.strptime(input_time, '%I:%M:%S %p')
-            parsed = parsed.replace(year=today.year, month=today.month, day=today.day)
-        except ValueError:
-            return False
-        return parsed
+        n = (day - J2000_DATETIME.date()).days - self.longitude / 360
+        anomaly = math.radians((357.5291 + 0.98560028 * n) % 360)
+        center = (1.9148 * math.sin(anomaly) + 0.02 * math.sin(2 * anomaly) +
+                  0.0003 * math.sin(3 * anomaly))
+        ecliptic = math.radians((math.degrees(anomaly) + center + 282.9372) % 360)
+        transit = n + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic)
+
+        declination = math.asin(math.sin(ecliptic) * math.sin(OBLIQUITY))
+        latitude = math.radians(self.latitude)
+        cos_hour_angle = ((math.sin(SUNSET_ELEVATION) -
+                           math.sin(latitude) * math.sin(declination)) /
+                          (math.cos(latitude) * math.cos(declination)))
+        if cos_hour_angle < -1:
+            return SunTimes(None, None, POLAR_DAY)
+        if cos_hour_angle > 1:
+            return SunTimes(None, None, POLAR_NIGHT)
+
+        hour_angle = math.degrees(math.acos(cos_hour_angle)) / 360
+        return SunTimes(self._to_datetime(transit - hour_angle),
+                        self._to_datetime(transit + hour_angle), None)
+
+    def _to_datetime(self, days):
+        """ Return UTC datetime from days since J2000 """
+        return J2000_DATETIME + timedelta(days=days)
+
+
+def _timestamp(utc):
+    """ Return naive UTC datetime as UNIX time, None during polar day or night """
+    return (utc - EPOCH).total_seconds() if utc else None
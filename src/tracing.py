@@ -0,0 +1,185 @@
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+
+TRACE_CAPACITY = 256  # How many finished traces are kept in memory
+SLOW_THRESHOLD = 2  # Seconds after a trace is considered slow
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples of profiled thread
+PROFILE_TOP = 10  # How many most common stacks are kept for a slow trace
+log = logging.getLogger("main")
+
+Span = namedtuple("Span", ["name", "start", "duration", "thread", "attributes"])
+
+
+class Trace(object):
+    """
+    Timed spans of one arrive or leave event, from detection to light change. Span
+    start times are seconds from start of trace.
+    """
+
+    def __init__(self, trace_id, name, start=None):
+        self.trace_id = trace_id
+        self.name = name
+        self.start = time.monotonic() if start is None else start
+        self.timestamp = time.time() - (time.monotonic() - self.start)
+        self.spans = []
+        self.attributes = {}
+        self.duration = None
+        self.profile = None
+
+    def add_span(self, name, start, end, **attributes):
+        self.spans.append(Span(name, start - self.start, end - start,
+                               threading.current_thread().name, attributes))
+
+    def to_dict(self):
+        return {
+            "id": self.trace_id,
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "spans": [span._asdict() for span in self.spans],
+            "profile": self.profile,
+        }
+
+
+class SamplingProfiler(object):
+    """
+    Sample stack of a thread in own thread at given interval. Used only while an event
+    is handled, so there is no cost when no event is in progress.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+
+    @contextmanager
+    def sample(self, thread_id):
+        """ Collect stacks of given thread inside context to yielded Counter """
+        samples = Counter()
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(self.interval):
+                frame = sys._current_frames().get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name}:{frame.f_lineno}")
+                    frame = frame.f_back
+                samples[";".join(reversed(stack))] += 1
+
+        sampler = threading.Thread(target=run, name="profiler", daemon=True)
+        sampler.start()
+        try:
+            yield samples
+        finally:
+            stop.set()
+            sampler.join()
+
+
+class Tracer(object):
+    """
+    Record traces of arrive and leave events. Trace is started where event is detected
+    and activated for the thread handling it, spans are recorded only inside an active
+    trace, so instrumented code costs almost nothing outside of events. Finished traces
+    are kept in a ring buffer. Traces slower than slow threshold are logged with their
+    spans and, if profiler is set, most common stacks sampled during the event.
+    """
+
+    def __init__(self, capacity=TRACE_CAPACITY, slow_threshold=SLOW_THRESHOLD,
+                 profiler=None):
+        self.slow_threshold = slow_threshold
+        self.profiler = profiler
+        self._traces = deque(maxlen=capacity)
+        self._ids = itertools.count(1)
+        self._local = threading.local()
+        self._slow_callbacks = [self._log_slow]
+
+    def start(self, name, start=None):
+        """ Return new trace of event with given name, start is monotonic time """
+        return Trace(next(self._ids), name, start)
+
+    def current(self):
+        """ Return trace active in current thread, None if there is none """
+        return getattr(self._local, "trace", None)
+
+    @contextmanager
+    def activate(self, trace):
+        """ Make given trace active in current thread inside context """
+        previous = self.current()
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """ Record span of given name to active trace, nothing if no trace is active """
+        trace = getattr(self._local, "trace", None)
+        if trace is None:
+            yield
+            return
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            attributes["error"] = repr(e)
+            raise
+        finally:
+            trace.add_span(name, start, time.monotonic(), **attributes)
+
+    @contextmanager
+    def profile(self, trace):
+        """ Sample stacks of current thread inside context, if profiler is set """
+        if trace is None or self.profiler is None:
+            yield
+            return
+        with self.profiler.sample(threading.get_ident()) as samples:
+            yield
+        trace.profile = samples.most_common(PROFILE_TOP)
+
+    def finish(self, trace):
+        """ Store finished trace, run slow callbacks if it took longer than threshold """
+        if trace is None:
+            return
+        trace.duration = time.monotonic() - trace.start
+        slow = trace.duration >= self.slow_threshold
+        if not slow:
+            trace.profile = None
+        self._traces.append(trace)
+        if slow:
+            for callback in list(self._slow_callbacks):
+                callback(trace)
+
+    def on_slow(self, callback):
+        """ Register function to call with each slow trace """
+        self._slow_callbacks.append(callback)
+
+    def traces(self):
+        """ Return list of finished traces, oldest first """
+        return list(self._traces)
+
+    def dump(self):
+        """ Log all finished traces as JSON, one trace per line """
+        traces = self.traces()
+        log.info(f"Dumping {len(traces)} traces")
+        for trace in traces:
+            log.info(json.dumps(trace.to_dict()))
+        return traces
+
+    def _log_slow(self, trace):
+        spans = ", ".join(f"{span.name} {span.duration:.3f}s" for span in trace.spans)
+        log.warning(f"Slow {trace.name} event {trace.trace_id} took "
+                    f"{trace.duration:.2f}s: {spans}")
+        for stack, count in trace.profile or []:
+            log.warning(f"  {count} samples: {stack}")
+
+
+TRACER = Tracer()
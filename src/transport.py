@@ -0,0 +1,146 @@
+import http.client
+import json
+import logging
+import queue
+import socket
+import threading
+
+from phue import Bridge, PhueException, PhueRequestTimeout
+
+POOL_SIZE = 4  # Maximum amount of idle connections kept open to bridge
+REQUEST_TIMEOUT = 10  # Seconds to wait for bridge to respond
+BUSY_STATUSES = (429, 503)  # HTTP statuses of a bridge rejecting requests due to load
+BUSY_ERROR = 901  # API error type of a bridge too busy to handle command
+log = logging.getLogger("main")
+
+
+class BridgeBusy(PhueException):
+    """ Bridge rejected request because it receives commands faster than it handles """
+
+
+class ConnectionPool(object):
+    """
+    Pool of persistent HTTP/1.1 connections to one host. Connections are reused between
+    requests and concurrent requests use separate connections. Bridge does not support
+    pipelining, so each connection has at most one request in flight.
+    """
+
+    def __init__(self, host, size=POOL_SIZE, timeout=REQUEST_TIMEOUT):
+        """
+        Keyword arguments:
+        host -- Host as "address" or "address:port"
+        size -- Maximum amount of idle connections kept open
+        timeout -- Socket timeout in seconds
+        """
+        self.host = host
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.opened = 0
+        self.reused = 0
+
+    def request(self, method, url, body=None):
+        """
+        Send request and return tuple of response status and body. Request is retried
+        once with a new connection if a reused connection was closed by the host.
+        """
+        connection, reused = self._acquire()
+        try:
+            status, data, will_close = self._send(connection, method, url, body)
+        except (http.client.RemoteDisconnected, ConnectionError) as e:
+            connection.close()
+            if not reused:
+                raise
+            log.debug(f'Reused connection to {self.host} closed, {e}')
+            connection, reused = self._acquire(new=True)
+            status, data, will_close = self._send(connection, method, url, body)
+        except Exception:
+            connection.close()
+            raise
+
+        self._release(connection, will_close)
+        return status, data
+
+    def stats(self):
+        """ Return dictionary of request and connection counters """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "opened": self.opened,
+                "reused": self.reused,
+                "idle": self._idle.qsize(),
+            }
+
+    def close(self):
+        """ Close all idle connections """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _acquire(self, new=False):
+        """ Return tuple of connection and boolean telling was it reused from pool """
+        with self._lock:
+            self.requests += 1
+            if not new:
+                try:
+                    connection = self._idle.get_nowait()
+                    self.reused += 1
+                    return connection, True
+                except queue.Empty:
+                    pass
+            self.opened += 1
+        return http.client.HTTPConnection(self.host, timeout=self.timeout), False
+
+    def _release(self, connection, will_close):
+        if will_close:
+            connection.close()
+            return
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _send(self, connection, method, url, body):
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        connection.request(method, url, body, headers)
+        response = connection.getresponse()
+        return response.status, response.read(), response.will_close
+
+
+class PooledBridge(Bridge):
+    """
+    phue Bridge sending requests through a pool of keep-alive connections instead of
+    opening new connection for every request.
+    """
+
+    def __init__(self, ip=None, username=None, config_file_path=None,
+                 pool_size=POOL_SIZE):
+        self.pool_size = pool_size
+        self.pool = None
+        super().__init__(ip, username, config_file_path)
+
+    def request(self, mode='GET', address=None, data=None):
+        """ Send request to bridge API, return parsed response """
+        if self.pool is None or self.pool.host != self.ip:
+            self.pool = ConnectionPool(self.ip, size=self.pool_size)
+
+        body = json.dumps(data) if mode in ('PUT', 'POST') else None
+        try:
+            status, response = self.pool.request(mode, address, body)
+        except socket.timeout:
+            error = f"{mode} Request to {self.ip}{address} timed out."
+            raise PhueRequestTimeout(None, error)
+        log.debug(f"{mode} {address} {data}: {status}")
+        if status in BUSY_STATUSES:
+            raise BridgeBusy(status, f"{mode} Request to {self.ip}{address} rejected "
+                                     f"with status {status}")
+        result = json.loads(response.decode('utf-8'))
+        if isinstance(result, list) and any(
+                isinstance(item, dict) and item.get("error", {}).get("type") == BUSY_ERROR
+                for item in result):
+            raise BridgeBusy(BUSY_ERROR, f"{mode} Request to {self.ip}{address} "
+                                         f"rejected, bridge busy")
+        return result
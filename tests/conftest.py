@@ -0,0 +1,10 @@
+import pytest
+
+from src.settings import reload_config
+
+
+@pytest.fixture(autouse=True)
+def config():
+    """ Parse config again after each test, as environment is restored after test """
+    yield
+    reload_config()
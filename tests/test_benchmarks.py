@@ -0,0 +1,28 @@
+from benchmarks.run import BENCHMARK_ENV, compare, percentile, run
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile(values, 100) == 100
+    assert percentile([3], 95) == 3
+
+
+def test_compare():
+    baseline = {"scenarios": {"leave": {"p95": 0.010}, "arrive": {"p95": 0.010}}}
+    results = {"scenarios": {"leave": {"p95": 0.011}, "arrive": {"p95": 0.020},
+                             "ping_pass": {"p95": 0.5}}}
+    assert compare(results, baseline) == [("arrive", 0.010, 0.020)]
+
+
+def test_run(monkeypatch):
+    for key, value in BENCHMARK_ENV.items():
+        monkeypatch.setenv(key, value)
+    results = run(iterations=3, latency=0, loss=0.1)
+    assert set(results["scenarios"]) == {"arrive", "leave", "ping_pass",
+                                         "handle_packet", "capture_scapy",
+                                         "capture_raw"}
+    for result in results["scenarios"].values():
+        assert result["p50"] <= result["p95"] <= result["p99"]
+        assert result["peak_bytes"] > 0
@@ -0,0 +1,36 @@
+import threading
+import time
+
+from src.bluetooth import (FakeBluetoothBackend, build_echo_request,
+                           is_echo_response)
+
+
+def test_echo_request():
+    request = build_echo_request(7, payload=b"ping")
+    assert request == b"\x08\x07\x04\x00ping"
+
+
+def test_echo_response():
+    assert is_echo_response(b"\x09\x07\x04\x00ping", 7)
+    assert not is_echo_response(b"\x09\x08\x04\x00ping", 7)
+    assert not is_echo_response(b"\x01\x07\x02\x00\x00\x00", 7)
+    assert not is_echo_response(b"\x09", 7)
+
+
+def test_fake_backend():
+    backend = FakeBluetoothBackend(present={"aa:aa:aa:aa:aa:aa"})
+    assert backend.ping("aa:aa:aa:aa:aa:aa")
+    assert not backend.ping("bb:bb:bb:bb:bb:bb")
+    assert backend.pings == ["aa:aa:aa:aa:aa:aa", "bb:bb:bb:bb:bb:bb"]
+
+
+def test_fake_backend_concurrent():
+    backend = FakeBluetoothBackend(present={"aa:aa:aa:aa:aa:aa"}, latency=0.2)
+    threads = [threading.Thread(target=backend.ping, args=("aa:aa:aa:aa:aa:aa",))
+               for _ in range(5)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.monotonic() - start < 0.5
@@ -0,0 +1,145 @@
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from src.commands import (ARRIVE_PRIORITY, GROUP, LEAVE_PRIORITY, LIGHT,
+                          CommandDispatcher, TokenBucket)
+from src.hue import CircuitBreaker, RetryPolicy
+from src.transport import BridgeBusy
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def retry():
+    return RetryPolicy(sleep=0.001, breaker=CircuitBreaker(threshold=100))
+
+
+def test_token_bucket_burst_and_rate(clock):
+    bucket = TokenBucket(10, capacity=2, clock=clock, sleep=clock.sleep)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1)
+    assert bucket.reserve() == pytest.approx(0.2)
+    clock.now += 0.2
+    assert bucket.reserve() == pytest.approx(0.1)
+
+
+def test_token_bucket_acquire_timeout(clock):
+    bucket = TokenBucket(1, clock=clock, sleep=clock.sleep)
+    assert bucket.acquire()
+    assert not bucket.acquire(timeout=0.5)
+    assert clock.now == 100
+    assert bucket.acquire(timeout=1)
+    assert clock.now == 101
+
+
+def test_token_bucket_pause(clock):
+    bucket = TokenBucket(10, clock=clock, sleep=clock.sleep)
+    bucket.pause(2)
+    assert bucket.reserve() == pytest.approx(2.1)
+    clock.now += 3
+    assert bucket.reserve() == 0
+
+
+def test_commands_sent_concurrently(retry):
+    dispatcher = CommandDispatcher(retry, workers=3, light_rate=1000)
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def command(light):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return light
+
+    assert dispatcher.run(LIGHT, command, [(i,) for i in range(6)]) == list(range(6))
+    assert peak[0] == 3
+
+
+def test_commands_rate_limited(retry):
+    dispatcher = CommandDispatcher(retry, workers=3, group_rate=20)
+    dispatcher.buckets[GROUP].reserve()  # Empty burst capacity
+    dispatcher.buckets[GROUP].reserve()
+    start = time.monotonic()
+    dispatcher.run(GROUP, Mock(return_value=True), [()] * 4)
+    assert time.monotonic() - start >= 0.15
+
+
+def test_arrive_commands_sent_before_leave(retry):
+    dispatcher = CommandDispatcher(retry, workers=1, light_rate=1000)
+    blocked = threading.Event()
+    order = []
+    first = dispatcher.submit(LIGHT, lambda: blocked.wait(1), priority=LEAVE_PRIORITY)
+    time.sleep(0.05)  # Worker is busy with first command
+    futures = [dispatcher.submit(LIGHT, order.append, (name,), priority)
+               for name, priority in [("leave", LEAVE_PRIORITY),
+                                      ("arrive", ARRIVE_PRIORITY)]]
+    blocked.set()
+    first.result()
+    for future in futures:
+        future.result()
+    assert order == ["arrive", "leave"]
+
+
+def test_busy_bridge_pauses_commands(retry):
+    dispatcher = CommandDispatcher(retry, light_rate=1000, busy_pause=0.1)
+    func = Mock(side_effect=[BridgeBusy(503, "Busy"), True])
+    func.__name__ = "set_light"
+    start = time.monotonic()
+    assert dispatcher.submit(LIGHT, func, (1,)).result() is True
+    assert func.call_count == 2
+    assert time.monotonic() - start >= 0.1
+
+
+def test_busy_bridge_does_not_open_circuit():
+    retry = RetryPolicy(attempts=3, sleep=0.001, breaker=CircuitBreaker(threshold=5))
+    dispatcher = CommandDispatcher(retry, light_rate=1000, busy_pause=0.01)
+    busy = Mock(side_effect=BridgeBusy(429, "Too many requests"), __name__="set_light")
+    assert dispatcher.run(LIGHT, busy, [(1,), (2,), (3,)]) == [None, None, None]
+    assert busy.call_count == 9
+    assert not retry.breaker.is_open
+
+    func = Mock(return_value=True, __name__="set_light")
+    assert dispatcher.run(LIGHT, func, [(1,), (2,)]) == [True, True]
+
+
+def test_rate_limit_exceeding_deadline(retry):
+    dispatcher = CommandDispatcher(retry, group_rate=0.1)
+    dispatcher.buckets[GROUP].pause(10)
+    func = Mock(return_value=True)
+    with retry.deadline(0.1):
+        assert dispatcher.submit(GROUP, func).result() is None
+    func.assert_not_called()
+
+
+def test_rate_limit_does_not_hold_circuit_probe():
+    breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+    retry = RetryPolicy(breaker=breaker)
+    breaker.failure()
+    dispatcher = CommandDispatcher(retry, group_rate=0.1)
+    dispatcher.buckets[GROUP].pause(10)
+    func = Mock(return_value=True)
+    with retry.deadline(0.1):
+        assert dispatcher.submit(GROUP, func).result() is None
+    assert not breaker._probing
+    assert breaker.allow()  # Circuit can still be probed
@@ -0,0 +1,81 @@
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from src.dispatcher import ActionDispatcher
+
+
+@pytest.fixture
+def blocked():
+    return threading.Event()
+
+
+@pytest.fixture
+def dispatcher(blocked):
+    """ Dispatcher with arrive action blocking until blocked event is set """
+    arrive = Mock(side_effect=lambda: blocked.wait(5))
+    leave = Mock()
+    return ActionDispatcher(arrive=arrive, leave=leave)
+
+
+def actions(dispatcher):
+    return dispatcher._actions["arrive"], dispatcher._actions["leave"]
+
+
+def test_dispatcher_returns_immediately(dispatcher, blocked):
+    dispatcher.arrive()
+    assert not dispatcher.wait(timeout=0.1)
+    blocked.set()
+    assert dispatcher.wait(timeout=1)
+    arrive, leave = actions(dispatcher)
+    arrive.assert_called_once()
+    assert dispatcher.latency is not None
+
+
+def test_dispatcher_coalesce_arrive(dispatcher, blocked):
+    dispatcher.arrive()
+    dispatcher.arrive()
+    dispatcher.arrive()
+    assert dispatcher.queue_depth <= 1
+    blocked.set()
+    dispatcher.wait(timeout=1)
+    arrive, leave = actions(dispatcher)
+    assert arrive.call_count <= 2
+    assert dispatcher.events == 3
+
+
+def test_dispatcher_leave_cancelled_by_arrive(dispatcher, blocked):
+    dispatcher.arrive()  # Blocks worker
+    dispatcher.wait(timeout=0.1)
+    dispatcher.leave()
+    dispatcher.arrive()
+    assert dispatcher.queue_depth == 0
+    blocked.set()
+    dispatcher.wait(timeout=1)
+    arrive, leave = actions(dispatcher)
+    arrive.assert_called_once()
+    leave.assert_not_called()
+
+
+def test_dispatcher_arrive_replaced_by_leave(dispatcher, blocked):
+    dispatcher.arrive()  # Blocks worker
+    dispatcher.wait(timeout=0.1)
+    dispatcher.arrive()
+    dispatcher.leave()
+    assert dispatcher.queue_depth == 1
+    blocked.set()
+    dispatcher.wait(timeout=1)
+    arrive, leave = actions(dispatcher)
+    arrive.assert_called_once()
+    leave.assert_called_once()
+
+
+def test_dispatcher_action_failure():
+    arrive = Mock(side_effect=OSError("Network is unreachable"))
+    dispatcher = ActionDispatcher(arrive=arrive, leave=Mock())
+    dispatcher.arrive()
+    assert dispatcher.wait(timeout=1)
+    dispatcher.arrive()
+    assert dispatcher.wait(timeout=1)
+    assert arrive.call_count == 2
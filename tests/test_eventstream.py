@@ -0,0 +1,166 @@
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import Mock
+
+import pytest
+from phue import PhueRequestTimeout
+
+from src.eventstream import EVENTSTREAM_PATH, BridgeMirror, parse_events
+from src.hue import BridgeState
+
+from .test_hue import bridge_api
+
+
+class EventStreamServer(object):
+    """
+    Local stand-in of bridge event stream. Events put to queue are sent to connected
+    client, None closes the connection.
+    """
+
+    def __init__(self):
+        self.events = queue.Queue()
+        self.keys = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.keys.append(self.headers.get("hue-application-key"))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                self.wfile.write(b": hi\n\n")
+                self.wfile.flush()
+                sequence = 0
+                while True:
+                    messages = server.events.get()
+                    if messages is None:
+                        return
+                    sequence += 1
+                    self.wfile.write(f"id: 1700000000:{sequence}\n"
+                                     f"data: {json.dumps(messages)}\n\n".encode())
+                    self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}{EVENTSTREAM_PATH}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.events.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def light_update(light_id, on):
+    return [{"type": "update", "data": [
+        {"id": "uuid", "id_v1": f"/lights/{light_id}", "type": "light", "on": {"on": on}},
+    ]}]
+
+
+def wait_for(condition, timeout=2):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def bridge():
+    bridge = Mock()
+    bridge.lights = [Mock(light_id=i, on=False) for i in range(1, 4)]
+    for light in bridge.lights:
+        light.name = f"Light {light.light_id}"
+    bridge.scenes = []
+    bridge.groups = []
+    bridge.get_api.side_effect = lambda: bridge_api(bridge)
+    return bridge
+
+
+@pytest.fixture
+def server():
+    server = EventStreamServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def mirror(bridge, server):
+    state = BridgeState(bridge)
+    mirror = BridgeMirror(state, server.url, "username", sleep=0.01).start()
+    assert wait_for(lambda: state.live)
+    yield mirror
+    mirror.stop()
+
+
+def test_parse_events():
+    lines = [b": hi\n", b"\n", b"id: 1:0\n", b"data: [1,\n", b"data: 2]\n", b"\n",
+             b"event: unknown\n", b"data:[3]\r\n", b"\r\n"]
+    assert list(parse_events(lines)) == [("1:0", "[1,\n2]"), (None, "[3]")]
+
+
+def test_mirror_updates_lights(mirror, bridge, server):
+    assert server.keys == ["username"]
+    bridge.get_api.assert_called_once()  # Resync after connection
+
+    server.events.put(light_update(3, True))
+    assert wait_for(lambda: mirror.state.get().lights_by_id[3].on)
+    assert mirror.state.get().lights_by_name["Light 3"].on
+    assert not mirror.state.get().lights_by_id[2].on
+    bridge.get_api.assert_called_once()
+
+
+def test_mirror_live_state_not_expired(mirror, bridge):
+    mirror.state.ttl = 0
+    mirror.state.get()
+    mirror.state.invalidate(topology=False)
+    mirror.state.get()
+    bridge.get_api.assert_called_once()
+
+    mirror.state.invalidate()
+    mirror.state.get()
+    assert bridge.get_api.call_count == 2
+
+
+def test_mirror_resync_on_topology_change(mirror, bridge, server):
+    server.events.put([{"type": "add", "data": [{"id": "uuid", "type": "scene"}]}])
+    assert wait_for(lambda: bridge.get_api.call_count == 2)
+
+    server.events.put(light_update(9, True))  # Unknown light
+    assert wait_for(lambda: bridge.get_api.call_count == 3)
+
+
+def test_mirror_reconnects(mirror, bridge, server):
+    server.events.put(None)
+    assert wait_for(lambda: mirror.connections == 2 and mirror.state.live)
+    assert bridge.get_api.call_count == 2  # Resync after reconnect
+
+    bridge.lights[0].on = True
+    server.events.put(light_update(1, True))
+    assert wait_for(lambda: mirror.state.get().lights_by_id[1].on)
+
+
+def test_mirror_reconnects_after_failed_resync(bridge, server):
+    api = bridge.get_api.side_effect
+    bridge.get_api.side_effect = [PhueRequestTimeout(None, "timeout"), KeyError("x"),
+                                  api(), api()]
+    mirror = BridgeMirror(BridgeState(bridge), server.url, "username",
+                          sleep=0.01).start()
+    assert wait_for(lambda: mirror.state.live)
+    assert mirror.connections == 3
+    mirror.stop()
+
+
+def test_mirror_not_connected(bridge):
+    state = BridgeState(bridge)
+    mirror = BridgeMirror(state, "http://127.0.0.1:9/", "username", sleep=0.01)
+    mirror.start()
+    assert not wait_for(lambda: state.live, timeout=0.1)
+    mirror.stop()
+    bridge.get_api.assert_not_called()
@@ -2,7 +2,10 @@ from unittest.mock import Mock, patch
 
 import pytest
 
-from src.hue import Hue
+from src.commands import GROUP
+from src.hue import BridgeState, CircuitBreaker, Hue, RetryPolicy
+from src.settings import reload_config
+from src.snapshot import SnapshotStore
 
 
 @pytest.fixture
@@ -28,14 +31,34 @@ def scene(lights):
     return scene
 
 
+def bridge_api(bridge):
+    """ Return full api dictionary of mocked lights and scenes """
+    return {
+        "lights": {
+            str(light.light_id): {"name": light.name, "state": {"on": light.on}}
+            for light in bridge.lights
+        },
+        "scenes": {
+            scene.scene_id: {"name": scene.name, "group": scene.group,
+                             "lights": [str(light_id) for light_id in scene.lights]}
+            for scene in bridge.scenes
+        },
+        "groups": {
+            str(group_id): {"name": name, "lights": [str(light) for light in lights]}
+            for group_id, name, lights in bridge.groups
+        },
+    }
+
+
 @pytest.fixture
-@patch('src.hue.Bridge')
-@patch('src.sun.threading')
+@patch('src.hue.PooledBridge')
 @patch('src.hue.Sun')
-def hue(bridge, monkeypatch, sun, scene, lights):
+def hue(sun, bridge, scene, lights):
     hue = Hue()
     hue.bridge.scenes = [scene]
     hue.bridge.lights = lights
+    hue.bridge.groups = []
+    hue.bridge.get_api.side_effect = lambda: bridge_api(hue.bridge)
     return hue
 
 
@@ -46,9 +69,8 @@ def test_hue_constructor(hue):
 def test_hue_arrive_after_sunset(hue):
     hue.sunset.is_past_sunset.return_value = True
     hue.set_arrive()
-    for light in ["Light 1", "Light 2"]:
-        hue.bridge.set_light.assert_any_call(light, 'on', True)
-        hue.bridge.set_light.assert_any_call(light, 'bri', 255)
+    for light in [1, 2]:
+        hue.bridge.set_light.assert_any_call(light, {'on': True, 'bri': 255})
     hue.sunset.is_past_sunset.assert_called_once
     hue.bridge.activate_scene.assert_called_once_with(1, "scene_id")
 
@@ -73,13 +95,190 @@ def test_hue_arrive_when_scene_activated(hue):
 @patch('src.hue.Sun')
 def test_hue_arrive_beofire_sunset(sun, hue):
     hue.set_arrive()
-    for light in ["Light 1", "Light 2"]:
-        hue.bridge.set_light.assert_any_call(light, 'on', True)
-        hue.bridge.set_light.assert_any_call(light, 'bri', 255)
+    for light in [1, 2]:
+        hue.bridge.set_light.assert_any_call(light, {'on': True, 'bri': 255})
     sun.is_past_sunset.assert_called_once
 
 
+def test_hue_arrive_group(hue):
+    hue.bridge.groups = [(3, "Hallway", [1, 2])]
+    hue.set_arrive()
+    hue.bridge.set_group.assert_called_once_with(3, {'on': True, 'bri': 255})
+    hue.bridge.set_light.assert_not_called()
+
+
 def test_hue_leave(hue):
     hue.set_leave_home()
-    for light in hue.bridge.lights:
-        hue.bridge.set_light.assert_any_call(light.light_id, 'on', False)
+    hue.bridge.set_group.assert_called_once_with(0, {'on': False})
+    hue.bridge.set_light.assert_not_called()
+
+
+def test_hue_leave_excluded_lights(hue, monkeypatch):
+    monkeypatch.setenv("EXCLUDE_LIGHTS", "Light 1,Light 3")
+    reload_config()
+    hue.bridge.create_group.return_value = [{"success": {"id": "7"}}]
+    hue.set_leave_home()
+    hue.bridge.create_group.assert_called_once_with("Hue geofencing", [2, 4])
+    hue.bridge.set_group.assert_called_once_with(7, {'on': False})
+    hue.bridge.set_light.assert_not_called()
+
+
+def test_hue_leave_managed_group(hue, monkeypatch, mocker):
+    monkeypatch.setenv("EXCLUDE_LIGHTS", "Light 1")
+    reload_config()
+    hue.bridge.groups = [(7, "Hue geofencing", [2, 4])]
+    run = mocker.spy(hue.commands, "run")
+    hue.set_leave_home()
+    assert run.call_args_list[0][0][:2] == (GROUP, hue.bridge.set_group)
+    hue.bridge.set_group.assert_any_call(7, 'lights', [2, 3, 4])
+    hue.bridge.set_group.assert_any_call(7, {'on': False})
+    hue.bridge.create_group.assert_not_called()
+
+
+def test_hue_leave_managed_group_failed(hue, monkeypatch):
+    monkeypatch.setenv("EXCLUDE_LIGHTS", "Light 1")
+    reload_config()
+    hue.bridge.create_group.return_value = [{"error": {"description": "table full"}}]
+    hue.set_leave_home()
+    for light in [2, 3, 4]:
+        hue.bridge.set_light.assert_any_call(light, {'on': False})
+
+
+def test_hue_state_snapshot(hue):
+    hue.set_leave_home()
+    hue.bridge.get_api.assert_called_once()
+
+
+def test_hue_state_ttl(hue):
+    hue.state.get()
+    hue.state.get()
+    hue.bridge.get_api.assert_called_once()
+
+    hue.state.ttl = 0
+    hue.state.get()
+    assert hue.bridge.get_api.call_count == 2
+
+
+def test_hue_state_invalidate(hue):
+    snapshot = hue.state.get()
+    assert snapshot.lights_by_name["Light 3"].light_id == 3
+    assert snapshot.scenes_by_name["After sunset scene"].lights == [3, 4]
+
+    hue.bridge.lights[2].on = True
+    hue.state.invalidate()
+    assert hue.state.get().lights_by_id[3].on is True
+
+
+def test_hue_live_state_answers_scene_check(hue):
+    hue.sunset.is_past_sunset.return_value = True
+    hue.set_arrive()
+    assert hue.bridge.get_api.call_count == 2  # Fetched again after lights were set
+
+    hue.bridge.get_api.reset_mock()
+    hue.state.invalidate()
+    hue.state.live = True
+    hue.set_arrive()
+    hue.bridge.get_api.assert_called_once()
+    assert hue.bridge.activate_scene.call_count == 2
+
+
+@pytest.fixture
+def sleep(mocker):
+    return mocker.patch('src.hue.time.sleep')
+
+
+def test_retry_policy_backoff(sleep):
+    func = Mock(side_effect=[OSError(), OSError(), OSError(), "result"])
+    policy = RetryPolicy(sleep=1, max_sleep=3, breaker=CircuitBreaker(threshold=10))
+    assert policy.run(func) == "result"
+    sleeps = [call[0][0] for call in sleep.call_args_list]
+    assert 0.5 <= sleeps[0] <= 1
+    assert 1 <= sleeps[1] <= 2
+    assert 1.5 <= sleeps[2] <= 3
+
+
+def test_retry_policy_attempts(sleep):
+    func = Mock(side_effect=OSError())
+    policy = RetryPolicy(attempts=3, breaker=CircuitBreaker(threshold=10))
+    assert policy.run(func) is None
+    assert func.call_count == 3
+
+
+def test_retry_policy_deadline(sleep):
+    func = Mock(side_effect=OSError())
+    policy = RetryPolicy(sleep=10, breaker=CircuitBreaker(threshold=10))
+    with policy.deadline(1):
+        assert policy.run(func) is None
+    func.assert_called_once()
+    sleep.assert_not_called()
+
+
+def test_retry_policy_lazy_property(sleep):
+    values = iter([OSError(), "Bridge"])
+
+    def getter():
+        value = next(values)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    assert RetryPolicy().run(getter) == "Bridge"
+
+
+def test_circuit_breaker_fails_fast(sleep, mocker):
+    monotonic = mocker.patch('src.hue.time.monotonic', return_value=100)
+    policy = RetryPolicy(breaker=CircuitBreaker(threshold=3, reset_timeout=30))
+    func = Mock(side_effect=OSError())
+    assert policy.run(func) is None
+    assert func.call_count == 3
+    assert policy.breaker.is_open
+
+    assert policy.run(func) is None
+    assert func.call_count == 3
+
+    monotonic.return_value = 131
+    func.side_effect = None
+    func.return_value = True
+    assert policy.run(func)
+    assert not policy.breaker.is_open
+
+
+def test_circuit_breaker_probe_failure(mocker):
+    monotonic = mocker.patch('src.hue.time.monotonic', return_value=100)
+    breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+    breaker.failure()
+    assert not breaker.allow()
+
+    monotonic.return_value = 131
+    assert breaker.allow()
+    assert not breaker.allow()  # Only one probe at a time
+    breaker.failure()
+    assert not breaker.allow()
+
+
+def test_circuit_breaker_probe_unexpected_exception(mocker):
+    monotonic = mocker.patch('src.hue.time.monotonic', return_value=100)
+    policy = RetryPolicy(breaker=CircuitBreaker(threshold=1, reset_timeout=30))
+    policy.breaker.failure()
+
+    monotonic.return_value = 131
+    with pytest.raises(ValueError):
+        policy.run(Mock(side_effect=ValueError()))
+    assert policy.breaker.allow()  # Probe was released
+    policy.breaker.success()
+    assert not policy.breaker.is_open
+
+
+def test_hue_state_restored_topology(hue, tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshot"))
+    BridgeState(hue.bridge, store=store).get()
+    hue.bridge.get_api.reset_mock()
+
+    state = BridgeState(hue.bridge, store=SnapshotStore(str(tmp_path / "snapshot")))
+    snapshot = state.get(light_state=False)
+    assert snapshot.restored
+    assert snapshot.lights_by_name["Light 2"].light_id == 2
+    hue.bridge.get_api.assert_not_called()
+
+    assert not state.get().restored
+    hue.bridge.get_api.assert_called_once()
@@ -0,0 +1,109 @@
+import threading
+import urllib.request
+from unittest.mock import Mock
+
+import pytest
+
+from src.hue import RetryPolicy
+from src.metrics import MetricsServer, Registry, serve_metrics
+
+
+@pytest.fixture
+def registry():
+    return Registry(prefix="test_")
+
+
+def test_counter_labels(registry):
+    counter = registry.counter("probes_total", "Probes", ["method"])
+    counter.labels("arp").inc()
+    counter.labels("arp").inc(2)
+    counter.labels("icmp").inc()
+    output = registry.render()
+    assert "# TYPE test_probes_total counter" in output
+    assert 'test_probes_total{method="arp"} 3' in output
+    assert 'test_probes_total{method="icmp"} 1' in output
+
+
+def test_histogram_buckets(registry):
+    histogram = registry.histogram("seconds", "Seconds", buckets=(0.1, 1))
+    for value in [0.05, 0.1, 0.5, 5]:
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert 'test_seconds_bucket{le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{le="1"} 3' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 4' in lines
+    assert "test_seconds_sum 5.65" in lines
+    assert "test_seconds_count 4" in lines
+
+
+def test_function_metric_labels(registry):
+    registry.gauge("residents", "Residents", ["site"],
+                   function=lambda: {("home",): 2, ("cabin",): 0})
+    output = registry.render()
+    assert 'test_residents{site="home"} 2' in output
+    assert 'test_residents{site="cabin"} 0' in output
+
+
+def test_function_metric(registry):
+    stats = {"packets": 0}
+    registry.counter("packets_total", "Packets", function=lambda: stats["packets"])
+    registry.gauge("sunset", "Sunset", function=lambda: None)
+    stats["packets"] = 42
+    output = registry.render()
+    assert "test_packets_total 42" in output
+    assert "test_sunset NaN" in output
+
+
+def test_gauge_replaced(registry):
+    registry.gauge("residents", "Residents").set(1)
+    registry.gauge("residents", "Residents").set(2)
+    assert "test_residents 2" in registry.render()
+
+
+def test_concurrent_increments(registry):
+    counter = registry.counter("total", "Total")
+
+    def increment():
+        for _ in range(1000):
+            counter.inc()
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert 3900 <= counter.labels().value <= 4000
+
+
+def test_metrics_server(registry):
+    registry.counter("requests_total", "Requests").inc()
+    server = MetricsServer(registry, "127.0.0.1", 0)
+    try:
+        url = f"http://127.0.0.1:{server.port}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert "test_requests_total 1" in response.read().decode()
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://127.0.0.1:{server.port}/", timeout=5)
+    finally:
+        server.close()
+
+
+def test_metrics_port_in_use(registry):
+    server = serve_metrics(registry, "127.0.0.1", 0)
+    try:
+        assert serve_metrics(registry, "127.0.0.1", server.port) is None
+    finally:
+        server.close()
+
+
+def test_bridge_retries_counted(mocker):
+    retries = mocker.patch("src.hue.BRIDGE_RETRIES")
+    failures = mocker.patch("src.hue.BRIDGE_FAILURES")
+    mocker.patch("src.hue.time.sleep")
+    func = Mock(side_effect=[OSError, OSError, True])
+    func.__name__ = "set_group"
+    assert RetryPolicy(attempts=3).run(func)
+    retries.labels.assert_called_with("set_group")
+    assert retries.labels.return_value.inc.call_count == 2
+    failures.labels.assert_not_called()
@@ -0,0 +1,469 @@
+import functools
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+import pytest
+from scapy.all import ARP, BOOTP, DHCP, IP, UDP, Ether, ICMPv6ND_NS, IPv6, Raw
+
+from src.bluetooth import FakeBluetoothBackend
+from src.network import (PROBE_TICK, SUSPECT_INTERVAL, SWEEP_BATCH_SIZE,
+                         Network, ProbeCadence)
+from src.presence import ABSENT, PRESENT, SUSPECT, Resident
+from src.settings import LEAVE_MISSES, SCAN_INTERVAL, reload_config
+from src.snapshot import SnapshotStore
+
+
+def arp_reply(ip, mac):
+    return Ether(src=mac)/ARP(op="is-at", psrc=ip, hwsrc=mac)
+
+
+def online(network):
+    """ Return set of (ip, mac) tuples of residents present """
+    return {(resident.ip, resident.wifi_mac) for resident in network.presence.present()}
+
+
+def set_online(network, *devices):
+    """ Add residents present, last seen long ago """
+    for ip, mac in devices:
+        network.presence.restore(Resident(mac, ip, None, {"ip": 0}, PRESENT))
+
+
+@pytest.fixture
+def network():
+    return Network(callback_leave=Mock(), callback_join=Mock(), track=False,
+                   bluetooth=FakeBluetoothBackend())
+
+
+@pytest.fixture
+def srp(mocker):
+    srp = mocker.patch('src.network.srp')
+    srp.return_value = ([], [])
+    return srp
+
+
+def test_handle_packet_ip(network):
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IP(src="192.168.1.10"))
+    assert ("192.168.1.10", "11:22:33:44:55:66") in online(network)
+    assert "192.168.1.10" in network._discovered_hosts
+    network.handle_join.assert_called_once()
+
+
+def test_handle_packet_arp(network):
+    network.handle_packet(arp_reply("192.168.1.11", "11:22:33:44:55:66"))
+    assert ("192.168.1.11", "11:22:33:44:55:66") in online(network)
+    network.handle_join.assert_called_once()
+
+
+def test_handle_packet_known_device(network):
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IP(src="192.168.1.10"))
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IP(src="192.168.1.10"))
+    network.handle_join.assert_called_once()
+
+
+def test_sweep_hosts_known_first(network):
+    network._discovered_hosts.add("192.168.1.200")
+    hosts = list(network._get_sweep_hosts("192.168.1.0/24"))
+    assert hosts[0] == "192.168.1.200"
+    assert hosts.count("192.168.1.200") == 1
+    assert len(hosts) == 254
+
+
+def test_scan_devices_batches(network, srp):
+    network.scan_devices("10.0.0.0/22")
+    assert srp.call_count == 4
+    assert all(len(call[0][0]) <= SWEEP_BATCH_SIZE for call in srp.call_args_list)
+
+
+def test_scan_devices_handles_tracked_replies(network, srp):
+    replies = [
+        arp_reply("192.168.1.10", "11:22:33:44:55:66"),
+        arp_reply("192.168.1.20", "de:ad:be:ef:00:01"),
+    ]
+    srp.return_value = ([(None, reply) for reply in replies], [])
+    network.scan_devices("192.168.1.0/24")
+    assert online(network) == {("192.168.1.10", "11:22:33:44:55:66")}
+    network.handle_join.assert_called_once()
+
+
+def test_scan_devices_stops_when_all_online(network, srp):
+    replies = [
+        arp_reply("10.0.0.10", "11:22:33:44:55:66"),
+        arp_reply("10.0.0.11", "77:88:99:aa:bb:cc"),
+    ]
+    srp.return_value = ([(None, reply) for reply in replies], [])
+    network.scan_devices("10.0.0.0/22")
+    assert srp.call_count == 1
+
+
+def test_probe_devices_first_response_cancels(network):
+    network._probe_arp = Mock(return_value=True)
+    network._probe_icmp = Mock(side_effect=lambda device, cancel: cancel.wait(5))
+    network._probe_tcp = Mock(return_value=False)
+    device = Resident("11:22:33:44:55:66", "192.168.1.10", None, {}, PRESENT)
+    assert network._probe_devices([device]) == {"11:22:33:44:55:66"}
+
+
+def test_probe_devices_deadline(network):
+    network._probe_arp = Mock(side_effect=lambda device, cancel: cancel.wait(5))
+    network._probe_icmp = Mock(return_value=False)
+    network._probe_tcp = Mock(side_effect=OSError("Network is unreachable"))
+    device = Resident("11:22:33:44:55:66", "192.168.1.10", None, {}, PRESENT)
+    assert network._probe_devices([device], deadline=0.1) == set()
+
+
+def test_ping_devices_online_lost_device(network, mocker):
+    mocker.patch("src.network.HEARTBEAT_WINDOW", 0)
+    mocker.patch("src.network.LEAVE_MISSES", 3)
+    present = ("192.168.1.10", "11:22:33:44:55:66")
+    lost = ("192.168.1.11", "77:88:99:aa:bb:cc")
+    set_online(network, present, lost)
+    network._probe_arp = Mock(side_effect=lambda device, cancel: device == present[0])
+    network._probe_icmp = Mock(return_value=False)
+    network._probe_tcp = Mock(return_value=False)
+    network.ping_devices_online(now=1000)
+    assert network.presence.get(lost[1]).state == SUSPECT
+    assert network._cadence[present[1]].interval == 600  # Backed off from 300
+
+    assert not network.ping_devices_online(now=1010)  # Suspect probed every 30 s
+    network.ping_devices_online(now=1030)
+    assert online(network) == {present, lost}
+    network.ping_devices_online(now=1060)
+    assert online(network) == {present}
+    network.handle_leave.assert_not_called()
+
+    network._probe_arp.side_effect = None
+    network._probe_arp.return_value = False
+    for now in [1600, 1630, 1660]:
+        network.ping_devices_online(now=now)
+    assert online(network) == set()
+    network.handle_leave.assert_called_once()
+
+
+def test_ping_devices_online_grace_period(network, mocker):
+    mocker.patch("src.network.HEARTBEAT_WINDOW", 0)
+    mocker.patch("src.network.LEAVE_MISSES", 1)
+    mocker.patch("src.network.LEAVE_GRACE", 600)
+    network.presence.restore(Resident("11:22:33:44:55:66", "192.168.1.10", None,
+                                      {"ip": 700}, PRESENT))
+    network._probe_devices = Mock(return_value=set())
+    network.ping_devices_online(now=1000)
+    assert network.presence.get("11:22:33:44:55:66").state == SUSPECT
+    network.ping_devices_online(now=1300)
+    assert online(network) == set()
+
+
+def test_suspect_seen_during_probe_stays_present(network, mocker):
+    mocker.patch("src.network.HEARTBEAT_WINDOW", 0)
+    set_online(network, ("192.168.1.10", "11:22:33:44:55:66"))
+
+    def probe(residents, **kwargs):
+        network.handle_packet(Ether(src="11:22:33:44:55:66")/IP(src="192.168.1.10"))
+        return set()
+
+    network._probe_devices = Mock(side_effect=probe)
+    network.ping_devices_online(now=1000)
+    assert network.presence.get("11:22:33:44:55:66").state == PRESENT
+
+
+def test_scan_devices_bluetooth(network, monkeypatch):
+    monkeypatch.setenv("BLUETOOTH_DEVICES", ",".join([
+        "11:22:33:44:55:66;aa:aa:aa:aa:aa:aa",
+        "77:88:99:aa:bb:cc;bb:bb:bb:bb:bb:bb",
+    ]))
+    reload_config()
+    network._bluetooth.present = {"aa:aa:aa:aa:aa:aa"}
+    network.scan_devices_bluetooth()
+    assert online(network) == {(None, "11:22:33:44:55:66")}
+    assert network.presence.get("aa:aa:aa:aa:aa:aa").wifi_mac == "11:22:33:44:55:66"
+    assert network._bluetooth.pings.count("aa:aa:aa:aa:aa:aa") == 1
+    network.handle_join.assert_called_once()
+
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IP(src="192.168.1.10"))
+    network.handle_join.assert_called_once()  # Already arrived from Bluetooth
+
+
+def test_restore_from_snapshot(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshot"))
+    store.update("network", {
+        "devices": [
+            {"ip": "192.168.1.10", "mac": "11:22:33:44:55:66", "last_seen": time.time()},
+            {"bluetooth": "bb:bb:bb:bb:bb:bb", "last_seen": time.time() - 7200},
+        ],
+        "hosts": ["192.168.1.10", "192.168.1.20"],
+    })
+    network = Network(callback_leave=Mock(), callback_join=Mock(), track=False,
+                      bluetooth=FakeBluetoothBackend(), store=store)
+    assert online(network) == {("192.168.1.10", "11:22:33:44:55:66")}
+    assert network._discovered_hosts == {"192.168.1.10", "192.168.1.20"}
+    network.handle_join.assert_not_called()
+
+
+def test_save_to_snapshot(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshot"))
+    network = Network(callback_leave=Mock(), callback_join=Mock(), track=False,
+                      bluetooth=FakeBluetoothBackend(), store=store)
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IP(src="192.168.1.10"))
+
+    data = SnapshotStore(str(tmp_path / "snapshot")).get("network")
+    assert data["hosts"] == ["192.168.1.10"]
+    assert data["devices"][0]["mac"] == "11:22:33:44:55:66"
+
+
+class FakeCaptureSocket(object):
+    """ Capture socket returning given packets, readable while packets are left """
+
+    def __init__(self, packets):
+        self._reader, self._writer = socket.socketpair()
+        self.packets = list(packets)
+        for _ in self.packets:
+            self._writer.send(b"\0")
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def recv(self):
+        self._reader.recv(1)
+        return self.packets.pop(0)
+
+
+def test_bpf_filter(network, monkeypatch):
+    assert network._get_BPF_filter() == \
+        "ether src host 11:22:33:44:55:66 or ether src host 77:88:99:aa:bb:cc"
+    assert network._get_BPF_filter() is network._get_BPF_filter()
+
+    monkeypatch.setenv("DEVICES", "11:22:33:44:55:66")
+    reload_config()
+    assert network._get_BPF_filter() == "ether src host 11:22:33:44:55:66"
+
+
+def test_capture_pauses_when_all_online(network, mocker):
+    mocker.patch("src.network.HEARTBEAT_WINDOW", 0)
+    sock = FakeCaptureSocket([
+        Ether(src="11:22:33:44:55:66")/IP(src="192.168.1.10"),
+        Ether(src="77:88:99:aa:bb:cc")/IP(src="192.168.1.11"),
+        Ether(src="77:88:99:aa:bb:cc")/IP(src="192.168.1.11"),
+    ])
+    network._capture_packets(sock, network._get_BPF_filter())
+    assert not network._capture_active.is_set()
+    assert network.handle_join.call_count == 2
+    assert len(sock.packets) == 1
+    assert network.capture_stats()["packets"] == 2
+
+
+def test_heartbeat_keeps_capture_active(network):
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IP(src="192.168.1.10"))
+    network.handle_packet(Ether(src="77:88:99:aa:bb:cc")/IP(src="192.168.1.11"))
+    network.handle_packet(Ether(src="77:88:99:aa:bb:cc")/IP(src="192.168.1.11"))
+    assert network._capture_active.is_set()
+    assert network.handle_join.call_count == 2
+    assert network.capture_stats()["heartbeats"] == 1
+
+
+def test_ping_skips_residents_seen_within_heartbeat(network, mocker):
+    mocker.patch("src.network.HEARTBEAT_WINDOW", 600)
+    network.presence.restore(Resident("11:22:33:44:55:66", "192.168.1.10", None,
+                                      {"ip": time.time() - 400}, PRESENT))
+    network.presence.restore(Resident("77:88:99:aa:bb:cc", "192.168.1.11", None,
+                                      {"ip": time.time() - 900}, PRESENT))
+    network._probe_arp = Mock(return_value=False)
+    network._probe_icmp = Mock(return_value=False)
+    network._probe_tcp = Mock(return_value=False)
+    network.ping_devices_online()
+    network._probe_arp.assert_called_once()
+    assert network._probe_arp.call_args[0][0] == "192.168.1.11"
+    assert network.presence.get("11:22:33:44:55:66").state == PRESENT
+    assert network.presence.get("77:88:99:aa:bb:cc").state == SUSPECT
+    assert network.capture_stats()["probes_skipped"] == 1
+
+
+def test_probes_not_started_are_not_misses(mocker):
+    mocker.patch("src.network.HEARTBEAT_WINDOW", 0)
+    pool = ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    pool.submit(release.wait, 5)  # Shared pool saturated by another site
+    network = Network(callback_leave=Mock(), callback_join=Mock(), track=False,
+                      bluetooth=FakeBluetoothBackend(), probe_pool=pool)
+    set_online(network, ("192.168.1.10", "11:22:33:44:55:66"))
+    network._probe_devices = functools.partial(network._probe_devices, deadline=0.1)
+    network._probe_arp = Mock(return_value=False)
+    now = time.time() + 86400
+    try:
+        network.ping_devices_online(now=now)
+    finally:
+        release.set()
+    assert network.presence.get("11:22:33:44:55:66").state == PRESENT
+    assert network._cadence["11:22:33:44:55:66"].next_probe == now + PROBE_TICK
+    assert network._cadence["11:22:33:44:55:66"].misses == 0
+    pool.shutdown()
+    network._probe_arp.assert_not_called()
+
+
+def test_ping_passes_do_not_overlap(network):
+    set_online(network, ("192.168.1.10", "11:22:33:44:55:66"))
+    network._ping_lock.acquire()
+    network._probe_devices = Mock(return_value=set())
+    assert network.ping_devices_online(now=time.time() + 86400) is False
+    assert network.scan_devices_bluetooth() is False
+    network._probe_devices.assert_not_called()
+
+
+def test_ping_pass_failure_releases_lock(network):
+    set_online(network, ("192.168.1.10", "11:22:33:44:55:66"))
+    network._probe_devices = Mock(side_effect=RuntimeError())
+    with pytest.raises(RuntimeError):
+        network.ping_devices_online(now=time.time() + 86400)
+    network._probe_devices = Mock(return_value={"11:22:33:44:55:66"})
+    network.ping_devices_online(now=time.time() + 86400)
+    network._probe_devices.assert_called_once()
+
+
+def test_probe_is_not_heartbeat(network, mocker):
+    mocker.patch("src.network.HEARTBEAT_WINDOW", 600)
+    now = time.time()
+    network.presence.restore(Resident("11:22:33:44:55:66", "192.168.1.10", None,
+                                      {"ip": now - 900, "probe": now - 300}, PRESENT))
+    network._cadence["11:22:33:44:55:66"] = ProbeCadence(300, now, 0)
+    network._probe_arp = Mock(return_value=True)
+    network.ping_devices_online(now=now)
+    network._probe_arp.assert_called_once()
+    assert network.capture_stats()["probes_skipped"] == 0
+
+
+def test_capture_resumes_when_device_lost(network, mocker):
+    mocker.patch("src.network.LEAVE_MISSES", 1)
+    network._capture_active.clear()
+    set_online(network, ("192.168.1.10", "11:22:33:44:55:66"))
+    network._probe_devices = Mock(return_value=set())
+    network.ping_devices_online()
+    assert network._capture_active.is_set()
+
+
+def test_capture_filter_change(network, monkeypatch):
+    sock = FakeCaptureSocket([])
+    bpf_filter = network._get_BPF_filter()
+    network.reload_filter()  # Filter not changed, capture continues
+    monkeypatch.setenv("DEVICES", "11:22:33:44:55:66")
+    reload_config()
+    network.reload_filter()
+    network._capture_packets(sock, bpf_filter)
+    assert network._capture_active.is_set()
+
+
+def dhcp(message_type, mac="11:22:33:44:55:66", requested=None):
+    options = [("message-type", message_type)]
+    if requested:
+        options.append(("requested_addr", requested))
+    packet = (Ether(src=mac)/IP(src="0.0.0.0", dst="255.255.255.255") /
+              UDP(sport=68, dport=67)/BOOTP()/DHCP(options=options + ["end"]))
+    return Ether(bytes(packet))  # Dissect as captured
+
+
+def test_handle_packet_dhcp_request(network):
+    network.handle_packet(dhcp("request", requested="192.168.1.10"))
+    assert online(network) == {("192.168.1.10", "11:22:33:44:55:66")}
+    network.handle_join.assert_called_once()
+
+
+def test_handle_packet_dhcp_discover_learns_ip(network):
+    network.handle_packet(dhcp("discover"))
+    assert online(network) == {(None, "11:22:33:44:55:66")}
+    network.handle_join.assert_called_once()
+
+    announcement = Ether(src="11:22:33:44:55:66")/ARP(psrc="192.168.1.10",
+                                                      pdst="192.168.1.10")
+    network.handle_packet(announcement)
+    assert online(network) == {("192.168.1.10", "11:22:33:44:55:66")}
+    assert "192.168.1.10" in network._discovered_hosts
+    network.handle_join.assert_called_once()
+
+
+def test_handle_packet_dhcp_other_messages(network):
+    network.handle_packet(dhcp("release"))
+    network.handle_join.assert_not_called()
+
+
+def test_handle_packet_arp_probe(network):
+    network.handle_packet(Ether(src="11:22:33:44:55:66") /
+                          ARP(psrc="0.0.0.0", pdst="192.168.1.10"))
+    assert online(network) == {("192.168.1.10", "11:22:33:44:55:66")}
+
+
+def test_handle_packet_neighbor_solicitation(network):
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IPv6(src="::") /
+                          ICMPv6ND_NS(tgt="fe80::1"))
+    assert online(network) == {(None, "11:22:33:44:55:66")}
+    network.handle_join.assert_called_once()
+
+
+def test_resident_without_address(network, mocker):
+    mocker.patch("src.network.HEARTBEAT_WINDOW", 0)
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IPv6(src="::") /
+                          ICMPv6ND_NS(tgt="fe80::1"))
+    network.handle_packet(Ether(src="77:88:99:aa:bb:cc")/IP(src="192.168.1.11"))
+    assert network._capture_active.is_set()  # Address of first resident is unknown
+
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IP(src="192.168.1.10"))
+    assert not network._capture_active.is_set()
+
+
+def test_silent_resident_without_address_leaves(network, mocker):
+    mocker.patch("src.network.HEARTBEAT_WINDOW", 0)
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IPv6(src="::") /
+                          ICMPv6ND_NS(tgt="fe80::1"))
+    network._probe_arp = Mock(return_value=True)
+    joined = time.time()
+
+    network.ping_devices_online(now=joined + SCAN_INTERVAL * 60)
+    assert network.presence.get("11:22:33:44:55:66").state == SUSPECT
+    for i in range(1, LEAVE_MISSES):
+        network.ping_devices_online(now=joined + SCAN_INTERVAL * 60 +
+                                    i * SUSPECT_INTERVAL)
+    assert network.presence.get("11:22:33:44:55:66").state == ABSENT
+    network.handle_leave.assert_called_once()
+    network._probe_arp.assert_not_called()
+
+
+def test_handle_packet_unspecified_source(network):
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IP(src="0.0.0.0")/Raw(b"x"))
+    network.handle_join.assert_not_called()
+
+
+def test_probes_without_ip(network, monkeypatch):
+    monkeypatch.setenv("BLUETOOTH_DEVICES", "11:22:33:44:55:66;aa:aa:aa:aa:aa:aa")
+    reload_config()
+    probes = network._get_probes(Resident("11:22:33:44:55:66", None, None, {}, PRESENT))
+    assert probes == [(network._probe_bluetooth, "aa:aa:aa:aa:aa:aa")]
+
+
+def test_restore_bluetooth_only_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setenv("BLUETOOTH_DEVICES", "77:88:99:aa:bb:cc;bb:bb:bb:bb:bb:bb")
+    reload_config()
+    store = SnapshotStore(str(tmp_path / "snapshot"))
+    store.update("network", {"devices": [
+        {"bluetooth": "bb:bb:bb:bb:bb:bb", "last_seen": time.time()},
+    ]})
+    network = Network(callback_leave=Mock(), callback_join=Mock(), track=False,
+                      bluetooth=FakeBluetoothBackend(), store=store)
+    assert online(network) == {(None, "77:88:99:aa:bb:cc")}
+
+
+def test_probe_metrics(network, mocker):
+    probes = mocker.patch("src.network.PROBES")
+    failed = threading.Event()
+
+    def fail(address, cancel):
+        failed.set()
+        raise OSError()
+
+    # ARP responds only after TCP has failed, so TCP is not cancelled before it runs
+    network._probe_arp = Mock(side_effect=lambda address, cancel: failed.wait(5),
+                              __name__="_probe_arp")
+    network._probe_icmp = Mock(return_value=False, __name__="_probe_icmp")
+    network._probe_tcp = Mock(side_effect=fail, __name__="_probe_tcp")
+    device = Resident("11:22:33:44:55:66", "192.168.1.10", None, {}, PRESENT)
+    network._probe_devices([device])
+    probes.labels.assert_any_call("arp", "up")
+    probes.labels.assert_any_call("tcp", "error")
@@ -0,0 +1,75 @@
+import threading
+
+from src.presence import ABSENT, PRESENT, SUSPECT, PresenceStore, Resident
+
+
+def test_mark_present_new_resident():
+    presence = PresenceStore()
+    resident, previous = presence.mark_present("11:22:33:44:55:66", "dhcp", now=10)
+    assert previous is None
+    assert resident == Resident("11:22:33:44:55:66", None, None, {"dhcp": 10}, PRESENT)
+    assert presence.is_present("11:22:33:44:55:66")
+
+
+def test_lookup_by_any_address():
+    presence = PresenceStore()
+    presence.mark_present("11:22:33:44:55:66", "arp", ip="192.168.1.10",
+                          bluetooth_mac="aa:aa:aa:aa:aa:aa")
+    for identifier in ["11:22:33:44:55:66", "192.168.1.10", "aa:aa:aa:aa:aa:aa"]:
+        assert presence.get(identifier).wifi_mac == "11:22:33:44:55:66"
+    assert presence.get("192.168.1.11") is None
+
+
+def test_address_change_updates_index():
+    presence = PresenceStore()
+    presence.mark_present("11:22:33:44:55:66", "arp", ip="192.168.1.10", now=10)
+    resident, previous = presence.mark_present("11:22:33:44:55:66", "ip",
+                                               ip="192.168.1.20", now=20)
+    assert previous.ip == "192.168.1.10"
+    assert resident.seen == {"arp": 10, "ip": 20}
+    assert resident.last_seen == 20
+    assert presence.get("192.168.1.10") is None
+    assert presence.get("192.168.1.20") is resident
+
+    presence.mark_present("77:88:99:aa:bb:cc", "ip", ip="192.168.1.20")
+    presence.mark_present("11:22:33:44:55:66", "ip", ip="192.168.1.30")
+    assert presence.get("192.168.1.20").wifi_mac == "77:88:99:aa:bb:cc"
+
+
+def test_mark_absent():
+    presence = PresenceStore()
+    assert presence.mark_absent("11:22:33:44:55:66") is None
+    presence.mark_present("11:22:33:44:55:66", "arp", ip="192.168.1.10")
+    assert presence.mark_absent("11:22:33:44:55:66").state == ABSENT
+    assert presence.present() == []
+    assert presence.get("192.168.1.10").state == ABSENT
+
+
+def test_concurrent_updates():
+    presence = PresenceStore()
+    macs = [f"11:22:33:44:55:{i:02x}" for i in range(8)]
+
+    def update(mac):
+        for i in range(200):
+            presence.mark_present(mac, "ip", ip=f"10.0.{i}.{macs.index(mac)}")
+
+    threads = [threading.Thread(target=update, args=(mac,)) for mac in macs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(presence.present()) == 8
+    for i, mac in enumerate(macs):
+        assert presence.get(f"10.0.199.{i}").wifi_mac == mac
+        assert presence.get(f"10.0.198.{i}") is None
+
+
+def test_mark_suspect_not_after_seen():
+    presence = PresenceStore()
+    presence.mark_present("11:22:33:44:55:66", "arp", now=10)
+    assert presence.mark_suspect("11:22:33:44:55:66", unseen_since=5) is None
+    assert presence.mark_suspect("11:22:33:44:55:66", unseen_since=10).state == SUSPECT
+    assert presence.is_present("11:22:33:44:55:66")
+    resident, previous = presence.mark_present("11:22:33:44:55:66", "ip", now=20)
+    assert previous.state == SUSPECT
+    assert resident.state == PRESENT
@@ -0,0 +1,98 @@
+from unittest.mock import Mock
+
+import pytest
+from scapy.all import ARP, IP, Ether
+
+from src.bluetooth import FakeBluetoothBackend
+from src.capture import SharedCapture
+from src.network import Network
+from src.rawcapture import (BPF_INSTRUCTION, MAX_FILTER_DEVICES,
+                            FakeFrameSource, build_filter, frame_ipv4_source,
+                            frame_source)
+
+HOME = "11:22:33:44:55:66"
+GUEST = "77:88:99:aa:bb:cc"
+OTHER = "11:22:33:44:55:67"
+
+
+@pytest.fixture
+def source():
+    source = FakeFrameSource([HOME, GUEST])
+    yield source
+    source.close()
+
+
+@pytest.fixture
+def network():
+    return Network(callback_leave=Mock(), callback_join=Mock(), track=False,
+                   bluetooth=FakeBluetoothBackend())
+
+
+def frame(mac, ip="192.168.1.10"):
+    return memoryview(bytes(Ether(src=mac)/IP(src=ip)))
+
+
+def test_filter_passes_tracked_devices(source):
+    source.send(Ether(src=OTHER)/IP(src="192.168.1.12"))
+    source.send(Ether(src=GUEST)/IP(src="192.168.1.11"))
+    source.send(Ether(src="66:55:44:33:22:11")/IP(src="192.168.1.13"))
+    source.send(Ether(src=HOME)/IP(src="192.168.1.10"))
+
+    assert frame_source(source.socket.recv()) == GUEST
+    assert frame_source(source.socket.recv()) == HOME
+    source.socket.ins.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        source.socket.recv()
+
+
+def test_filter_size():
+    assert len(build_filter([HOME, GUEST])) == 10 * BPF_INSTRUCTION.size
+    devices = [f"02:00:00:00:{i // 256:02x}:{i % 256:02x}"
+               for i in range(MAX_FILTER_DEVICES + 1)]
+    assert len(build_filter(devices)) == BPF_INSTRUCTION.size  # Accept all
+
+
+def test_frame_fields():
+    assert frame_source(frame(GUEST)) == GUEST
+    assert bytes(frame_ipv4_source(frame(HOME, "192.168.1.10"))) == \
+        bytes([192, 168, 1, 10])
+    arp = memoryview(bytes(Ether(src=HOME)/ARP(psrc="192.168.1.10")))
+    assert frame_ipv4_source(arp) is None
+    assert frame_ipv4_source(frame(HOME)[:20]) is None
+
+
+def test_handle_frame(network, mocker):
+    handle_packet = mocker.spy(network, "handle_packet")
+    network.handle_captured(frame(HOME))
+    network.handle_captured(frame(HOME))  # Heartbeat from header
+    network.handle_captured(frame(HOME, "192.168.1.20"))  # New address is dissected
+    network.handle_captured(frame("66:55:44:33:22:11"))  # Not tracked
+
+    assert handle_packet.call_count == 2
+    assert network.presence.get(HOME).ip == "192.168.1.20"
+    network.handle_join.assert_called_once()
+    assert network.capture_stats()["heartbeats"] == 1
+    assert network.capture_stats()["packets"] == 4
+
+
+def test_capture_raw_frames(network, source, mocker):
+    mocker.patch("src.network.HEARTBEAT_WINDOW", 0)
+    source.send(Ether(src=HOME)/IP(src="192.168.1.10"))
+    source.send(Ether(src=OTHER)/IP(src="192.168.1.12"))
+    source.send(Ether(src=GUEST)/IP(src="192.168.1.11"))
+    network._capture_packets(source.socket, network._get_BPF_filter())
+
+    assert not network._capture_active.is_set()
+    assert network.handle_join.call_count == 2
+    assert network.capture_stats()["packets"] == 2
+
+
+def test_shared_capture_raw_frames(mocker):
+    mocker.patch("src.capture.threading.Thread")
+    capture = SharedCapture()
+    network = Mock(config=Mock(devices=(HOME,)), capture_active=True)
+    capture.attach(network)
+    capture.handle_packet(frame(HOME))
+    capture.handle_packet(frame(GUEST))
+    network.handle_captured.assert_called_once()
+    assert capture.packets == 2
@@ -0,0 +1,33 @@
+from scapy.all import IP, Ether, wrpcap
+
+from src.replay import ARRIVE, LEAVE, Decision, Replay, read_packets
+
+
+def packet(timestamp, mac="11:22:33:44:55:66", ip="192.168.1.10"):
+    packet = Ether(src=mac)/IP(src=ip)
+    packet.time = timestamp
+    return packet
+
+
+def test_replay_decisions(tmp_path):
+    capture = str(tmp_path / "capture.pcap")
+    wrpcap(capture, [
+        packet(1000),
+        packet(1005),
+        packet(1100, mac="de:ad:be:ef:00:01", ip="192.168.1.20"),
+        packet(5000, mac="de:ad:be:ef:00:01", ip="192.168.1.20"),
+    ])
+    replay = Replay()
+    decisions = replay.run([capture])
+    # Silent after heartbeat window, then three missed probe passes
+    assert decisions == [Decision(1000, ARRIVE), Decision(1670, LEAVE)]
+    assert replay.packets == 4
+    assert replay.handled == 2
+
+
+def test_read_packets_directory(tmp_path):
+    wrpcap(str(tmp_path / "2.pcap"), [packet(2000)])
+    wrpcap(str(tmp_path / "1.pcap"), [packet(1000), packet(1001)])
+    (tmp_path / "notes.txt").write_text("not a capture")
+    timestamps = [float(packet.time) for packet in read_packets([str(tmp_path)])]
+    assert timestamps == [1000, 1001, 2000]
@@ -0,0 +1,76 @@
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from src.scheduler import Scheduler
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = Scheduler()
+    yield scheduler
+    scheduler.shutdown()
+
+
+def wait_for(condition, timeout=2):
+    end = time.monotonic() + timeout
+    while not condition() and time.monotonic() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_scheduler_runs_jobs_in_deadline_order(scheduler):
+    runs = []
+    scheduler.every(10, lambda: runs.append("slow"), delay=0.1)
+    scheduler.every(10, lambda: runs.append("fast"), delay=0.01)
+    assert wait_for(lambda: len(runs) == 2)
+    assert runs == ["fast", "slow"]
+
+
+def test_scheduler_interval(scheduler):
+    func = Mock(__name__="job")
+    job = scheduler.every(0.05, func)
+    assert wait_for(lambda: job.runs >= 3)
+    assert job.lag < 0.05
+    assert job.duration is not None
+    assert scheduler.stats()["job"]["runs"] >= 3
+
+
+def test_scheduler_no_overlap(scheduler):
+    release = threading.Event()
+    running = []
+
+    def job():
+        running.append(True)
+        release.wait(1)
+
+    job = scheduler.every(0.02, job, delay=0)
+    assert wait_for(lambda: job.skipped >= 2)
+    assert len(running) == 1
+    release.set()
+    assert wait_for(lambda: job.runs >= 1)
+
+
+def test_scheduler_job_failure(scheduler):
+    func = Mock(__name__="job", side_effect=OSError("Network is unreachable"))
+    job = scheduler.every(0.02, func, delay=0)
+    assert wait_for(lambda: job.runs >= 2)
+
+
+def test_scheduler_cancel(scheduler):
+    func = Mock(__name__="job")
+    job = scheduler.every(0.05, func)
+    scheduler.cancel(job)
+    time.sleep(0.1)
+    func.assert_not_called()
+    assert scheduler.stats() == {}
+
+
+def test_scheduler_shutdown(scheduler):
+    func = Mock(__name__="job")
+    scheduler.every(0.05, func)
+    scheduler.shutdown()
+    time.sleep(0.1)
+    func.assert_not_called()
@@ -1,4 +1,6 @@
+import os
 from importlib import reload
+from unittest.mock import Mock
 
 import pytest
 
@@ -17,7 +19,7 @@ def test_location_decimals(monkeypatch):
     monkeypatch.setenv("LOCATION_LON", "27.123")
 
     reload(settings)
-    assert settings.LOCATION() == (55, 27)
+    assert settings.LOCATION() == (55.123, 27.123)
 
 
 def test_location_invalid(monkeypatch):
@@ -38,7 +40,7 @@ def test_location_empty(monkeypatch):
 def test_devices(monkeypatch):
     monkeypatch.setenv("DEVICES", "00:1B:44:11:3A:B7,E8:FC:AF:B9:BE:A2")
     reload(settings)
-    assert set(settings.DEVICES()) == {"00:1B:44:11:3A:B7", "E8:FC:AF:B9:BE:A2"}
+    assert set(settings.DEVICES()) == {"00:1b:44:11:3a:b7", "e8:fc:af:b9:be:a2"}
 
 
 def test_devices_empty(monkeypatch):
@@ -60,3 +62,77 @@ def test_devices_missing(monkeypatch):
     with pytest.raises(ValueError):
         reload(settings)
         settings.DEVICES()
+
+
+def test_bluetooth_devices(monkeypatch):
+    monkeypatch.setenv("BLUETOOTH_DEVICES", "11:22:33:44:55:66;aa:bb:cc:dd:ee:ff")
+    reload(settings)
+    assert settings.BLUETOOTH_DEVICES() == {"11:22:33:44:55:66": "aa:bb:cc:dd:ee:ff"}
+
+
+def test_bluetooth_devices_missing(monkeypatch):
+    monkeypatch.delenv("BLUETOOTH_DEVICES", raising=False)
+    reload(settings)
+    assert settings.BLUETOOTH_DEVICES() == {}
+
+
+def test_config_indexes(monkeypatch):
+    monkeypatch.setenv("DEVICES", "11:22:33:44:55:66,77:88:99:AA:BB:CC")
+    monkeypatch.setenv("BLUETOOTH_DEVICES", "77:88:99:AA:BB:CC;AA:BB:CC:DD:EE:FF")
+    monkeypatch.setenv("ARRIVE_LIGHTS", "Light 2,Light 1")
+    config = settings.reload_config()
+    assert config.device_set == {"11:22:33:44:55:66", "77:88:99:aa:bb:cc"}
+    assert config.bluetooth_devices == {"77:88:99:aa:bb:cc": "aa:bb:cc:dd:ee:ff"}
+    assert config.wifi_by_bluetooth == {"aa:bb:cc:dd:ee:ff": "77:88:99:aa:bb:cc"}
+    assert config.arrive_lights == ("Light 2", "Light 1")
+
+
+def test_config_invalid_bluetooth_device(monkeypatch):
+    monkeypatch.setenv("BLUETOOTH_DEVICES", "11:22:33:44:55:66")
+    with pytest.raises(ValueError):
+        settings.reload_config()
+
+
+def test_reload_config_invalid_keeps_current(monkeypatch):
+    config = settings.get_config()
+    callback = Mock()
+    settings.on_reload(callback)
+    monkeypatch.setenv("DEVICES", "invalid")
+    with pytest.raises(ValueError):
+        settings.reload_config()
+    assert settings.get_config() is config
+    callback.assert_not_called()
+
+
+def test_reload_config_from_file(tmp_path, monkeypatch):
+    monkeypatch.setenv("DEVICES", "11:22:33:44:55:66")
+    monkeypatch.setenv("EXCLUDE_LIGHTS", "Light 1")
+    env_file = tmp_path / ".env"
+    env_file.write_text("# Comment\nDEVICES=77:88:99:aa:bb:cc\n"
+                        "EXCLUDE_LIGHTS='Light 2'\n")
+    callback = Mock()
+    settings.on_reload(callback)
+    config = settings.reload_config(str(env_file))
+    assert config.devices == ("77:88:99:aa:bb:cc",)
+    assert settings.EXCLUDE_LIGHTS() == {"Light 2"}
+    callback.assert_called_once_with()
+
+
+def test_config_watcher(tmp_path, monkeypatch):
+    monkeypatch.setenv("DEVICES", "11:22:33:44:55:66")
+    settings.reload_config()
+    env_file = tmp_path / ".env"
+    env_file.write_text("DEVICES=11:22:33:44:55:66\n")
+    watcher = settings.ConfigWatcher(str(env_file))
+    assert not watcher.check()
+
+    env_file.write_text("DEVICES=invalid\n")
+    os.utime(env_file, (0, 1))
+    assert not watcher.check()
+    assert settings.DEVICES() == ("11:22:33:44:55:66",)
+    assert os.environ["DEVICES"] == "11:22:33:44:55:66"
+
+    env_file.write_text("DEVICES=77:88:99:aa:bb:cc\n")
+    os.utime(env_file, (0, 2))
+    assert watcher.check()
+    assert settings.DEVICES() == ("77:88:99:aa:bb:cc",)
@@ -0,0 +1,137 @@
+from unittest.mock import Mock
+
+import pytest
+from scapy.all import IP, Ether
+
+from src.bluetooth import FakeBluetoothBackend
+from src.capture import SharedCapture
+from src.metrics import REGISTRY
+from src.network import Network
+from src.settings import SiteConfig, load_sites
+from src.sites import MultiSite
+
+HOME = "11:22:33:44:55:66"
+CABIN = "77:88:99:aa:bb:cc"
+
+
+@pytest.fixture
+def sites_dir(tmp_path):
+    (tmp_path / "home.env").write_text(
+        f"BRIDGE_IP=192.168.1.2\nDEVICES={HOME}\nARRIVE_LIGHTS=Light 1\n"
+        f"SNAPSHOT_PATH={tmp_path}/home.snapshot\n")
+    (tmp_path / "cabin.env").write_text(
+        f"BRIDGE_IP=192.168.2.2\nNETWORK_MASK=192.168.2.0/24\nDEVICES={CABIN}\n"
+        f"AFTER_SUNSET=Evening\nSNAPSHOT_PATH={tmp_path}/cabin.snapshot\n")
+    return tmp_path
+
+
+@pytest.fixture
+def runtime(mocker, sites_dir):
+    mocker.patch("src.hue.PooledBridge")
+    return MultiSite(load_sites(sites_dir), scheduler=Mock(),
+                     bluetooth=FakeBluetoothBackend(), track=False)
+
+
+@pytest.fixture
+def capture(mocker):
+    mocker.patch("src.capture.threading.Thread")
+    return SharedCapture()
+
+
+def network(devices):
+    return Network(callback_leave=Mock(), callback_join=Mock(), track=False,
+                   bluetooth=FakeBluetoothBackend(),
+                   config=lambda: Mock(devices=devices))
+
+
+def test_site_config(sites_dir):
+    cabin, home = load_sites(sites_dir)
+    assert cabin.name == "cabin"
+    assert cabin.devices == (CABIN,)
+    assert cabin.network_mask == "192.168.2.0/24"
+    assert cabin.after_sunset_scene == "Evening"
+    assert home.name == "home"
+    assert home.network_mask == "192.168.1.0/24"
+    assert home.after_sunset_scene == "After sunset scene"
+    assert home.arrive_lights == ("Light 1",)
+
+
+def test_site_config_without_bridge(tmp_path):
+    path = tmp_path / "home.env"
+    path.write_text(f"DEVICES={HOME}\n")
+    with pytest.raises(ValueError):
+        SiteConfig(str(path))
+
+
+def test_load_sites_empty(tmp_path):
+    with pytest.raises(ValueError):
+        load_sites(tmp_path)
+
+
+def test_scheduler_scales_with_sites(mocker, sites_dir):
+    mocker.patch("src.hue.PooledBridge")
+    scheduler = mocker.patch("src.sites.Scheduler")
+    (sites_dir / "office.env").write_text(
+        f"BRIDGE_IP=192.168.3.2\nDEVICES={HOME}\n"
+        f"SNAPSHOT_PATH={sites_dir}/office.snapshot\n")
+    MultiSite(load_sites(sites_dir), bluetooth=FakeBluetoothBackend(), track=False)
+    scheduler.assert_called_once_with(workers=6)
+
+
+def test_sites_have_own_state(runtime):
+    cabin, home = runtime.sites
+    assert cabin.hue is not home.hue
+    assert cabin.hue.sunset is home.hue.sunset
+    assert cabin.network._probe_pool is home.network._probe_pool
+    assert cabin.hue.after_sunset_scene == "Evening"
+
+    home.network.handle_packet(Ether(src=HOME)/IP(src="192.168.1.10"))
+    assert home.network.presence.is_present(HOME)
+    assert not cabin.network.presence.get(HOME)
+    assert home.network.config.devices == (HOME,)
+
+
+def test_site_reload(runtime, sites_dir):
+    cabin, home = runtime.sites
+    (sites_dir / "home.env").write_text(
+        f"BRIDGE_IP=192.168.1.2\nDEVICES={HOME},{CABIN}\n")
+    runtime.reload()
+    assert home.network.config.devices == (HOME, CABIN)
+
+    (sites_dir / "home.env").write_text("BRIDGE_IP=192.168.1.2\nDEVICES=invalid\n")
+    assert not home.watcher.reload()
+    assert home.network.config.devices == (HOME, CABIN)
+
+
+def test_site_metrics(runtime):
+    runtime.sites[1].network.handle_packet(Ether(src=HOME)/IP(src="192.168.1.10"))
+    output = REGISTRY.render()
+    assert 'hue_geofencing_residents_present{site="home"} 1' in output
+    assert 'hue_geofencing_residents_present{site="cabin"} 0' in output
+
+
+def test_shared_capture_demultiplex(capture):
+    home, cabin = network((HOME,)), network((CABIN, HOME))
+    capture.attach(home)
+    capture.attach(cabin)
+    assert capture._get_BPF_filter() == \
+        f"ether src host {HOME} or ether src host {CABIN}"
+
+    capture.handle_packet(Ether(src=CABIN)/IP(src="192.168.2.10"))
+    assert cabin.presence.is_present(CABIN)
+    assert not home.presence.get(CABIN)
+
+    capture.handle_packet(Ether(src=HOME)/IP(src="192.168.1.10"))
+    assert home.presence.is_present(HOME)
+    assert cabin.presence.is_present(HOME)
+    assert home.counters()["packets"] == 1
+    assert cabin.counters()["packets"] == 2
+
+
+def test_shared_capture_paused_network(capture):
+    home = network((HOME,))
+    capture.attach(home)
+    home._capture_active.clear()
+    capture.handle_packet(Ether(src=HOME)/IP(src="192.168.1.10"))
+    assert not home.presence.get(HOME)
+    assert capture.packets == 1
@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+from src.snapshot import SnapshotStore
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "snapshot")
+
+
+def test_snapshot_write_and_restore(path):
+    store = SnapshotStore(path)
+    assert store.get("network") is None
+    assert store.update("network", {"hosts": ["192.168.1.10"]})
+    assert store.update("bridge", {"lights": {}})
+
+    restored = SnapshotStore(path)
+    assert restored.get("network") == {"hosts": ["192.168.1.10"]}
+    assert restored.get("bridge") == {"lights": {}}
+
+
+def test_snapshot_unchanged(path):
+    store = SnapshotStore(path)
+    assert store.update("network", {"hosts": []})
+    assert not store.update("network", {"hosts": []})
+
+
+def test_snapshot_no_temporary_files(path, tmp_path):
+    store = SnapshotStore(path)
+    for i in range(3):
+        store.update("network", {"hosts": [i]})
+    assert [p.name for p in tmp_path.iterdir()] == ["snapshot"]
+
+
+def test_snapshot_corrupted(path):
+    with open(path, "w") as f:
+        f.write('{"version": 1, "network": ')
+    assert SnapshotStore(path).get("network") is None
+
+
+def test_snapshot_unknown_version(path):
+    with open(path, "w") as f:
+        json.dump({"version": 0, "network": {}}, f)
+    assert SnapshotStore(path).get("network") is None
+
+
+def test_snapshot_write_failed(tmp_path):
+    store = SnapshotStore(str(tmp_path / "missing" / "snapshot"))
+    assert not store.update("network", {"hosts": []})
@@ -1,43 +1,71 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime
 
 import pytest
 
-from src.sun import Sun
+from src.sun import POLAR_DAY, POLAR_NIGHT, Sun
 
 
 @pytest.fixture
-def mock(mocker):
-    mock = mocker.Mock()
-    mocker.patch('src.sun.requests', mock)
-    mocker.patch('src.sun.threading.Thread', mock)
+def location(monkeypatch):
+    def set_location(lat, lon):
+        monkeypatch.setattr('src.sun.LOCATION', lambda: (lat, lon))
+    set_location(60.17, 24.94)  # Helsinki
+    return set_location
 
-    mock.get.return_value.status_code = 200
-    mock.get.return_value.json.return_value = {
-        "results": {
-            "sunrise": "3:15:00 AM",
-            "sunset": "5:30:00 PM",
-        }
-    }
 
-    return mock
+def assert_close(expected, actual, minutes=3):
+    assert abs((expected - actual).total_seconds()) < minutes * 60
 
 
-def test_sun(mock):
+def test_sun(location):
     sun = Sun()
-    sunrise_mocked = datetime.utcnow() + timedelta(days=1)
-    sunrise_mocked = sunrise_mocked.replace(hour=3, minute=15, second=0, microsecond=0)
-    sunset_mocked = datetime.utcnow().replace(hour=17, minute=30, second=0, microsecond=0)
-    timestamp_delta = datetime.utcnow() - sun.timestamp
+    day = sun.get_day(datetime(2020, 6, 21, 12))
+    assert_close(datetime(2020, 6, 21, 0, 54), day.sunrise)
+    assert_close(datetime(2020, 6, 21, 19, 50), day.sunset)
+    assert day.polar is None
+    assert sun.timestamp is not None
 
-    assert sunrise_mocked == sun.sunrise
-    assert sunset_mocked == sun.sunset
-    assert round(timestamp_delta.total_seconds()) == 0
-    assert sun._scheduler is not None
 
+def test_sun_western_longitude(location):
+    location(40.71, -74.0)  # New York
+    day = Sun().get_day(datetime(2020, 6, 22, 0, 0))
+    assert_close(datetime(2020, 6, 21, 9, 25), day.sunrise)
+    assert_close(datetime(2020, 6, 22, 0, 31), day.sunset)
 
-def test_is_past_sunset(mock):
+
+def test_sun_full_year(location):
+    sun = Sun()
+    year = sun._solar_date(datetime.utcnow()).year
+    assert date(year, 1, 1) in sun._days
+    assert date(year, 12, 31) in sun._days
+    assert not sun.update()
+
+
+def test_is_past_sunset(location):
     sun = Sun()
-    sunset_mocked = datetime.utcnow().replace(hour=17, minute=30, second=0, microsecond=0)
+    assert not sun.is_past_sunset(datetime(2020, 6, 21, 12))
+    assert sun.is_past_sunset(datetime(2020, 6, 21, 21))
+    assert sun.is_past_sunset(datetime(2020, 6, 21, 0, 30))
+    assert sun.is_past_sunset(datetime(2020, 12, 21, 15))
+
 
-    expected_value = datetime.utcnow() > sunset_mocked
+def test_is_past_sunset_current_time(location):
+    sun = Sun()
+    day = sun.get_day(datetime.utcnow())
+    expected_value = not day.sunrise < datetime.utcnow() < day.sunset
     assert expected_value == sun.is_past_sunset()
+
+
+def test_polar_day_and_night(location):
+    location(69.9, 27.0)  # Utsjoki
+    sun = Sun()
+    assert sun.get_day(datetime(2020, 6, 21, 12)).polar == POLAR_DAY
+    assert not sun.is_past_sunset(datetime(2020, 6, 21, 23))
+    assert sun.get_day(datetime(2020, 12, 21, 12)).polar == POLAR_NIGHT
+    assert sun.is_past_sunset(datetime(2020, 12, 21, 12))
+
+
+def test_location_missing(location, monkeypatch):
+    monkeypatch.setattr('src.sun.LOCATION', lambda: False)
+    with pytest.raises(ValueError):
+        Sun()
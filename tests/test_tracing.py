@@ -0,0 +1,117 @@
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+from scapy.all import IP, Ether
+
+from src.bluetooth import FakeBluetoothBackend
+from src.dispatcher import ActionDispatcher
+from src.network import Network
+from src.tracing import TRACER, SamplingProfiler, Tracer
+
+
+@pytest.fixture
+def tracer():
+    return Tracer(capacity=3, slow_threshold=0.05)
+
+
+def span_names(trace):
+    return [span.name for span in trace.spans]
+
+
+def test_span_without_trace(tracer):
+    with tracer.span("noop"):
+        pass
+    assert tracer.current() is None
+    assert tracer.traces() == []
+
+
+def test_span_recorded_to_active_trace(tracer):
+    trace = tracer.start("arrive")
+    with tracer.activate(trace):
+        with tracer.span("bridge", attempt=0):
+            pass
+        with pytest.raises(OSError):
+            with tracer.span("failing"):
+                raise OSError("Network is unreachable")
+    assert tracer.current() is None
+    assert span_names(trace) == ["bridge", "failing"]
+    assert trace.spans[0].attributes == {"attempt": 0}
+    assert "Network is unreachable" in trace.spans[1].attributes["error"]
+
+
+def test_trace_ids_and_ring_buffer(tracer):
+    traces = [tracer.start("arrive") for _ in range(5)]
+    for trace in traces:
+        tracer.finish(trace)
+    assert [trace.trace_id for trace in traces] == [1, 2, 3, 4, 5]
+    assert tracer.traces() == traces[2:]
+    assert [trace.to_dict()["id"] for trace in tracer.dump()] == [3, 4, 5]
+
+
+def test_slow_trace_callback(tracer):
+    callback = Mock()
+    tracer.on_slow(callback)
+    fast = tracer.start("arrive")
+    tracer.finish(fast)
+    slow = tracer.start("leave", start=time.monotonic() - 1)
+    tracer.finish(slow)
+    callback.assert_called_once_with(slow)
+    assert slow.duration >= 1
+
+
+def test_profiler_samples_slow_trace(tracer):
+    tracer.profiler = SamplingProfiler(interval=0.001)
+    trace = tracer.start("arrive")
+    with tracer.profile(trace):
+        time.sleep(0.1)
+    tracer.finish(trace)
+    stack, count = trace.profile[0]
+    assert "test_profiler_samples_slow_trace" in stack
+    assert count > 0
+
+
+def test_profile_dropped_from_fast_trace(tracer):
+    tracer.profiler = SamplingProfiler(interval=0.001)
+    trace = tracer.start("arrive")
+    with tracer.profile(trace):
+        pass
+    tracer.finish(trace)
+    assert trace.profile is None
+
+
+def test_trace_from_packet_to_action():
+    done = threading.Event()
+
+    def arrive():
+        with TRACER.span("bridge"):
+            done.set()
+
+    dispatcher = ActionDispatcher(arrive=arrive, leave=Mock())
+    network = Network(callback_leave=dispatcher.leave, callback_join=dispatcher.arrive,
+                      track=False, bluetooth=FakeBluetoothBackend())
+    network.handle_packet(Ether(src="11:22:33:44:55:66")/IP(src="192.168.1.10"))
+    assert dispatcher.wait(timeout=1)
+    trace = TRACER.traces()[-1]
+    assert trace.name == "arrive"
+    assert trace.attributes["mac"] == "11:22:33:44:55:66"
+    assert span_names(trace) == ["capture", "handle_packet", "queue", "bridge"]
+    assert trace.spans[-1].thread != threading.current_thread().name
+
+
+def test_coalesced_traces_finished():
+    blocked = threading.Event()
+    dispatcher = ActionDispatcher(arrive=lambda: blocked.wait(5), leave=Mock())
+    dispatcher.arrive()  # Blocks worker
+    dispatcher.wait(timeout=0.1)
+    traces = [TRACER.start("arrive"), TRACER.start("leave")]
+    with TRACER.activate(traces[0]):
+        dispatcher.arrive()
+    with TRACER.activate(traces[1]):
+        dispatcher.leave()
+    assert traces[0].attributes["dropped"] == "coalesced"
+    blocked.set()
+    assert dispatcher.wait(timeout=1)
+    assert "dropped" not in traces[1].attributes
+    assert traces[1].duration is not None
@@ -0,0 +1,98 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.transport import BridgeBusy, ConnectionPool, PooledBridge
+
+
+class BridgeHandler(BaseHTTPRequestHandler):
+    """ Stand-in for Hue bridge API, echoes request back as JSON """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._respond()
+
+    def do_PUT(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self._respond(json.loads(self.rfile.read(length)))
+
+    def _respond(self, data=None):
+        self.server.connections.add(self.client_address)
+        body = json.dumps([{"path": self.path, "data": data}]).encode()
+        self.send_response(self.server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.server.close_connections:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.drop_connections:
+            self.close_connection = True  # Close without telling the client
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BridgeHandler)
+    server.connections = set()
+    server.close_connections = False
+    server.drop_connections = False
+    server.status = 200
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def host(server):
+    return f"127.0.0.1:{server.server_address[1]}"
+
+
+def test_pool_reuses_connection(server, host):
+    pool = ConnectionPool(host)
+    for _ in range(5):
+        status, data = pool.request("GET", "/api/user/lights")
+        assert status == 200
+    assert pool.stats() == {"requests": 5, "opened": 1, "reused": 4, "idle": 1}
+    assert len(server.connections) == 1
+    pool.close()
+
+
+def test_pool_connection_close(server, host):
+    server.close_connections = True
+    pool = ConnectionPool(host)
+    pool.request("GET", "/api/user/lights")
+    pool.request("GET", "/api/user/lights")
+    assert pool.stats()["opened"] == 2
+    assert pool.stats()["idle"] == 0
+
+
+def test_pool_stale_connection(server, host):
+    server.drop_connections = True
+    pool = ConnectionPool(host)
+    pool.request("GET", "/api/user/lights")
+    status, data = pool.request("GET", "/api/user/lights")
+    assert status == 200
+    assert pool.stats()["opened"] == 2
+
+
+def test_pooled_bridge(server, host, tmp_path):
+    bridge = PooledBridge(host, username="user", config_file_path=str(tmp_path / "c"))
+    response = bridge.set_light(1, {"on": True, "bri": 255})
+    assert response == [[{"path": "/api/user/lights/1/state",
+                          "data": {"on": True, "bri": 255}}]]
+    bridge.set_light(2, {"on": True})
+    assert bridge.pool.stats()["reused"] == 1
+    assert len(server.connections) == 1
+
+
+def test_pooled_bridge_busy(server, host, tmp_path):
+    bridge = PooledBridge(host, username="user", config_file_path=str(tmp_path / "c"))
+    server.status = 429
+    with pytest.raises(BridgeBusy):
+        bridge.set_light(1, {"on": True})